@@ -2,20 +2,37 @@
 
 from __future__ import annotations
 
+import asyncio
 import os
 from datetime import datetime
 
-from telegram import Update
-from telegram.ext import ContextTypes
+from telegram import InputFile, Update
+from telegram.ext import CommandHandler, ContextTypes, MessageHandler, filters
 
+import async_database
 import config
 import database
+import db_backup
+import export_jobs
+import memo_delivery
+import user_cache
+
+# Bot API не принимает от бота файлы больше 50 МБ
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+# Сколько ждать отправку копии в Telegram (секунды)
+FILE_TRANSFER_TIMEOUT = 300
+# Как часто проверять размер журнала изменений (секунды)
+JOURNAL_TRIM_INTERVAL = 3600
 
 
 def is_admin(user_id: int) -> bool:
     return user_id in getattr(config, "ADMIN_USER_IDS", set())
 
 
+def _format_size(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} МБ"
+
+
 def _format_dt_iso(iso_str: str) -> str:
     try:
         return datetime.fromisoformat(iso_str).strftime("%d.%m.%Y %H:%M")
@@ -40,7 +57,7 @@ async def cmd_memos(update: Update, context: ContextTypes.DEFAULT_TYPE):
             limit = 10
 
     limit = max(1, min(limit, 50))
-    memos = database.list_voice_memos(limit=limit)
+    memos = await async_database.list_voice_memos(limit=limit)
 
     if not memos:
         await update.message.reply_text("Памяточек пока нет.")
@@ -73,15 +90,61 @@ async def cmd_memo_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("id должен быть числом. Пример: /memo_delete 12")
         return
 
-    ok = database.delete_voice_memo(memo_id)
+    ok = await async_database.delete_voice_memo(memo_id)
     if ok:
+        memo_delivery.invalidate()
         await update.message.reply_text(f"✅ Удалил памяточку id={memo_id}.")
     else:
         await update.message.reply_text(f"Не нашёл памяточку id={memo_id}.")
 
 
+async def cmd_stats_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats_check — сверить счетчики user_stats с историей отметок."""
+    if not update.effective_user or not update.message:
+        return
+
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+
+    mismatched = await async_database.check_user_stats()
+    if not mismatched:
+        await update.message.reply_text("✅ Счетчики совпадают с историей отметок.")
+        return
+
+    sample = ", ".join(str(uid) for uid in mismatched[:20])
+    await update.message.reply_text(
+        f"⚠️ Расхождения у {len(mismatched)} пользователей: {sample}\n"
+        "Пересчитать: /stats_rebuild"
+    )
+
+
+async def cmd_stats_rebuild(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats_rebuild — пересчитать user_stats по истории отметок."""
+    if not update.effective_user or not update.message:
+        return
+
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+
+    count = await async_database.rebuild_user_stats()
+    user_cache.clear()
+    await update.message.reply_text(f"✅ Счетчики пересчитаны для {count} пользователей.")
+
+
+async def _send_file(update: Update, path: str, filename: str, caption: str):
+    # read_file_handle=False: HTTPXRequest читает файл кусками при отправке, а не целиком в память
+    with open(path, "rb") as f:
+        await update.message.reply_document(
+            document=InputFile(f, filename=filename, read_file_handle=False),
+            caption=caption,
+            write_timeout=FILE_TRANSFER_TIMEOUT,
+        )
+
+
 async def cmd_db_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/db_backup — отправить текущий файл базы администратору."""
+    """/db_backup — отправить сжатую копию базы администратору."""
     if not update.effective_user or not update.message:
         return
 
@@ -94,15 +157,85 @@ async def cmd_db_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Файл базы не найден.")
         return
 
+    backup = None
     try:
-        with open(db_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=os.path.basename(db_path))
+        # Накопленные взаимодействия должны попасть в копию
+        await async_database.flush_interactions()
+        backup = await asyncio.to_thread(db_backup.create_backup)
+
+        if backup["size"] > TELEGRAM_UPLOAD_LIMIT:
+            await update.message.reply_text(
+                f"❌ Сжатая копия весит {_format_size(backup['size'])} — больше лимита Telegram на отправку файлов."
+            )
+            return
+
+        ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+        filename = f"{os.path.splitext(os.path.basename(db_path))[0]}-{ts}.db.gz"
+        await _send_file(
+            update,
+            backup["path"],
+            filename,
+            f"База {_format_size(backup['raw_size'])} → {_format_size(backup['size'])}, "
+            f"снимок за {backup['elapsed']:.1f} с\n"
+            f"sha256: {backup['sha256']}\n"
+            f"Цепочка {backup['chain']['chain_id']}: дальше /db_delta",
+        )
+        # Дельты считаются от этой копии только после того, как она дошла
+        await asyncio.to_thread(db_backup.commit_backup, backup["chain"])
     except Exception as e:
         await update.message.reply_text(f"❌ Не удалось отправить базу: {e}")
+    finally:
+        if backup:
+            db_backup.remove(backup["path"])
+
+
+async def cmd_db_delta(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/db_delta — отправить изменения с последней копии (полной или дельты)."""
+    if not update.effective_user or not update.message:
+        return
+
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+
+    path = None
+    try:
+        await async_database.flush_interactions()
+        path, header = await asyncio.to_thread(db_backup.create_delta)
+
+        size = os.path.getsize(path)
+        if size > TELEGRAM_UPLOAD_LIMIT:
+            await update.message.reply_text(
+                f"❌ Дельта весит {_format_size(size)} — больше лимита Telegram, сделай полную копию: /db_backup"
+            )
+            return
+
+        base = os.path.splitext(os.path.basename(database.DATABASE_NAME))[0]
+        filename = f"{base}-{header['chain_id']}-delta-{header['delta_number']:03d}.gz"
+        await _send_file(
+            update,
+            path,
+            filename,
+            f"Дельта №{header['delta_number']}: {header['rows']} строк, {_format_size(size)}\n"
+            f"sha256: {header['sha256']}",
+        )
+        await asyncio.to_thread(db_backup.commit_delta, header)
+    except db_backup.ChainError as e:
+        await update.message.reply_text(f"⚠️ {e}")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Не удалось собрать дельту: {e}")
+    finally:
+        if path:
+            db_backup.remove(path)
+
+
+def _staged_restore_path() -> str:
+    """Файл, в котором собирается восстанавливаемая база (полная копия плюс дельты)"""
+    return f"{database.DATABASE_NAME}.restore"
 
 
 async def cmd_db_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/db_restore — включить режим восстановления: ждём .db файлом."""
+    """/db_restore — включить режим восстановления: ждём .db файлом, затем дельты."""
     if not update.effective_user or not update.message:
         return
 
@@ -110,25 +243,21 @@ async def cmd_db_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(user_id):
         return
 
+    # Начинаем заново: недособранная копия от прошлого /db_restore не нужна
+    db_backup.remove(_staged_restore_path())
+    context.user_data["db_restore_staged"] = None
     context.user_data["waiting_for_db_restore"] = True
     await update.message.reply_text(
-        "Отправь мне файлом (document) SQLite базу *.db, и я заменю текущую.\n"
-        "Перед заменой сделаю бэкап текущего pillow_bot.db.\n\n"
-        "Важно: после восстановления перезапусти бота/контейнер на BotHost."
+        "Отправь мне файлом (document) SQLite базу *.db или копию *.db.gz из /db_backup.\n"
+        "Потом можно прислать дельты из /db_delta по порядку.\n"
+        "Текущая база заменится один раз, по /db_restore_done, когда всё собрано; "
+        "перед заменой сделаю бэкап текущего pillow_bot.db.\n\n"
+        "Перезапуск не нужен: бот подменит базу на ходу."
     )
 
 
-def _looks_like_sqlite(path: str) -> bool:
-    try:
-        with open(path, "rb") as f:
-            header = f.read(16)
-        return header.startswith(b"SQLite format 3\x00")
-    except Exception:
-        return False
-
-
 async def handle_db_restore_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """При включенном /db_restore принимает document и заменяет DB."""
+    """При включенном /db_restore принимает полную копию и дельты в отложенную базу."""
     if not update.effective_user or not update.message:
         return
 
@@ -144,47 +273,129 @@ async def handle_db_restore_document(update: Update, context: ContextTypes.DEFAU
         return
 
     filename = (doc.file_name or "").lower()
-    if filename and not filename.endswith(".db"):
-        await update.message.reply_text("Пожалуйста, пришли файл с расширением .db")
+    if filename and not filename.endswith((".db", ".gz")):
+        await update.message.reply_text("Пожалуйста, пришли файл с расширением .db или .db.gz")
+        return
+
+    max_upload = config.RESTORE_MAX_UPLOAD_MB * 1024 * 1024
+    if doc.file_size and doc.file_size > max_upload:
+        await update.message.reply_text(
+            f"Файл весит {_format_size(doc.file_size)}, а принять можно до {config.RESTORE_MAX_UPLOAD_MB} МБ."
+        )
         return
 
     upload_path = f"{database.DATABASE_NAME}.upload"
+    staged_path = _staged_restore_path()
 
     try:
         tg_file = await context.bot.get_file(doc.file_id)
-        await tg_file.download_to_drive(custom_path=upload_path)
-
-        if not _looks_like_sqlite(upload_path):
-            try:
-                os.remove(upload_path)
-            except Exception:
-                pass
-            await update.message.reply_text("Файл не похож на SQLite базу. Отмена.")
+        # Файл скачивается кусками и сразу распаковывается: плохой заголовок прерывает загрузку
+        upload = await asyncio.to_thread(
+            db_backup.receive_upload,
+            tg_file.file_path,
+            upload_path,
+            max_upload,
+            config.RESTORE_MAX_DB_MB * 1024 * 1024,
+        )
+        received = f"Получено {_format_size(upload.received)}, sha256: {upload.checksum}"
+
+        if upload.kind == "delta":
+            staged = context.user_data.get("db_restore_staged")
+            if not staged:
+                db_backup.remove(upload_path)
+                await update.message.reply_text("Сначала пришли полную копию, дельты ложатся на нее.")
+                return
+            # Дельта ложится на отложенную копию: в нее бот не пишет
+            header = await asyncio.to_thread(db_backup.apply_delta, staged_path, upload_path)
+            db_backup.remove(upload_path)
+            staged["deltas"] += 1
+            await update.message.reply_text(
+                f"✅ Дельта №{header['delta_number']} применена к копии. "
+                f"Следующая дельта или /db_restore_done, чтобы заменить базу.\n{received}"
+            )
             return
 
-        ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-        db_path = database.DATABASE_NAME
-        backup_path = f"{db_path}.backup-{ts}.db"
+        await update.message.reply_text(f"{received}\nПроверяю базу...")
+        version = await asyncio.to_thread(db_backup.stage_restore, upload_path, staged_path)
+        context.user_data["db_restore_staged"] = {"version": version, "deltas": 0}
+        await update.message.reply_text(
+            "✅ Копия проверена, текущая база пока не тронута.\n"
+            "Пришли дельты по порядку, затем /db_restore_done — тогда база заменится."
+        )
 
-        if os.path.exists(db_path):
-            os.replace(db_path, backup_path)
+    except db_backup.RestoreError as e:
+        db_backup.remove(upload_path)
+        await update.message.reply_text(f"❌ База не прошла проверку, текущая не тронута: {e}")
+    except db_backup.ChainError as e:
+        db_backup.remove(upload_path)
+        await update.message.reply_text(f"⚠️ {e}")
+    except Exception as e:
+        db_backup.remove(upload_path)
+        await update.message.reply_text(f"❌ Ошибка восстановления базы: {e}")
 
-        os.replace(upload_path, db_path)
 
-        # На всякий случай создаём недостающие таблицы
-        database.init_database()
+async def cmd_db_restore_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/db_restore_done — заменить базу собранной копией и выключить режим восстановления."""
+    if not update.effective_user or not update.message:
+        return
+
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
 
+    staged = context.user_data.get("db_restore_staged")
+    if not staged:
         context.user_data["waiting_for_db_restore"] = False
+        await update.message.reply_text("Режим восстановления выключен, база не менялась.")
+        return
 
-        await update.message.reply_text(
-            f"✅ База восстановлена. Старый файл сохранён как {os.path.basename(backup_path)}.\n"
-            "Перезапусти бота/контейнер на BotHost."
-        )
+    # Процессы экспорта читают файл базы напрямую — подменять его под ними нельзя
+    if export_jobs.running_count():
+        await update.message.reply_text("Сейчас идет экспорт в Excel. Дождись его и повтори /db_restore_done.")
+        return
 
+    try:
+        result = await asyncio.to_thread(db_backup.hot_restore, _staged_restore_path())
+    except db_backup.RestoreError as e:
+        await update.message.reply_text(f"❌ Собранная база не прошла проверку, текущая не тронута: {e}")
+        return
     except Exception as e:
-        try:
-            if os.path.exists(upload_path):
-                os.remove(upload_path)
-        except Exception:
-            pass
         await update.message.reply_text(f"❌ Ошибка восстановления базы: {e}")
+        return
+    memo_delivery.invalidate()
+    user_cache.clear()
+
+    context.user_data["db_restore_staged"] = None
+    context.user_data["waiting_for_db_restore"] = False
+    await update.message.reply_text(
+        f"✅ База восстановлена без перезапуска (дельт: {staged['deltas']}): "
+        f"запись стояла {result['pause']:.2f} с, перенесено напоминаний: {result['rescheduled']}.\n"
+        f"Старый файл сохранён как {os.path.basename(result['backup_path'])}.\n"
+        "Режим восстановления выключен."
+    )
+
+
+async def trim_change_journal(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая проверка размера журнала изменений (если копии долго не снимали)"""
+    await async_database.run(db_backup.trim_journal, config.CHANGE_JOURNAL_MAX_ROWS)
+
+
+def add_handlers(application):
+    """Регистрирует админ-команды в приложении бота."""
+    application.add_handler(CommandHandler("memos", cmd_memos))
+    application.add_handler(CommandHandler("memo_delete", cmd_memo_delete))
+    application.add_handler(CommandHandler("stats_check", cmd_stats_check))
+    application.add_handler(CommandHandler("stats_rebuild", cmd_stats_rebuild))
+    application.add_handler(CommandHandler("db_backup", cmd_db_backup))
+    application.add_handler(CommandHandler("db_delta", cmd_db_delta))
+    application.add_handler(CommandHandler("db_restore", cmd_db_restore))
+    application.add_handler(CommandHandler("db_restore_done", cmd_db_restore_done))
+    application.add_handler(
+        MessageHandler(filters.Document.ALL, handle_db_restore_document),
+        group=0
+    )
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(
+            trim_change_journal, interval=JOURNAL_TRIM_INTERVAL, first=JOURNAL_TRIM_INTERVAL,
+            name='change_journal_trim'
+        )
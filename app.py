@@ -1,18 +1,24 @@
 """WSGI приложение для хостинга.
 
-Поднимает Flask (health endpoints) и запускает Telegram-бота в отдельном потоке.
+Поднимает Flask (health endpoints и /metrics в формате Prometheus) и запускает
+Telegram-бота в отдельном потоке.
 Дополнительно "подмешивает" админ-команды (без правок в bot.py), чтобы:
 - /memos [N] — список последних памяток
 - /memo_delete <id> — удалить памятку
-- /db_backup — отправить текущий pillow_bot.db
-- /db_restore — включить режим восстановления, затем отправить .db файлом
+- /stats_check, /stats_rebuild — сверить и пересчитать счетчики приема
+- /db_backup — отправить сжатую копию pillow_bot.db (начинает цепочку копий)
+- /db_delta — отправить изменения с последней копии цепочки
+- /db_restore — включить режим восстановления, затем отправить .db/.db.gz и дельты;
+  /db_restore_done — заменить базу собранной копией и выключить режим
 """
 
 import asyncio
 import logging
 import threading
 
-from flask import Flask
+from flask import Flask, Response
+
+import metrics
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -33,6 +39,11 @@ def health():
     return {'status': 'healthy'}, 200
 
 
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 _bot_started = False
 _lock = threading.Lock()
 
@@ -40,7 +51,7 @@ _lock = threading.Lock()
 def run_bot_in_thread():
     """Запускает бота в отдельном потоке (без signal handlers)."""
     try:
-        from telegram.ext import Application, CommandHandler, MessageHandler, filters
+        from telegram.ext import Application
 
         import bot
         import admin_tools
@@ -58,16 +69,7 @@ def run_bot_in_thread():
 
             def patched_build(*b_args, **b_kwargs):
                 application = original_build(*b_args, **b_kwargs)
-
-                application.add_handler(CommandHandler('memos', admin_tools.cmd_memos))
-                application.add_handler(CommandHandler('memo_delete', admin_tools.cmd_memo_delete))
-                application.add_handler(CommandHandler('db_backup', admin_tools.cmd_db_backup))
-                application.add_handler(CommandHandler('db_restore', admin_tools.cmd_db_restore))
-                application.add_handler(
-                    MessageHandler(filters.Document.ALL, admin_tools.handle_db_restore_document),
-                    group=0
-                )
-
+                admin_tools.add_handlers(application)
                 return application
 
             builder.build = patched_build
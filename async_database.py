@@ -0,0 +1,143 @@
+"""
+Асинхронный доступ к базе данных для обработчиков бота.
+
+Функции database.py выполняются в отдельном ограниченном пуле потоков,
+поэтому медленный диск не останавливает event loop. Любую функцию
+модуля database можно вызвать как корутину:
+
+    await async_database.get_reminder_time(user_id)
+
+Чтения профиля пользователя (CACHED_READS) отдаются из user_cache, а
+записи в его данные сбрасывают профиль.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import database
+import local_time
+import metrics
+import user_cache
+
+_executor = None
+_executor_lock = threading.Lock()
+_wrapped = {}
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Возвращает пул потоков для запросов к базе (создается при первом обращении)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=config.DB_EXECUTOR_WORKERS,
+                thread_name_prefix='db'
+            )
+        return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию в пуле базы и ждет результат"""
+    loop = asyncio.get_running_loop()
+    # Время вместе с ожиданием свободного потока — именно столько ждет обработчик
+    with metrics.DB_SECONDS.time(getattr(func, '__name__', 'unknown')):
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+# Чтения вида func(user_id), которые обслуживаются из кэша профиля
+CACHED_READS = {
+    'get_user_timezone',
+    'get_reminder_time',
+    'get_days_count',
+    'get_first_use_date',
+    'get_user_stats',
+    'is_pill_taken_today',
+}
+# Зависят от текущей даты пользователя: дата входит в ключ, чтобы значение не пережило его полночь
+_DAILY_READS = {'is_pill_taken_today'}
+
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+def _wrap_cached(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(user_id: int):
+        field = (name, await get_user_today(user_id)) if name in _DAILY_READS else name
+        value = user_cache.get(user_id, field)
+        if value is user_cache.MISSING:
+            generation = user_cache.generation()
+            value = await run(func, user_id)
+            user_cache.put(user_id, field, value, generation)
+        return value
+    return wrapper
+
+
+async def get_user_today(user_id: int) -> str:
+    """Текущая дата пользователя в его часовом поясе (часовой пояс — из кэша профиля)"""
+    return local_time.local_today(await _facade('get_user_timezone')(user_id))
+
+
+async def set_reminder_time(user_id: int, time: str, timezone: str = 'Europe/Moscow', username: str = None):
+    """Устанавливает время напоминания и сразу кладет новые значения в кэш"""
+    await run(database.set_reminder_time, user_id, time, timezone, username)
+    user_cache.invalidate(user_id)
+    user_cache.put(user_id, 'get_reminder_time', time)
+    user_cache.put(user_id, 'get_user_timezone', timezone)
+
+
+async def set_user_timezone(user_id: int, timezone: str, username: str = None):
+    """Устанавливает часовой пояс и сразу кладет его в кэш"""
+    await run(database.set_user_timezone, user_id, timezone, username)
+    user_cache.invalidate(user_id)
+    user_cache.put(user_id, 'get_user_timezone', timezone)
+
+
+async def mark_pill_taken(user_id: int, date_str: str):
+    """Отмечает таблеточку и сбрасывает профиль (отметка и счетчики дней изменились)"""
+    await run(database.mark_pill_taken, user_id, date_str)
+    user_cache.invalidate(user_id)
+
+
+async def clear_pill_taken_today(user_id: int):
+    """Снимает отметку на сегодня и сбрасывает профиль"""
+    await run(database.clear_pill_taken_today, user_id)
+    user_cache.invalidate(user_id)
+
+
+async def log_interaction(user_id: int, interaction_type: str, interaction_data: str = None, username: str = None):
+    """Логирует взаимодействие (только кладет событие в буфер, без похода в пул)"""
+    database.log_interaction(user_id, interaction_type, interaction_data, username)
+
+
+def _facade(name: str):
+    if name.startswith('_'):
+        raise AttributeError(name)
+    func = getattr(database, name)
+    if not callable(func):
+        raise AttributeError(name)
+    if name not in _wrapped:
+        _wrapped[name] = _wrap_cached(func) if name in CACHED_READS else _wrap(func)
+    return _wrapped[name]
+
+
+def __getattr__(name: str):
+    # async_database.<имя> -> асинхронная обертка над database.<имя>
+    return _facade(name)
+
+
+def shutdown():
+    """Дожидается завершения запросов в пуле и останавливает его"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
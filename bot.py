@@ -1,23 +1,33 @@
 """
 Telegram бот для ежедневных напоминаний о таблеточках
 """
+import functools
 import logging
+import os
+import time
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application,
     CommandHandler,
-    CallbackQueryHandler,
     ContextTypes,
-    ConversationHandler,
     MessageHandler,
     filters
 )
-from datetime import time as dt_time, datetime, timedelta
+from datetime import datetime
 import pytz
 
+import async_database
 import config
 import database
+import export_jobs
+import memo_delivery
+import metrics
+import user_cache
+from callback_router import CallbackRouter
+from reminder_scheduler import ReminderScheduler
+from send_queue import SendQueue
+from update_processor import PerUserUpdateProcessor
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,9 +40,6 @@ logger = logging.getLogger(__name__)
 logging.getLogger('apscheduler').setLevel(logging.WARNING)
 logging.getLogger('apscheduler.scheduler').setLevel(logging.WARNING)
 
-# Состояния для ConversationHandler
-SELECTING_TIME, CONFIRMING_TIME = range(2)
-
 MEMO_BUTTON_TEXT = "💗 Получить памяточку по носику"
 
 # Создаем постоянную клавиатуру с кнопками меню
@@ -45,12 +52,53 @@ def get_main_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, is_persistent=True)
 
+# Кнопки выбора времени: (callback_data без префикса time_, подпись)
+TIME_CHOICES = [
+    ("08:00", "🌅 Утро (8:00)"),
+    ("09:00", "🌞 Утро (9:00)"),
+    ("10:00", "☀️ Утро (10:00)"),
+    ("12:00", "🌤️ Обед (12:00)"),
+    ("13:00", "🍽️ Обед (13:00)"),
+    ("14:00", "☕ День (14:00)"),
+    ("18:00", "🌆 Вечер (18:00)"),
+    ("19:00", "🌇 Вечер (19:00)"),
+    ("20:00", "🌃 Вечер (20:00)"),
+    ("21:00", "🌙 Вечер (21:00)"),
+    ("Другое", "⏰ Выбрать другое время")
+]
+
+def get_time_keyboard():
+    """Inline-клавиатура выбора времени (по 2 кнопки в ряд) с кнопкой «Настройки»"""
+    keyboard = []
+    for i in range(0, len(TIME_CHOICES), 2):
+        keyboard.append([
+            InlineKeyboardButton(label, callback_data=f"time_{value}")
+            for value, label in TIME_CHOICES[i:i + 2]
+        ])
+    keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_time_set_keyboard():
+    """Клавиатура после установки времени"""
+    keyboard = [
+        [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
+        [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
+        [InlineKeyboardButton("ℹ️ Информация", callback_data="info_btn")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Часовые пояса для кнопок city_<код>: (часовой пояс, название)
+CITIES = {
+    'spb': ('Europe/Moscow', "Санкт-Петербург (UTC+3)"),
+    'ufa': ('Asia/Yekaterinburg', "Уфа (UTC+5)"),
+}
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     logger.info(f"Start command received from user {update.effective_user.id}")
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
-    database.log_interaction(user_id, "start_command", None, username)
+    await async_database.log_interaction(user_id, "start_command", None, username)
     
     welcome_message = (
         "💊 Привет, малыш! 👋\n\n"
@@ -58,36 +106,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "чтоб ты выпила таблеточку и чувствовала себя хорошо. 💕\n\n"
         "Выбери время, когда тебе удобно получать напоминания: ⏰"
     )
-    
-    # Создаем клавиатуру с кнопками выбора времени
-    keyboard = []
-    times = [
-        ("08:00", "🌅 Утро (8:00)"),
-        ("09:00", "🌞 Утро (9:00)"),
-        ("10:00", "☀️ Утро (10:00)"),
-        ("12:00", "🌤️ Обед (12:00)"),
-        ("13:00", "🍽️ Обед (13:00)"),
-        ("14:00", "☕ День (14:00)"),
-        ("18:00", "🌆 Вечер (18:00)"),
-        ("19:00", "🌇 Вечер (19:00)"),
-        ("20:00", "🌃 Вечер (20:00)"),
-        ("21:00", "🌙 Вечер (21:00)"),
-        ("Другое", "⏰ Выбрать другое время")
-    ]
-    
-    # Разбиваем кнопки на ряды по 2
-    for i in range(0, len(times), 2):
-        row = []
-        row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-        if i + 1 < len(times):
-            row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-        keyboard.append(row)
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Добавляем кнопку "Настройки" в конец клавиатуры
-    keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_time_keyboard()
     
     try:
         await update.message.reply_text(
@@ -109,338 +128,169 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Используй кнопки ниже для навигации:", reply_markup=get_main_keyboard())
         except Exception as e2:
             logger.error(f"Error sending start message (second attempt) to user {user_id}: {e2}", exc_info=True)
-    
-    return SELECTING_TIME
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на inline кнопки"""
+# --- Inline-кнопки (маршруты CallbackRouter, на query уже ответил роутер) ---
+
+async def edit_or_reply(query, text: str, reply_markup=None):
+    """Редактирует сообщение с кнопкой, а если не вышло — отправляет новое"""
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        await query.message.reply_text(text, reply_markup=reply_markup)
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки back_to_main и main_menu"""
+    # Сбрасываем флаг ожидания пользовательского времени
+    context.user_data['waiting_for_custom_time'] = False
+    await edit_or_reply(
+        update.callback_query,
+        "💊 Главное меню 💕\n\n"
+        "Выбери время, когда тебе удобно получать напоминания: ⏰",
+        get_time_keyboard()
+    )
+
+async def show_time_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «Изменить время»"""
+    await edit_or_reply(
+        update.callback_query,
+        "💊 Выбери время, когда тебе удобно получать напоминания: ⏰",
+        get_time_keyboard()
+    )
+
+async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Меню настроек"""
+    query = update.callback_query
+    username = query.from_user.username or query.from_user.first_name
+    await async_database.log_interaction(query.from_user.id, "settings_opened", None, username)
+    keyboard = [
+        [InlineKeyboardButton("🧪 Тест", callback_data="test_notification")],
+        [InlineKeyboardButton("🌍 Выбор города", callback_data="select_city")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
+    ]
+    await edit_or_reply(query, "⚙️ Настройки:\n\nВыбери действие:", InlineKeyboardMarkup(keyboard))
+
+async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Экран «Информация»"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    data = query.data
-    
-    if data == "settings":
-        # Логируем взаимодействие
-        username = query.from_user.username or query.from_user.first_name
-        database.log_interaction(query.from_user.id, "settings_opened", None, username)
-        # Показываем меню настроек
-        keyboard = [
-            [InlineKeyboardButton("🧪 Тест", callback_data="test_notification")],
-            [InlineKeyboardButton("🌍 Выбор города", callback_data="select_city")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "⚙️ Настройки:\n\n"
-            "Выбери действие:",
-            reply_markup=reply_markup
-        )
-        return SELECTING_TIME
-    
-    if data == "test_notification":
-        # Логируем взаимодействие
-        username = query.from_user.username or query.from_user.first_name
-        database.log_interaction(query.from_user.id, "test_notification", None, username)
-        # Отправляем тестовое уведомление
-        reminder_message = (
-            "💊 Выпей таблеточку, малыш. Люблю тебя, хорошего дня! 💕"
-        )
-        keyboard = [
-            [InlineKeyboardButton("💖 Я уже выпила таблеточку, любимый", callback_data="pill_taken")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            reminder_message,
-            reply_markup=reply_markup
-        )
-        return SELECTING_TIME
-    
-    if data == "select_city":
-        # Показываем выбор города
-        keyboard = [
-            [InlineKeyboardButton("🏙️ Санкт-Петербург (UTC+3)", callback_data="city_spb")],
-            [InlineKeyboardButton("🏔️ Уфа (UTC+5)", callback_data="city_ufa")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "🌍 Выбери город для установки часового пояса:",
-            reply_markup=reply_markup
-        )
-        return SELECTING_TIME
-    
-    if data == "city_spb":
-        # Устанавливаем часовой пояс для Санкт-Петербурга (UTC+3, MSK)
-        timezone = 'Europe/Moscow'
-        city_name = "Санкт-Петербург (UTC+3)"
-        username = query.from_user.username or query.from_user.first_name
-        database.set_user_timezone(user_id, timezone, username)
-        database.log_interaction(user_id, "timezone_changed", f"Санкт-Петербург (UTC+3)", username)
-        
-        # Перепланируем напоминание с новым часовым поясом
-        reminder_time = database.get_reminder_time(user_id)
-        if reminder_time:
-            schedule_reminder(user_id, reminder_time, context.application.job_queue, timezone)
-        
-        await query.edit_message_text(
-            f"✅ Часовой пояс изменен на {city_name} 🌍\n\n"
-            f"Напоминания теперь будут приходить согласно этому часовому поясу. 💕"
-        )
-        return ConversationHandler.END
-    
-    if data == "city_ufa":
-        # Устанавливаем часовой пояс для Уфы (UTC+5)
-        timezone = 'Asia/Yekaterinburg'
-        city_name = "Уфа (UTC+5)"
-        username = query.from_user.username or query.from_user.first_name
-        database.set_user_timezone(user_id, timezone, username)
-        database.log_interaction(user_id, "timezone_changed", f"Уфа (UTC+5)", username)
-        
-        # Перепланируем напоминание с новым часовым поясом
-        reminder_time = database.get_reminder_time(user_id)
-        if reminder_time:
-            schedule_reminder(user_id, reminder_time, context.application.job_queue, timezone)
-        
-        await query.edit_message_text(
-            f"✅ Часовой пояс изменен на {city_name} 🌍\n\n"
-            f"Напоминания теперь будут приходить согласно этому часовому поясу. 💕"
-        )
-        return ConversationHandler.END
+    username = query.from_user.username or query.from_user.first_name
+    await async_database.log_interaction(user_id, "info_viewed", None, username)
     
-    if data == "back_to_main" or data == "main_menu":
-        # Возвращаемся к главному меню
-        keyboard = []
-        times = [
-            ("08:00", "🌅 Утро (8:00)"),
-            ("09:00", "🌞 Утро (9:00)"),
-            ("10:00", "☀️ Утро (10:00)"),
-            ("12:00", "🌤️ Обед (12:00)"),
-            ("13:00", "🍽️ Обед (13:00)"),
-            ("14:00", "☕ День (14:00)"),
-            ("18:00", "🌆 Вечер (18:00)"),
-            ("19:00", "🌇 Вечер (19:00)"),
-            ("20:00", "🌃 Вечер (20:00)"),
-            ("21:00", "🌙 Вечер (21:00)"),
-            ("Другое", "⏰ Выбрать другое время")
-        ]
-        for i in range(0, len(times), 2):
-            row = []
-            row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-            if i + 1 < len(times):
-                row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "💊 Привет, малыш! 👋\n\n"
-            "Я сделал тебе бота, который будет напоминать, "
-            "чтоб ты выпила таблеточку и чувствовала себя хорошо. 💕\n\n"
-            "Выбери время, когда тебе удобно получать напоминания: ⏰",
-            reply_markup=reply_markup
-        )
-        return SELECTING_TIME
-    
-    if data == "change_time_btn":
-        # Переход к выбору времени
-        keyboard = []
-        times = [
-            ("08:00", "🌅 Утро (8:00)"),
-            ("09:00", "🌞 Утро (9:00)"),
-            ("10:00", "☀️ Утро (10:00)"),
-            ("12:00", "🌤️ Обед (12:00)"),
-            ("13:00", "🍽️ Обед (13:00)"),
-            ("14:00", "☕ День (14:00)"),
-            ("18:00", "🌆 Вечер (18:00)"),
-            ("19:00", "🌇 Вечер (19:00)"),
-            ("20:00", "🌃 Вечер (20:00)"),
-            ("21:00", "🌙 Вечер (21:00)"),
-            ("Другое", "⏰ Выбрать другое время")
-        ]
-        for i in range(0, len(times), 2):
-            row = []
-            row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-            if i + 1 < len(times):
-                row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "⏰ Выбери новое время для напоминаний:",
-            reply_markup=reply_markup
-        )
-        return SELECTING_TIME
+    info_message = await build_info_message(user_id)
+    keyboard = [
+        [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
+    ]
+    await edit_or_reply(query, info_message, InlineKeyboardMarkup(keyboard))
+
+async def send_test_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Тестовое уведомление из настроек"""
+    query = update.callback_query
+    username = query.from_user.username or query.from_user.first_name
+    await async_database.log_interaction(query.from_user.id, "test_notification", None, username)
+    keyboard = [
+        [InlineKeyboardButton("💖 Я уже выпила таблеточку, любимый", callback_data="pill_taken")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
+    ]
+    await edit_or_reply(query, REMINDER_MESSAGE, InlineKeyboardMarkup(keyboard))
+
+async def show_city_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор города"""
+    keyboard = [
+        [InlineKeyboardButton("🏙️ Санкт-Петербург (UTC+3)", callback_data="city_spb")],
+        [InlineKeyboardButton("🏔️ Уфа (UTC+5)", callback_data="city_ufa")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
+    ]
+    await edit_or_reply(update.callback_query, "🌍 Выбери город для установки часового пояса:", InlineKeyboardMarkup(keyboard))
+
+async def select_city(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
+    """Кнопки city_<код>: установка часового пояса"""
+    if city not in CITIES:
+        return
+    query = update.callback_query
+    user_id = query.from_user.id
+    timezone, city_name = CITIES[city]
     
-    if data == "info_btn":
-        # Логируем взаимодействие
-        username = query.from_user.username or query.from_user.first_name
-        database.log_interaction(query.from_user.id, "info_viewed", None, username)
-        # Показываем информацию
-        user_id = query.from_user.id
-        days_count = database.get_days_count(user_id)
-        first_date = database.get_first_use_date(user_id)
-        reminder_time = database.get_reminder_time(user_id)
-        
-        info_message = (
-            f"ℹ️ Информация о твоем использовании бота:\n\n"
-            f"📊 Количество дней, когда ты пила таблеточку с помощью бота: {days_count} дней\n\n"
-        )
-        
-        if first_date:
-            from datetime import datetime
-            try:
-                first_dt = datetime.fromisoformat(first_date)
-                days_since_first = (datetime.now().date() - first_dt.date()).days + 1
-                info_message += f"📅 Первое использование: {first_dt.strftime('%d.%m.%Y')}\n"
-                info_message += f"⏱️ Всего дней с ботом: {days_since_first} дней\n\n"
-            except:
-                pass
-        
-        if reminder_time:
-            timezone = database.get_user_timezone(user_id)
-            info_message += f"⏰ Время напоминания: {reminder_time}\n"
-            info_message += f"🌍 Часовой пояс: {timezone}\n"
-        else:
-            info_message += "⏰ Время напоминания: не установлено\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await query.edit_message_text(
-                info_message,
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Error editing message for info: {e}")
-            # Если не удалось отредактировать, отправляем новое сообщение
-            await query.message.reply_text(
-                info_message,
-                reply_markup=reply_markup
-            )
-        return SELECTING_TIME
+    username = query.from_user.username or query.from_user.first_name
+    await async_database.set_user_timezone(user_id, timezone, username)
+    await async_database.log_interaction(user_id, "timezone_changed", city_name, username)
     
-    if data.startswith("time_"):
-        time_str = data[5:]  # Убираем префикс "time_"
-        
-        if time_str == "Другое":
-            keyboard = [
-                [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "💭 Напиши время в формате ЧЧ:ММ (например, 15:30 или 09:15):",
-                reply_markup=reply_markup
-            )
-            return CONFIRMING_TIME
-        else:
-            # Проверяем формат времени
-            try:
-                hour, minute = map(int, time_str.split(':'))
-                if 0 <= hour < 24 and 0 <= minute < 60:
-                    timezone = database.get_user_timezone(user_id)
-                    username = query.from_user.username or query.from_user.first_name
-                    # При смене времени очищаем отметку о выпитой таблеточке сегодня
-                    database.clear_pill_taken_today(user_id)
-                    database.set_reminder_time(user_id, time_str, timezone, username)
-                    database.log_interaction(user_id, "reminder_time_changed", time_str, username)
-                    logger.info(f"User {user_id} selected time {time_str} in timezone {timezone}")
-                    schedule_reminder(user_id, time_str, context.application.job_queue, timezone)
-                    
-                    keyboard = [
-                        [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
-                        [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
-                        [InlineKeyboardButton("ℹ️ Информация", callback_data="info_btn")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await query.edit_message_text(
-                        f"✅ Отлично, малыш! 💕\n\n"
-                        f"Я буду напоминать тебе каждый день в {time_str} ⏰\n\n"
-                        f"Не забудь выпить таблеточку! 💊",
-                        reply_markup=reply_markup
-                    )
-                    # Возвращаем ConversationHandler.END, но кнопки будут работать через отдельный обработчик
-                    return ConversationHandler.END
-                else:
-                    keyboard = [
-                        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await query.edit_message_text(
-                        "❌ Время указано неверно. Попробуй еще раз:",
-                        reply_markup=reply_markup
-                    )
-                    return CONFIRMING_TIME
-            except ValueError:
-                keyboard = [
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(
-                    "❌ Неверный формат времени. Напиши время в формате ЧЧ:ММ (например, 15:30):",
-                    reply_markup=reply_markup
-                )
-                return CONFIRMING_TIME
+    # Перепланируем напоминание с новым часовым поясом
+    reminder_time = await async_database.get_reminder_time(user_id)
+    if reminder_time:
+        schedule_reminder(user_id, reminder_time, context.application.job_queue, timezone)
     
-    return SELECTING_TIME
+    await edit_or_reply(
+        query,
+        f"✅ Часовой пояс изменен на {city_name} 🌍\n\n"
+        f"Напоминания теперь будут приходить согласно этому часовому поясу. 💕"
+    )
+    logger.info(f"Timezone changed to {city_name} for user {user_id}")
 
-async def handle_custom_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик пользовательского времени"""
-    user_id = update.effective_user.id
-    time_str = update.message.text.strip()
+async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str: str):
+    """Кнопки time_<ЧЧ:ММ> и time_Другое"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+    
+    if time_str == "Другое":
+        # Следующее текстовое сообщение примет handle_custom_time_global
+        context.user_data['waiting_for_custom_time'] = True
+        logger.info(f"Set waiting_for_custom_time=True for user {user_id}")
+        await edit_or_reply(query, "💭 Напиши время в формате ЧЧ:ММ (например, 15:30 или 09:15):", back_markup)
+        return
     
-    # Проверяем формат времени
     try:
         hour, minute = map(int, time_str.split(':'))
-        if 0 <= hour < 24 and 0 <= minute < 60:
-            time_formatted = f"{hour:02d}:{minute:02d}"
-            timezone = database.get_user_timezone(user_id)
-            # При смене времени очищаем отметку о выпитой таблеточке сегодня
-            database.clear_pill_taken_today(user_id)
-            username = update.effective_user.username or update.effective_user.first_name
-            database.set_reminder_time(user_id, time_formatted, timezone, username)
-            database.log_interaction(user_id, "reminder_time_changed", time_formatted, username)
-            logger.info(f"User {user_id} entered custom time {time_formatted} in timezone {timezone}")
-            schedule_reminder(user_id, time_formatted, context.application.job_queue, timezone)
-            
-            keyboard = [
-                [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
-                [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
-                [InlineKeyboardButton("ℹ️ Информация", callback_data="info_btn")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                f"✅ Отлично, малыш! 💕\n\n"
-                f"Я буду напоминать тебе каждый день в {time_formatted} ⏰\n\n"
-                f"Не забудь выпить таблеточку! 💊",
-                reply_markup=reply_markup
-            )
-            # Возвращаем ConversationHandler.END, но кнопки будут работать через отдельный обработчик
-            return ConversationHandler.END
-        else:
-            await update.message.reply_text(
-                "❌ Время указано неверно. Укажи часы от 0 до 23 и минуты от 0 до 59.\n"
-                "Попробуй еще раз (формат ЧЧ:ММ):"
-            )
-            return CONFIRMING_TIME
-    except ValueError:
-        await update.message.reply_text(
-            "❌ Неверный формат времени. Напиши время в формате ЧЧ:ММ (например, 15:30):"
-        )
-        return CONFIRMING_TIME
+    except ValueError as e:
+        logger.error(f"Error parsing time {time_str}: {e}")
+        await edit_or_reply(query, "❌ Неверный формат времени. Попробуй еще раз.", back_markup)
+        return
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        await edit_or_reply(query, "❌ Время указано неверно. Попробуй еще раз:", back_markup)
+        return
+    
+    timezone = await async_database.get_user_timezone(user_id)
+    username = query.from_user.username or query.from_user.first_name
+    # При смене времени очищаем отметку о выпитой таблеточке сегодня
+    await async_database.clear_pill_taken_today(user_id)
+    await async_database.set_reminder_time(user_id, time_str, timezone, username)
+    await async_database.log_interaction(user_id, "reminder_time_changed", time_str, username)
+    logger.info(f"User {user_id} selected time {time_str} in timezone {timezone}")
+    schedule_reminder(user_id, time_str, context.application.job_queue, timezone)
+    
+    await edit_or_reply(
+        query,
+        f"✅ Отлично, малыш! 💕\n\n"
+        f"Я буду напоминать тебе каждый день в {time_str} ⏰\n\n"
+        f"Не забудь выпить таблеточку! 💊",
+        get_time_set_keyboard()
+    )
 
-async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик кнопки 'Информация'"""
-    user_id = update.effective_user.id
-    username = update.effective_user.username or update.effective_user.first_name
-    database.log_interaction(user_id, "info_viewed", None, username)
+async def pill_taken(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «Я уже выпила таблеточку»"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Дата — по часовому поясу пользователя, как и его напоминания
+    today = await async_database.get_user_today(user_id)
+    username = query.from_user.username or query.from_user.first_name
+    await async_database.mark_pill_taken(user_id, today)
+    await async_database.log_interaction(user_id, "pill_taken", today, username)
     
-    days_count = database.get_days_count(user_id)
-    first_date = database.get_first_use_date(user_id)
-    reminder_time = database.get_reminder_time(user_id)
+    keyboard = [
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
+    ]
+    await query.edit_message_text(
+        "💕 Отлично, малыш! Горжусь тобой! Сегодня напоминание больше не придет. 😊💖",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def build_info_message(user_id: int) -> str:
+    """Текст экрана «Информация» (счетчики читаются одной строкой user_stats)"""
+    days_count, first_date, last_taken, current_streak, longest_streak = await async_database.get_user_stats(user_id)
+    reminder_time = await async_database.get_reminder_time(user_id)
+    today = datetime.fromisoformat(await async_database.get_user_today(user_id)).date()
     
     info_message = (
         f"ℹ️ Информация о твоем использовании бота:\n\n"
@@ -448,21 +298,35 @@ async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     if first_date:
-        from datetime import datetime
         try:
             first_dt = datetime.fromisoformat(first_date)
-            days_since_first = (datetime.now().date() - first_dt.date()).days + 1
+            days_since_first = (today - first_dt.date()).days + 1
             info_message += f"📅 Первое использование: {first_dt.strftime('%d.%m.%Y')}\n"
             info_message += f"⏱️ Всего дней с ботом: {days_since_first} дней\n\n"
         except:
             pass
     
+    # Серия прерывается, если вчера таблеточка не отмечена
+    if last_taken and (today - datetime.fromisoformat(last_taken).date()).days > 1:
+        current_streak = 0
+    if longest_streak:
+        info_message += f"🔥 Дней подряд: {current_streak} (рекорд: {longest_streak})\n\n"
+    
     if reminder_time:
-        timezone = database.get_user_timezone(user_id)
+        timezone = await async_database.get_user_timezone(user_id)
         info_message += f"⏰ Время напоминания: {reminder_time}\n"
         info_message += f"🌍 Часовой пояс: {timezone}\n"
     else:
         info_message += "⏰ Время напоминания: не установлено\n"
+    return info_message
+
+async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопки 'Информация'"""
+    user_id = update.effective_user.id
+    username = update.effective_user.username or update.effective_user.first_name
+    await async_database.log_interaction(user_id, "info_viewed", None, username)
+    
+    info_message = await build_info_message(user_id)
     
     keyboard = [
         [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
@@ -477,44 +341,16 @@ async def info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def change_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /mur_time или кнопки 'Изменить время'"""
-    keyboard = []
-    times = [
-        ("08:00", "🌅 Утро (8:00)"),
-        ("09:00", "🌞 Утро (9:00)"),
-        ("10:00", "☀️ Утро (10:00)"),
-        ("12:00", "🌤️ Обед (12:00)"),
-        ("13:00", "🍽️ Обед (13:00)"),
-        ("14:00", "☕ День (14:00)"),
-        ("18:00", "🌆 Вечер (18:00)"),
-        ("19:00", "🌇 Вечер (19:00)"),
-        ("20:00", "🌃 Вечер (20:00)"),
-        ("21:00", "🌙 Вечер (21:00)"),
-        ("Другое", "⏰ Выбрать другое время")
-    ]
-    
-    for i in range(0, len(times), 2):
-        row = []
-        row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-        if i + 1 < len(times):
-            row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-        keyboard.append(row)
-    
-    # Добавляем кнопку "Настройки" в конец клавиатуры
-    keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "⏰ Выбери новое время для напоминаний:",
-        reply_markup=reply_markup
+        reply_markup=get_time_keyboard()
     )
-    
-    return SELECTING_TIME
 
 async def settings_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Настройки'"""
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
-    database.log_interaction(user_id, "settings_opened", None, username)
+    await async_database.log_interaction(user_id, "settings_opened", None, username)
     
     keyboard = [
         [InlineKeyboardButton("🧪 Тест", callback_data="test_notification")],
@@ -531,146 +367,131 @@ async def settings_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена операции"""
+    context.user_data['waiting_for_custom_time'] = False
     await update.message.reply_text(
         "Окей, можем выбрать время позже 😊\n"
         "Используй /start чтобы начать заново.",
         reply_markup=get_main_keyboard()
     )
-    return ConversationHandler.END
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Отправка напоминания пользователю"""
-    user_id = context.job.data
-    
-    # Проверяем, не выпила ли уже таблеточку сегодня
-    if database.is_pill_taken_today(user_id):
-        logger.info(f"User {user_id} already took pill today, skipping reminder")
-        return
-    
-    reminder_message = (
-        "💊 Выпей таблеточку, малыш. Люблю тебя, хорошего дня! 💕"
-    )
-    
-    # Создаем клавиатуру с кнопкой "Я уже выпила таблеточку"
+REMINDER_MESSAGE = "💊 Выпей таблеточку, малыш. Люблю тебя, хорошего дня! 💕"
+
+def get_reminder_keyboard():
+    """Клавиатура напоминания с кнопкой «Я уже выпила таблеточку»"""
     keyboard = [
         [InlineKeyboardButton("💖 Я уже выпила таблеточку, любимый", callback_data="pill_taken")],
         [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+# Все отправки напоминаний и памяточек идут через общую очередь с лимитами Telegram
+send_queue = SendQueue(
+    rate=config.SEND_RATE_PER_SECOND,
+    per_chat_rate=config.SEND_PER_CHAT_RATE,
+    workers=config.SEND_WORKERS,
+    max_retries=config.SEND_MAX_RETRIES
+)
+
+async def send_reminder(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Отправка напоминания пользователю"""
+    await dispatch_reminders(context, [user_id])
+
+async def _send_reminder_message(bot, user_id: int, reply_markup, fire_utc: int = None):
+    """Одно напоминание; задержка пишется, когда Telegram принял сообщение"""
+    message = await bot.send_message(chat_id=user_id, text=REMINDER_MESSAGE, reply_markup=reply_markup)
+    if fire_utc is not None:
+        metrics.REMINDER_LAG_SECONDS.observe(max(0.0, time.time() - fire_utc))
+    return message
+
+async def dispatch_reminders(context: ContextTypes.DEFAULT_TYPE, user_ids: list, fire_times: dict = None):
+    """Отправляет напоминания всем пользователям, у которых наступило время.
+
+    fire_times — user_id -> запланированное время срабатывания (для метрики задержки).
+    """
+    # Кто уже выпил таблеточку сегодня — одним запросом на пачку и мимо кэша профилей,
+    # чтобы рассылка не вытесняла из него активных пользователей
+    recipients = await async_database.filter_pill_not_taken_today(list(user_ids))
+    skipped = len(user_ids) - len(recipients)
+    if skipped:
+        logger.info(f"{skipped} users already took pill today, skipping their reminders")
+    if not recipients:
+        return
     
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=reminder_message,
-            reply_markup=reply_markup
-        )
-        logger.info(f"Reminder sent to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error sending reminder to user {user_id}: {e}")
+    reply_markup = get_reminder_keyboard()
+    fire_times = fire_times or {}
+    report = await send_queue.send_batch([
+        (user_id, functools.partial(
+            _send_reminder_message, context.bot, user_id, reply_markup, fire_times.get(user_id)
+        ))
+        for user_id in recipients
+    ])
+    
+    logger.info(f"Reminder batch delivered: {report}")
+    for user_id, error in report.errors.items():
+        logger.error(f"Error sending reminder to user {user_id}: {error}")
+
+# Один планировщик на процесс: очередные срабатывания берутся из reminders.next_fire_utc
+reminder_scheduler = ReminderScheduler(dispatch_reminders)
 
 def schedule_reminder(user_id: int, time_str: str, job_queue, timezone: str = 'Europe/Moscow'):
-    """Планирует ежедневное напоминание"""
+    """Планирует ежедневное напоминание.
+
+    Время следующего срабатывания уже сохранено set_reminder_time / set_user_timezone,
+    здесь только убеждаемся, что ежеминутная задача запущена.
+    """
     if job_queue is None:
         logger.warning(f"JobQueue is not available, cannot schedule reminder for user {user_id}")
         return
     
-    hour, minute = map(int, time_str.split(':'))
-    
-    # Удаляем старую задачу если она существует
-    job_id = f"reminder_{user_id}"
-    # Получаем все задачи и находим нужную по имени
-    jobs = job_queue.jobs()
-    for job in jobs:
-        if job.name == job_id:
-            job.schedule_removal()
-    
-    # Сохраняем параметры для использования в замыкании
-    user_tz_obj = pytz.timezone(timezone)
-    
-    # Создаем обертку, которая планирует следующее напоминание
-    async def reminder_with_reschedule(context: ContextTypes.DEFAULT_TYPE):
-        """Отправляет напоминание и планирует следующее"""
-        logger.info(f"Reminder triggered for user {user_id}")
-        await send_reminder(context)
-        
-        # Планируем следующее напоминание на завтра в то же время
-        # Используем сохраненные значения из замыкания
-        now_user_tz = datetime.now(user_tz_obj)
-        next_time_user_tz = now_user_tz.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=1)
-        next_time_utc = next_time_user_tz.astimezone(pytz.UTC)
-        delay = (next_time_utc - datetime.now(pytz.UTC)).total_seconds()
-        
-        logger.info(f"Rescheduling reminder for user {user_id}: next_time_utc={next_time_utc}, delay={delay} seconds")
-        
-        if delay > 0:
-            job_queue.run_once(
-                reminder_with_reschedule,
-                when=delay,
-                data=user_id,
-                name=job_id
-            )
-            logger.info(f"Next reminder scheduled successfully for user {user_id}")
-        else:
-            logger.warning(f"Cannot reschedule reminder for user {user_id}: delay is {delay} seconds (non-positive)")
-    
-    # Вычисляем время в UTC, которое соответствует нужному времени в часовом поясе пользователя
-    now_user_tz = datetime.now(user_tz_obj)
-    target_time_user_tz = now_user_tz.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    
-    # Если время уже прошло сегодня, планируем на завтра
-    if target_time_user_tz <= now_user_tz:
-        target_time_user_tz += timedelta(days=1)
-    
-    # Конвертируем в UTC для планирования
-    target_time_utc = target_time_user_tz.astimezone(pytz.UTC)
-    
-    # Вычисляем задержку до первого запуска
-    delay = (target_time_utc - datetime.now(pytz.UTC)).total_seconds()
-    
-    logger.info(f"Scheduling reminder for user {user_id}: time={time_str}, timezone={timezone}, "
-                f"target_time_utc={target_time_utc}, delay={delay} seconds")
-    
-    if delay > 0:
-        job_queue.run_once(
-            reminder_with_reschedule,
-            when=delay,
-            data=user_id,
-            name=job_id
-        )
-        logger.info(f"Reminder scheduled successfully for user {user_id} with delay {delay} seconds")
-    else:
-        logger.warning(f"Cannot schedule reminder for user {user_id}: delay is {delay} seconds (non-positive)")
-    
+    reminder_scheduler.start(job_queue)
     logger.info(f"Scheduled reminder for user {user_id} at {time_str} ({timezone})")
 
+async def catch_up_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Досылает пропущенные за время простоя напоминания пачками по очереди.
+
+    job.data — [(user_id, запланированное время срабатывания)] из claim_missed_reminders.
+    """
+    missed = context.job.data
+    batch_size = max(1, config.CATCHUP_BATCH_SIZE)
+    for i in range(0, len(missed), batch_size):
+        batch = missed[i:i + batch_size]
+        await dispatch_reminders(context, [user_id for user_id, _ in batch], dict(batch))
+    logger.info(f"Catch-up finished for {len(missed)} missed reminders")
+
 def load_existing_reminders(job_queue):
-    """Загружает существующие напоминания из базы данных при запуске"""
+    """Запускает планировщик напоминаний при старте"""
     if job_queue is None:
         logger.warning("JobQueue is not available, skipping reminder loading")
         return
     
-    users = database.get_all_users_with_reminders()
-    for user_data in users:
-        if len(user_data) >= 3:
-            user_id, reminder_time, timezone = user_data[0], user_data[1], user_data[2]
-        elif len(user_data) == 2:
-            # Совместимость со старыми данными
-            user_id, reminder_time = user_data[0], user_data[1]
-            timezone = 'Europe/Moscow'
-            # Обновляем запись, добавляя часовой пояс
-            database.set_reminder_time(user_id, reminder_time, timezone)
-        else:
-            continue
-        schedule_reminder(user_id, reminder_time, job_queue, timezone)
-    logger.info(f"Loaded {len(users)} existing reminders")
-
-def main():
-    """Главная функция для запуска бота"""
+    # Напоминания, пропущенные пока бот был выключен: недавние досылаем, более старые переносим
+    now_utc = int(datetime.now(pytz.UTC).timestamp())
+    since_utc = now_utc - config.CATCHUP_WINDOW_MINUTES * 60
+    missed = database.claim_missed_reminders(since_utc, now_utc)
+    skipped = database.roll_forward_reminders(now_utc)
+    if skipped:
+        logger.info(f"Skipped {skipped} reminders that were due before the catch-up window")
+    if missed:
+        logger.info(f"{len(missed)} reminders were missed during downtime, scheduling catch-up")
+        # Небольшая пауза: сначала обработаются накопившиеся нажатия «Я уже выпила таблеточку»
+        job_queue.run_once(catch_up_reminders, when=5, data=missed, name='reminder_catch_up')
+    
+    reminder_scheduler.start(job_queue)
+    logger.info("Reminder scheduler is running")
+
+def build_application() -> Application:
+    """Создает Application со всеми обработчиками (без запуска: polling или webhook выбирает вызывающий)"""
     # Инициализация базы данных
     database.init_database()
     
     # Создание приложения
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .request(metrics.TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(config.CONCURRENT_UPDATES))
+        .build()
+    )
 
     def is_admin(user_id: int) -> bool:
         return user_id in getattr(config, 'ADMIN_USER_IDS', set())
@@ -684,10 +505,11 @@ def main():
             return
 
         file_id = update.message.voice.file_id
-        memo_id = database.add_voice_memo(file_id)
+        memo_id = await async_database.add_voice_memo(file_id)
+        memo_delivery.invalidate()
 
         username = update.effective_user.username or update.effective_user.first_name
-        database.log_interaction(user_id, "voice_memo_added", str(memo_id), username)
+        await async_database.log_interaction(user_id, "voice_memo_added", str(memo_id), username)
 
         await update.message.reply_text(
             f"✅ Памяточка сохранена (id={memo_id}).\n"
@@ -699,92 +521,56 @@ def main():
         user_id = update.effective_user.id
         username = update.effective_user.username or update.effective_user.first_name
 
+        last_memo_id, taken_today = await async_database.get_voice_memo_state(user_id)
+
         # Лимит: 1 памяточка в день (кроме админа)
-        if not is_admin(user_id) and database.is_voice_memo_taken_today(user_id):
-            database.log_interaction(user_id, "voice_memo_rate_limited", None, username)
+        if not is_admin(user_id) and taken_today:
+            await async_database.log_interaction(user_id, "voice_memo_rate_limited", None, username)
             await update.message.reply_text(
                 "Ты сегодня уже получила памяточку по носику. Попробуй завтра, милая 💗"
             )
             return
 
-        memo = database.get_next_voice_memo_for_user(user_id)
+        memo = await memo_delivery.next_memo(last_memo_id)
         if not memo:
-            total, delivered, remaining = database.get_voice_memo_stats_for_user(user_id)
-            database.log_interaction(user_id, "voice_memo_empty", f"total={total};delivered={delivered}", username)
+            total, delivered, remaining = await async_database.get_voice_memo_stats_for_user(user_id)
+            await async_database.log_interaction(user_id, "voice_memo_empty", f"total={total};delivered={delivered}", username)
             await update.message.reply_text(
                 "😿 Памяточек по носику нет.\n"
                 "Если я добавлю новые — кнопка снова начнет выдавать их по одной."
             )
             return
 
-        memo_id, file_id, created_at = memo
-
-        await context.bot.send_voice(chat_id=user_id, voice=file_id)
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Сладких котят, милая. Я очень сильно тебя люблю!"
-        )
-
-        database.mark_voice_memo_delivered(user_id, memo_id)
-        if not is_admin(user_id):
-            database.mark_voice_memo_taken_today(user_id)
-        database.log_interaction(user_id, "voice_memo_delivered", str(memo_id), username)
+        await memo_delivery.deliver(context.bot, send_queue, user_id, memo, count_daily=not is_admin(user_id))
+        await async_database.log_interaction(user_id, "voice_memo_delivered", str(memo[0]), username)
 
     # Ловим voice от админа (загрузка памяток)
     application.add_handler(MessageHandler(filters.VOICE, admin_voice_upload_handler), group=0)
     
-    # Обработчики для постоянных кнопок меню (добавляем ПЕРЕД ConversationHandler)
+    # Обработчики для постоянных кнопок меню
     async def button_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых кнопок меню"""
         text = update.message.text
         
         if text == "⏰ Изменить время":
-            return await change_time(update, context)
+            await change_time(update, context)
         elif text == "⚙️ Настройки":
             await settings_handler(update, context)
-            # Возвращаем ConversationHandler.END чтобы завершить текущий диалог
-            return ConversationHandler.END
         elif text == "ℹ️ Информация":
             await info_handler(update, context)
-            # Возвращаем ConversationHandler.END чтобы завершить текущий диалог
-            return ConversationHandler.END
         elif text == MEMO_BUTTON_TEXT:
             await send_next_voice_memo_handler(update, context)
-            return ConversationHandler.END
         elif text == "🏠 Главное меню":
             # Возвращаемся к главному меню
-            keyboard = []
-            times = [
-                ("08:00", "🌅 Утро (8:00)"),
-                ("09:00", "🌞 Утро (9:00)"),
-                ("10:00", "☀️ Утро (10:00)"),
-                ("12:00", "🌤️ Обед (12:00)"),
-                ("13:00", "🍽️ Обед (13:00)"),
-                ("14:00", "☕ День (14:00)"),
-                ("18:00", "🌆 Вечер (18:00)"),
-                ("19:00", "🌇 Вечер (19:00)"),
-                ("20:00", "🌃 Вечер (20:00)"),
-                ("21:00", "🌙 Вечер (21:00)"),
-                ("Другое", "⏰ Выбрать другое время")
-            ]
-            for i in range(0, len(times), 2):
-                row = []
-                row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-                if i + 1 < len(times):
-                    row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-                keyboard.append(row)
-            keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(
                 "💊 Главное меню 💕\n\n"
                 "Выбери время, когда тебе удобно получать напоминания: ⏰",
-                reply_markup=reply_markup
+                reply_markup=get_time_keyboard()
             )
-            return SELECTING_TIME
     
-    # Обработчик для пользовательского времени (работает вне ConversationHandler)
+    # Обработчик для пользовательского времени (после кнопки «Другое»)
     async def handle_custom_time_global(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик пользовательского времени, работающий вне ConversationHandler"""
+        """Обработчик пользовательского времени: срабатывает, пока стоит флаг waiting_for_custom_time"""
         user_id = update.effective_user.id
         text = update.message.text if update.message else None
         logger.info(f"handle_custom_time_global called for user {user_id}, text: {text}, waiting_for_custom_time: {context.user_data.get('waiting_for_custom_time')}")
@@ -804,12 +590,12 @@ def main():
             hour, minute = map(int, time_str.split(':'))
             if 0 <= hour < 24 and 0 <= minute < 60:
                 time_formatted = f"{hour:02d}:{minute:02d}"
-                timezone = database.get_user_timezone(user_id)
+                timezone = await async_database.get_user_timezone(user_id)
                 # При смене времени очищаем отметку о выпитой таблеточке сегодня
-                database.clear_pill_taken_today(user_id)
+                await async_database.clear_pill_taken_today(user_id)
                 username = update.effective_user.username or update.effective_user.first_name
-                database.set_reminder_time(user_id, time_formatted, timezone, username)
-                database.log_interaction(user_id, "reminder_time_changed", time_formatted, username)
+                await async_database.set_reminder_time(user_id, time_formatted, timezone, username)
+                await async_database.log_interaction(user_id, "reminder_time_changed", time_formatted, username)
                 logger.info(f"User {user_id} entered custom time {time_formatted} in timezone {timezone}")
                 schedule_reminder(user_id, time_formatted, context.application.job_queue, timezone)
                 
@@ -843,384 +629,36 @@ def main():
             context.user_data['waiting_for_custom_time'] = False
     
     # Добавляем обработчик для пользовательского времени ПЕРЕД обработчиком постоянных кнопок
-    # Используем group=-1 чтобы он обрабатывался ДО ConversationHandler
+    # Используем group=-1 чтобы он обрабатывался ДО остальных обработчиков
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
         handle_custom_time_global
     ), group=-1)
     
-    # Добавляем обработчик для постоянных кнопок ПЕРЕД ConversationHandler
+    # Добавляем обработчик для постоянных кнопок
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.Regex('^(⏰ Изменить время|⚙️ Настройки|ℹ️ Информация|🏠 Главное меню|🎧 Получить памятку|💗 Получить памяточку по носику)$'),
         button_text_handler
     ), group=1)
     
-    
-    # Создание ConversationHandler для обработки выбора времени
-    conv_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler('start', start),
-            CommandHandler('Start', start),
-            CommandHandler('START', start),
-            CommandHandler('mur', start),
-            CommandHandler('mur_time', change_time),
-            MessageHandler(filters.Regex('^⏰ Изменить время$'), change_time)
-        ],
-        states={
-            SELECTING_TIME: [
-                # Убираем select_city и city_ из паттерна, чтобы они обрабатывались глобальным обработчиком
-                CallbackQueryHandler(button_callback, pattern='^(time_|settings|test_notification|back_to_main|change_time_btn|info_btn|main_menu)')
-            ],
-            CONFIRMING_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_time)]
-        },
-        fallbacks=[CommandHandler('cancel', cancel)]
-    )
-    
-    # Отдельный обработчик для кнопки "Я уже выпила таблеточку" (работает всегда, добавляем ПЕРЕД conv_handler)
-    async def pill_taken_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик кнопки 'Я уже выпила таблеточку'"""
-        query = update.callback_query
-        if query and query.data == "pill_taken":
-            await query.answer()
-            user_id = query.from_user.id
-            from datetime import date
-            today = date.today().isoformat()
-            username = query.from_user.username or query.from_user.first_name
-            database.mark_pill_taken(user_id, today)
-            database.log_interaction(user_id, "pill_taken", today, username)
-            
-            keyboard = [
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "💕 Отлично, малыш! Горжусь тобой! Сегодня напоминание больше не придет. 😊💖",
-                reply_markup=reply_markup
-            )
-    
-    application.add_handler(CallbackQueryHandler(pill_taken_callback, pattern='^pill_taken$'))
-    
-    # Отдельный обработчик для inline кнопок, которые работают всегда (вне ConversationHandler)
-    async def global_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Глобальный обработчик inline кнопок, работающий всегда"""
-        query = update.callback_query
-        if not query:
-            return
-        
-        await query.answer()
-        data = query.data
-        logger.info(f"Global button callback received: {data} from user {query.from_user.id}")
-        
-        # Обрабатываем кнопки, которые должны работать вне ConversationHandler
-        if data == "change_time_btn":
-            # Открываем меню выбора времени
-            keyboard = []
-            times = [
-                ("08:00", "🌅 Утро (8:00)"),
-                ("09:00", "🌞 Утро (9:00)"),
-                ("10:00", "☀️ Утро (10:00)"),
-                ("12:00", "🌤️ Обед (12:00)"),
-                ("13:00", "🍽️ Обед (13:00)"),
-                ("14:00", "☕ День (14:00)"),
-                ("18:00", "🌆 Вечер (18:00)"),
-                ("19:00", "🌇 Вечер (19:00)"),
-                ("20:00", "🌃 Вечер (20:00)"),
-                ("21:00", "🌙 Вечер (21:00)"),
-                ("Другое", "⏰ Выбрать другое время")
-            ]
-            for i in range(0, len(times), 2):
-                row = []
-                row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-                if i + 1 < len(times):
-                    row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-                keyboard.append(row)
-            keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(
-                    "💊 Выбери время, когда тебе удобно получать напоминания: ⏰",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-                await query.message.reply_text(
-                    "💊 Выбери время, когда тебе удобно получать напоминания: ⏰",
-                    reply_markup=reply_markup
-                )
-        elif data == "settings":
-            # Показываем настройки
-            username = query.from_user.username or query.from_user.first_name
-            database.log_interaction(query.from_user.id, "settings_opened", None, username)
-            keyboard = [
-                [InlineKeyboardButton("🧪 Тест", callback_data="test_notification")],
-                [InlineKeyboardButton("🌍 Выбор города", callback_data="select_city")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(
-                    "⚙️ Настройки:\n\n"
-                    "Выбери действие:",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-                await query.message.reply_text(
-                    "⚙️ Настройки:\n\n"
-                    "Выбери действие:",
-                    reply_markup=reply_markup
-                )
-        elif data == "info_btn":
-            # Показываем информацию
-            user_id = query.from_user.id
-            username = query.from_user.username or query.from_user.first_name
-            database.log_interaction(user_id, "info_viewed", None, username)
-            
-            days_count = database.get_days_count(user_id)
-            first_date = database.get_first_use_date(user_id)
-            reminder_time = database.get_reminder_time(user_id)
-            
-            info_message = (
-                f"ℹ️ Информация о твоем использовании бота:\n\n"
-                f"📊 Количество дней, когда ты пила таблеточку с помощью бота: {days_count} дней\n\n"
-            )
-            
-            if first_date:
-                try:
-                    first_dt = datetime.fromisoformat(first_date)
-                    days_since_first = (datetime.now().date() - first_dt.date()).days + 1
-                    info_message += f"📅 Первое использование: {first_dt.strftime('%d.%m.%Y')}\n"
-                    info_message += f"⏱️ Всего дней с ботом: {days_since_first} дней\n\n"
-                except:
-                    pass
-            
-            if reminder_time:
-                timezone = database.get_user_timezone(user_id)
-                info_message += f"⏰ Время напоминания: {reminder_time}\n"
-                info_message += f"🌍 Часовой пояс: {timezone}\n"
-            else:
-                info_message += "⏰ Время напоминания: не установлено\n"
-            
-            keyboard = [
-                [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(
-                    info_message,
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message for info: {e}")
-                await query.message.reply_text(
-                    info_message,
-                    reply_markup=reply_markup
-                )
-        elif data == "back_to_main" or data == "main_menu":
-            # Сбрасываем флаг ожидания пользовательского времени
-            if 'waiting_for_custom_time' in context.user_data:
-                context.user_data['waiting_for_custom_time'] = False
-            # Возвращаемся к главному меню
-            keyboard = []
-            times = [
-                ("08:00", "🌅 Утро (8:00)"),
-                ("09:00", "🌞 Утро (9:00)"),
-                ("10:00", "☀️ Утро (10:00)"),
-                ("12:00", "🌤️ Обед (12:00)"),
-                ("13:00", "🍽️ Обед (13:00)"),
-                ("14:00", "☕ День (14:00)"),
-                ("18:00", "🌆 Вечер (18:00)"),
-                ("19:00", "🌇 Вечер (19:00)"),
-                ("20:00", "🌃 Вечер (20:00)"),
-                ("21:00", "🌙 Вечер (21:00)"),
-                ("Другое", "⏰ Выбрать другое время")
-            ]
-            for i in range(0, len(times), 2):
-                row = []
-                row.append(InlineKeyboardButton(times[i][1], callback_data=f"time_{times[i][0]}"))
-                if i + 1 < len(times):
-                    row.append(InlineKeyboardButton(times[i+1][1], callback_data=f"time_{times[i+1][0]}"))
-                keyboard.append(row)
-            keyboard.append([InlineKeyboardButton("⚙️ Настройки", callback_data="settings")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(
-                    "💊 Главное меню 💕\n\n"
-                    "Выбери время, когда тебе удобно получать напоминания: ⏰",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-                await query.message.reply_text(
-                    "💊 Главное меню 💕\n\n"
-                    "Выбери время, когда тебе удобно получать напоминания: ⏰",
-                    reply_markup=reply_markup
-                )
-        elif data.startswith("time_"):
-            # Обработка выбора времени
-            logger.info(f"Time button pressed: {data} from user {query.from_user.id}")
-            time_str = data[5:]  # Убираем префикс "time_"
-            
-            if time_str == "Другое":
-                # Устанавливаем флаг ожидания пользовательского времени
-                context.user_data['waiting_for_custom_time'] = True
-                logger.info(f"Set waiting_for_custom_time=True for user {query.from_user.id}")
-                keyboard = [
-                    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                try:
-                    await query.edit_message_text(
-                        "💭 Напиши время в формате ЧЧ:ММ (например, 15:30 или 09:15):",
-                        reply_markup=reply_markup
-                    )
-                except Exception as e:
-                    logger.error(f"Error editing message: {e}")
-                    await query.message.reply_text(
-                        "💭 Напиши время в формате ЧЧ:ММ (например, 15:30 или 09:15):",
-                        reply_markup=reply_markup
-                    )
-            else:
-                # Обрабатываем выбранное время
-                try:
-                    hour, minute = map(int, time_str.split(':'))
-                    if 0 <= hour < 24 and 0 <= minute < 60:
-                        user_id = query.from_user.id
-                        timezone = database.get_user_timezone(user_id)
-                        username = query.from_user.username or query.from_user.first_name
-                        # При смене времени очищаем отметку о выпитой таблеточке сегодня
-                        database.clear_pill_taken_today(user_id)
-                        database.set_reminder_time(user_id, time_str, timezone, username)
-                        database.log_interaction(user_id, "reminder_time_changed", time_str, username)
-                        logger.info(f"User {user_id} selected time {time_str} in timezone {timezone}")
-                        schedule_reminder(user_id, time_str, context.application.job_queue, timezone)
-                        
-                        keyboard = [
-                            [InlineKeyboardButton("⏰ Изменить время", callback_data="change_time_btn")],
-                            [InlineKeyboardButton("⚙️ Настройки", callback_data="settings")],
-                            [InlineKeyboardButton("ℹ️ Информация", callback_data="info_btn")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        try:
-                            await query.edit_message_text(
-                                f"✅ Отлично, малыш! 💕\n\n"
-                                f"Я буду напоминать тебе каждый день в {time_str} ⏰\n\n"
-                                f"Не забудь выпить таблеточку! 💊",
-                                reply_markup=reply_markup
-                            )
-                        except Exception as e:
-                            logger.error(f"Error editing message: {e}")
-                            await query.message.reply_text(
-                                f"✅ Отлично, малыш! 💕\n\n"
-                                f"Я буду напоминать тебе каждый день в {time_str} ⏰\n\n"
-                                f"Не забудь выпить таблеточку! 💊",
-                                reply_markup=reply_markup
-                            )
-                    else:
-                        keyboard = [
-                            [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        try:
-                            await query.edit_message_text(
-                                "❌ Время указано неверно. Попробуй еще раз:",
-                                reply_markup=reply_markup
-                            )
-                        except Exception as e:
-                            logger.error(f"Error editing message: {e}")
-                            await query.message.reply_text(
-                                "❌ Время указано неверно. Попробуй еще раз:",
-                                reply_markup=reply_markup
-                            )
-                except ValueError as e:
-                    logger.error(f"Error parsing time {time_str}: {e}")
-                    keyboard = [
-                        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    try:
-                        await query.edit_message_text(
-                            "❌ Неверный формат времени. Попробуй еще раз.",
-                            reply_markup=reply_markup
-                        )
-                    except Exception as e2:
-                        logger.error(f"Error editing message: {e2}")
-                        await query.message.reply_text(
-                            "❌ Неверный формат времени. Попробуй еще раз.",
-                            reply_markup=reply_markup
-                        )
-        elif data == "test_notification":
-            # Тестовое уведомление
-            username = query.from_user.username or query.from_user.first_name
-            database.log_interaction(query.from_user.id, "test_notification", None, username)
-            reminder_message = "💊 Выпей таблеточку, малыш. Люблю тебя, хорошего дня! 💕"
-            keyboard = [
-                [InlineKeyboardButton("💖 Я уже выпила таблеточку, любимый", callback_data="pill_taken")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(reminder_message, reply_markup=reply_markup)
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-                await query.message.reply_text(reminder_message, reply_markup=reply_markup)
-        elif data == "select_city":
-            # Выбор города
-            logger.info(f"select_city button pressed by user {query.from_user.id}")
-            keyboard = [
-                [InlineKeyboardButton("🏙️ Санкт-Петербург (UTC+3)", callback_data="city_spb")],
-                [InlineKeyboardButton("🏔️ Уфа (UTC+5)", callback_data="city_ufa")],
-                [InlineKeyboardButton("⬅️ Назад", callback_data="settings")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(
-                    "🌍 Выбери город для установки часового пояса:",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}", exc_info=True)
-                await query.message.reply_text(
-                    "🌍 Выбери город для установки часового пояса:",
-                    reply_markup=reply_markup
-                )
-        elif data == "city_spb" or data == "city_ufa":
-            # Установка часового пояса
-            logger.info(f"City button pressed: {data} by user {query.from_user.id}")
-            user_id = query.from_user.id
-            if data == "city_spb":
-                timezone = 'Europe/Moscow'
-                city_name = "Санкт-Петербург (UTC+3)"
-            else:
-                timezone = 'Asia/Yekaterinburg'
-                city_name = "Уфа (UTC+5)"
-            
-            username = query.from_user.username or query.from_user.first_name
-            database.set_user_timezone(user_id, timezone, username)
-            database.log_interaction(user_id, "timezone_changed", city_name, username)
-            
-            # Перепланируем напоминание с новым часовым поясом
-            reminder_time = database.get_reminder_time(user_id)
-            if reminder_time:
-                schedule_reminder(user_id, reminder_time, context.application.job_queue, timezone)
-            
-            try:
-                await query.edit_message_text(
-                    f"✅ Часовой пояс изменен на {city_name} 🌍\n\n"
-                    f"Напоминания теперь будут приходить согласно этому часовому поясу. 💕"
-                )
-                logger.info(f"Timezone changed to {city_name} for user {user_id}")
-            except Exception as e:
-                logger.error(f"Error editing message: {e}", exc_info=True)
-                await query.message.reply_text(
-                    f"✅ Часовой пояс изменен на {city_name} 🌍\n\n"
-                    f"Напоминания теперь будут приходить согласно этому часовому поясу. 💕"
-                )
-    
-    # Добавляем глобальный обработчик для inline кнопок (добавляем ПЕРЕД ConversationHandler)
-    # Включаем обработку кнопок времени (time_*), чтобы они работали всегда
-    application.add_handler(CallbackQueryHandler(global_button_callback, pattern='^(change_time_btn|settings|info_btn|back_to_main|main_menu|time_|test_notification|select_city|city_)'))
+    # Команды меню (регистр команд Telegram не учитывается: /Start и /START тоже сюда)
+    application.add_handler(CommandHandler(['start', 'mur'], start))
+    application.add_handler(CommandHandler('mur_time', change_time))
+    application.add_handler(CommandHandler('cancel', cancel))
+    
+    # Все inline-кнопки идут через один обработчик с таблицей маршрутов
+    router = CallbackRouter()
+    router.add('back_to_main', show_main_menu)
+    router.add('main_menu', show_main_menu)
+    router.add('change_time_btn', show_time_menu)
+    router.add('settings', show_settings)
+    router.add('info_btn', show_info)
+    router.add('test_notification', send_test_notification)
+    router.add('select_city', show_city_menu)
+    router.add('pill_taken', pill_taken)
+    router.add_prefix('time', select_time)
+    router.add_prefix('city', select_city)
+    application.add_handler(router.handler())
     
     # Тестовая команда для проверки напоминаний
     async def test_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1244,16 +682,69 @@ def main():
     
     application.add_handler(CommandHandler('test', test_reminder))
     
-    # Команда для экспорта данных в Excel
-    async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Команда для экспорта данных в Excel"""
+    # Команда для экспорта данных в Excel (книга собирается в отдельном процессе)
+    export_sheets = ["Пользователи", "История взаимодействий", "Принятые таблеточки"]
+    export_cancel_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✖️ Отменить экспорт", callback_data="export_cancel")]
+    ])
+
+    def format_export_progress(progress: dict) -> str:
+        """Текст сообщения о прогрессе экспорта"""
+        lines = ["⏳ Готовлю экспорт данных...\n"]
+        for title in export_sheets:
+            state = progress.get(title)
+            if state is None:
+                lines.append(f"• {title}: в очереди")
+            elif state[1]:
+                lines.append(f"✅ {title}: {state[0]} строк")
+            else:
+                lines.append(f"• {title}: {state[0]} строк...")
+        return "\n".join(lines)
+
+    async def run_export_job(message, user_id: int, username: str):
+        """Фоновая задача: экспорт с обновлением прогресса и отправка файла"""
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"pillow_bot_data_{timestamp}.xlsx"
+        # На диске добавляем id, чтобы одновременные экспорты не перезаписали друг друга
+        path = f"pillow_bot_data_{timestamp}_{user_id}.xlsx"
+
+        progress_message = await message.reply_text(
+            format_export_progress({}),
+            reply_markup=export_cancel_markup
+        )
+        progress = {}
+        last_edit = 0.0
+
+        async def on_progress(sheet_title, rows_written, done):
+            nonlocal last_edit
+            progress[sheet_title] = (rows_written, done)
+            # Не правим сообщение чаще раза в пару секунд, кроме окончания листа
+            now = time.monotonic()
+            if done or now - last_edit >= 2:
+                last_edit = now
+                await progress_message.edit_text(
+                    format_export_progress(progress),
+                    reply_markup=export_cancel_markup
+                )
+
+        try:
+            await export_jobs.run_export(user_id, path, on_progress)
+        except export_jobs.ExportBusy:
+            await progress_message.edit_text("⏳ Экспорт уже идет, дождись его окончания.")
+            return
+        except export_jobs.ExportCancelled:
+            await progress_message.edit_text("✖️ Экспорт отменен.")
+            return
+        except Exception as e:
+            logger.error(f"Error exporting data: {e}", exc_info=True)
+            await progress_message.edit_text(f"❌ Ошибка при экспорте данных: {e}")
+            return
+
         try:
-            import excel_export
-            filename = excel_export.export_to_excel()
-            
+            await progress_message.edit_text("📤 Экспорт готов, отправляю файл...")
             # Отправляем файл пользователю
-            with open(filename, 'rb') as f:
-                await update.message.reply_document(
+            with open(path, 'rb') as f:
+                await message.reply_document(
                     document=f,
                     filename=filename,
                     caption="📊 Вот твои данные из базы бота! 📈\n\n"
@@ -1262,23 +753,41 @@ def main():
                             "• Историю взаимодействий\n"
                             "• Данные о принятых таблеточках"
                 )
-            
-            # Удаляем временный файл
-            import os
-            os.remove(filename)
-            
-            user_id = update.effective_user.id
-            username = update.effective_user.username or update.effective_user.first_name
-            database.log_interaction(user_id, "data_exported", None, username)
+            await async_database.log_interaction(user_id, "data_exported", None, username)
         except Exception as e:
-            logger.error(f"Error exporting data: {e}")
-            await update.message.reply_text(f"❌ Ошибка при экспорте данных: {e}")
-    
+            logger.error(f"Error sending export: {e}", exc_info=True)
+            await message.reply_text(f"❌ Ошибка при отправке экспорта: {e}")
+        finally:
+            # Удаляем временный файл
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда для экспорта данных всех пользователей в Excel (только для админа)"""
+        user_id = update.effective_user.id
+        if not is_admin(user_id):
+            return
+        username = update.effective_user.username or update.effective_user.first_name
+        if not export_jobs.can_start(user_id):
+            await update.message.reply_text("⏳ Экспорт уже идет. Отменить: /export_cancel")
+            return
+        # Не ждем окончания экспорта в обработчике, чтобы не задерживать другие обновления
+        context.application.create_task(run_export_job(update.message, user_id, username), update=update)
+
+    async def export_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отмена идущего экспорта (команда /export_cancel или кнопка под прогрессом)"""
+        query = update.callback_query
+        user_id = update.effective_user.id
+        cancelled = export_jobs.cancel_export(user_id)
+        if query:
+            await query.answer("Отменяю экспорт..." if cancelled else "Экспорт уже завершен")
+        elif not cancelled:
+            await update.message.reply_text("Сейчас нет идущего экспорта.")
+
     application.add_handler(CommandHandler('export', export_data))
-    
-    
-    # Добавление обработчиков
-    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('export_cancel', export_cancel))
+    # На кнопку под прогрессом export_cancel отвечает сам, с текстом
+    router.add('export_cancel', export_cancel, answer=False)
     
     # Логируем количество зарегистрированных обработчиков
     logger.info(f"Total handlers registered: {len(application.handlers[0])}")
@@ -1288,13 +797,55 @@ def main():
         """Загружает существующие напоминания после инициализации"""
         load_existing_reminders(app.job_queue)
         logger.info("Existing reminders loaded")
+        await memo_delivery.warm()
     
     application.post_init = post_init
+
+    async def post_shutdown(app: Application) -> None:
+        """Дожидается незавершенных запросов к базе и сбрасывает буфер логов"""
+        await send_queue.close()
+        export_jobs.shutdown()
+        async_database.shutdown()
+        database.flush_interactions()
+
+    application.post_shutdown = post_shutdown
+
+    register_metrics(application)
+    metrics.instrument_application(application)
+    return application
+
+def register_metrics(application: Application):
+    """Значения очередей и кэшей для /metrics"""
+    processor = application.update_processor
+    metrics.register_gauge('bot_updates_active', 'Updates being processed', lambda: processor.active)
+    metrics.register_gauge('bot_updates_waiting', 'Updates waiting for a free slot', lambda: processor.waiting)
+    metrics.register_gauge(
+        'bot_updates_queued_behind_user', 'Updates waiting for the same user', lambda: processor.queued_behind_user
+    )
+    metrics.register_gauge('bot_updates_processed_total', 'Processed updates', lambda: processor.processed, 'counter')
+    metrics.register_gauge('bot_update_queue_size', 'Updates received but not dispatched', application.update_queue.qsize)
+    metrics.register_gauge('bot_send_queue_size', 'Messages waiting in the send queue', send_queue.qsize)
+    metrics.register_gauge(
+        'bot_interaction_log_queue_depth', 'Buffered interaction log rows',
+        lambda: database.get_interaction_log_stats()['queue_depth']
+    )
+    metrics.register_gauge(
+        'bot_interaction_log_dropped_total', 'Interaction log rows dropped because the buffer was full',
+        lambda: database.get_interaction_log_stats()['dropped'], 'counter'
+    )
+    metrics.register_gauge('bot_user_cache_hits_total', 'User cache hits', lambda: user_cache.get_stats()['hits'], 'counter')
+    metrics.register_gauge('bot_user_cache_misses_total', 'User cache misses', lambda: user_cache.get_stats()['misses'], 'counter')
+    metrics.register_gauge('bot_memo_cache_hits_total', 'Voice memo cache hits', lambda: memo_delivery.get_stats()['hits'], 'counter')
+    metrics.register_gauge('bot_memo_cache_misses_total', 'Voice memo cache misses', lambda: memo_delivery.get_stats()['misses'], 'counter')
+
+def main():
+    """Главная функция для запуска бота (long polling)"""
+    application = build_application()
     
     # Запуск бота
     logger.info("Bot is starting...")
     logger.info("Handlers registered, starting polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=config.DROP_PENDING_UPDATES)
 
 def create_and_setup_application():
     """
@@ -1347,7 +898,7 @@ async def run_bot_with_start_polling():
         await application.start()
         await application.updater.start_polling(
             allowed_updates=Update.ALL_TYPES, 
-            drop_pending_updates=True
+            drop_pending_updates=config.DROP_PENDING_UPDATES
         )
         logger.info("Bot is running...")
         
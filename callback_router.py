@@ -0,0 +1,71 @@
+"""
+Маршрутизация нажатий inline-кнопок по callback_data.
+
+Все кнопки бота обрабатывает один CallbackQueryHandler без регулярного
+выражения, а обработчик выбирается по таблице: сначала точное совпадение
+(settings, pill_taken, ...), затем префикс до первого «_» с аргументом
+(time_08:00 -> time, "08:00"; city_spb -> city, "spb"). Данные разбираются
+один раз, а обработчику префикса сразу приходит аргумент.
+"""
+import logging
+
+from telegram.ext import CallbackQueryHandler
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackRouter:
+    """Таблица callback_data -> обработчик"""
+
+    def __init__(self):
+        self._exact = {}     # callback_data -> (обработчик, ответить ли на query)
+        self._prefixes = {}  # префикс без «_» -> (обработчик, ответить ли на query)
+
+    def add(self, data: str, callback, answer: bool = True):
+        """Кнопка с фиксированными данными: callback(update, context)
+
+        answer=False — обработчик сам отвечает на query (например, с текстом).
+        """
+        self._exact[data] = (callback, answer)
+
+    def add_prefix(self, prefix: str, callback, answer: bool = True):
+        """Кнопки вида <prefix>_<аргумент>: callback(update, context, аргумент)"""
+        self._prefixes[prefix] = (callback, answer)
+
+    def resolve(self, data: str):
+        """(обработчик, ответить ли, аргумент или None) либо None, если маршрута нет"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route[0], route[1], None
+        prefix, sep, arg = data.partition('_')
+        if sep:
+            route = self._prefixes.get(prefix)
+            if route is not None:
+                return route[0], route[1], arg
+        return None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        route = self.resolve(query.data or '')
+        if route is None:
+            # Кнопка из старого сообщения или чужие данные: убираем «часики» и выходим
+            logger.warning(f"Unknown callback data {query.data!r} from user {query.from_user.id}")
+            await query.answer()
+            return
+        callback, answer, arg = route
+        if answer:
+            await query.answer()
+        with metrics.HANDLER_SECONDS.time(callback.__name__):
+            if arg is None:
+                await callback(update, context)
+            else:
+                await callback(update, context, arg)
+
+    # Время пишется по маршрутам, instrument_application не оборачивает dispatch целиком
+    dispatch.timed = True
+
+    def handler(self) -> CallbackQueryHandler:
+        """Единственный CallbackQueryHandler для всех inline-кнопок"""
+        return CallbackQueryHandler(self.dispatch)
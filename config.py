@@ -35,3 +35,59 @@ def _parse_int_set(raw: str) -> set[int]:
 # Формат: "123,456".
 # Если переменная не задана — по умолчанию ваш id.
 ADMIN_USER_IDS = _parse_int_set(os.getenv('ADMIN_USER_IDS', '459695859'))
+
+# Сколько потоков выполняют запросы к базе для асинхронных обработчиков
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+
+# Лимиты отправки сообщений (Telegram: ~30 сообщений/с на бота, ~1 сообщение/с в чат)
+SEND_RATE_PER_SECOND = float(os.getenv('SEND_RATE_PER_SECOND', '30'))
+SEND_PER_CHAT_RATE = float(os.getenv('SEND_PER_CHAT_RATE', '1'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+# Сколько раз повторять отправку после 429 / сетевой ошибки
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+
+# Досылка напоминаний после простоя: за сколько минут назад досылать пропущенные
+# и по сколько штук. Пачки идут одна за другой, чтобы между ними в общую очередь
+# отправки успевали ответы на нажатия; внутри пачки скорость ограничивает SendQueue
+CATCHUP_WINDOW_MINUTES = int(os.getenv('CATCHUP_WINDOW_MINUTES', '180'))
+CATCHUP_BATCH_SIZE = int(os.getenv('CATCHUP_BATCH_SIZE', '20'))
+
+# Отбрасывать ли накопившиеся за время простоя обновления (нажатия кнопок) при старте
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '0').lower() in ('1', 'true', 'yes')
+
+# Экспорт в Excel: сколько процессов собирают книги и сколько экспортов одновременно у одного пользователя
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '2'))
+EXPORT_MAX_PER_USER = int(os.getenv('EXPORT_MAX_PER_USER', '1'))
+
+# Голосовые памятки: размер кэша следующих памяток и сколько частых позиций прогревать при старте
+MEMO_CACHE_SIZE = int(os.getenv('MEMO_CACHE_SIZE', '1024'))
+MEMO_WARM_COUNT = int(os.getenv('MEMO_WARM_COUNT', '50'))
+
+# Кэш профилей пользователей (часовой пояс, время напоминания, счетчики): сколько профилей и сколько секунд живет запись
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+
+# Сколько обновлений Telegram обрабатывать одновременно (обновления одного пользователя всегда идут по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+
+# Режим webhook (python webhook.py): публичный адрес бота, путь, адрес и порт HTTP-сервера.
+# Без WEBHOOK_URL webhook в Telegram не регистрируется (локальная проверка).
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8080')))
+# Секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Резервные копии (/db_backup): сколько страниц SQLite копировать за шаг и уровень сжатия gzip (1-9)
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '4096'))
+BACKUP_COMPRESS_LEVEL = int(os.getenv('BACKUP_COMPRESS_LEVEL', '6'))
+# Сколько строк может накопить журнал изменений без /db_backup и /db_delta;
+# при превышении цепочка копий сбрасывается, и следующей нужна полная копия
+CHANGE_JOURNAL_MAX_ROWS = int(os.getenv('CHANGE_JOURNAL_MAX_ROWS', '1000000'))
+
+# Восстановление (/db_restore): предельный размер загруженного файла и распакованной базы (МБ).
+# Облачный Bot API отдает боту файлы до 20 МБ; с локальным Bot API сервером лимит можно поднять.
+RESTORE_MAX_UPLOAD_MB = int(os.getenv('RESTORE_MAX_UPLOAD_MB', '20'))
+RESTORE_MAX_DB_MB = int(os.getenv('RESTORE_MAX_DB_MB', '2048'))
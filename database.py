@@ -1,16 +1,285 @@
 """
 Модуль для работы с базой данных
 """
+import atexit
+import logging
+import os
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytz
+
+import local_time
+
+logger = logging.getLogger(__name__)
 
 DATABASE_NAME = 'pillow_bot.db'
 
-def init_database():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+# Размер кэша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 128
+
+# Сколько ждать снятия блокировки записи другим потоком (секунды)
+BUSY_TIMEOUT = 30
+
+# Соединения живут весь срок жизни потока: открывать файл на каждый запрос дорого.
+_local = threading.local()
+_connections_lock = threading.Lock()
+_connections = []
+_generation = 0
+
+
+class _SwapLock:
+    """Обычные запросы идут параллельно, подмена файла базы (exclusive_access) — одна и без них.
+
+    Ожидающая подмена не пропускает новые запросы, иначе под нагрузкой она бы не дождалась очереди.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._exclusive or self._waiting_exclusive:
+                self._cond.wait()
+            self._active += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._active -= 1
+            if not self._active:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            self._waiting_exclusive += 1
+            try:
+                while self._exclusive or self._active:
+                    self._cond.wait()
+            finally:
+                self._waiting_exclusive -= 1
+            self._exclusive = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._exclusive = False
+            self._cond.notify_all()
+
+
+_swap_lock = _SwapLock()
+
+
+def _open_connection() -> sqlite3.Connection:
+    """Открывает новое соединение с настройками для долгой жизни"""
+    # isolation_level=None: транзакциями управляем сами через transaction()
+    conn = sqlite3.connect(
+        DATABASE_NAME,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    # WAL: читатели не блокируют писателя и наоборот
+    conn.execute('PRAGMA journal_mode=WAL')
+    # В режиме WAL NORMAL не рискует целостностью, но убирает fsync на каждый commit
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает соединение текущего потока (открывает при первом обращении)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.generation == _generation and _local.path == DATABASE_NAME:
+        return conn
+
+    if conn is not None:
+        _forget_connection(conn)
+
+    conn = _open_connection()
+    with _connections_lock:
+        _connections.append(conn)
+        _local.generation = _generation
+    _local.conn = conn
+    _local.path = DATABASE_NAME
+    return conn
+
+
+def _forget_connection(conn: sqlite3.Connection):
+    with _connections_lock:
+        try:
+            _connections.remove(conn)
+        except ValueError:
+            pass
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+@contextmanager
+def shared_access():
+    """Доступ к файлу базы, при котором его нельзя подменить (вложенные вызовы бесплатны)"""
+    if getattr(_local, 'shared', False) or getattr(_local, 'exclusive', False):
+        yield
+        return
+
+    _swap_lock.acquire_shared()
+    _local.shared = True
+    try:
+        yield
+    finally:
+        _local.shared = False
+        _swap_lock.release_shared()
+
+
+@contextmanager
+def exclusive_access():
+    """Ждет завершения текущих запросов и не пускает новые (для подмены файла базы)"""
+    _swap_lock.acquire_exclusive()
+    _local.exclusive = True
+    try:
+        yield
+    finally:
+        _local.exclusive = False
+        _swap_lock.release_exclusive()
+
+
+@contextmanager
+def connection():
+    """Контекст для чтения: соединение текущего потока без явной транзакции"""
+    with shared_access():
+        yield get_connection()
+
+
+@contextmanager
+def transaction():
+    """Контекст для записи: BEGIN IMMEDIATE ... COMMIT (ROLLBACK при ошибке).
+
+    Вложенные вызовы присоединяются к внешней транзакции.
+    """
+    with shared_access():
+        conn = get_connection()
+        if conn.in_transaction:
+            yield conn
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            _abort(conn)
+            raise
+        try:
+            conn.execute('COMMIT')
+        except BaseException:
+            # Неудачный COMMIT (SQLITE_BUSY, ошибка диска) оставляет транзакцию открытой:
+            # следующие transaction() этого потока сочли бы себя вложенными и ничего не записали бы
+            _abort(conn)
+            raise
+
+
+def _abort(conn: sqlite3.Connection):
+    """Откатывает транзакцию, не заслоняя исходную ошибку.
+
+    SQLite мог уже откатить ее сам (SQLITE_FULL, IOERR) — тогда ROLLBACK не нужен.
+    Если откат не удался, соединение потока закрывается и при следующем
+    обращении открывается заново.
+    """
+    try:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+    except sqlite3.Error as e:
+        logger.error(f"Rollback failed, reopening connection: {e}")
+        if getattr(_local, 'conn', None) is conn:
+            _local.conn = None
+        _forget_connection(conn)
+
+
+def close_connections():
+    """Закрывает все открытые соединения (например, перед заменой файла базы).
+
+    Вызывать, когда никакие запросы не выполняются: потоки откроют
+    новые соединения при следующем обращении.
+    """
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        conns = list(_connections)
+        _connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def checkpoint():
+    """Переносит содержимое WAL в основной файл базы"""
+    with connection() as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def swap_database(new_path: str, backup_path: str) -> dict:
+    """Подменяет файл базы на new_path без остановки бота, старый сохраняет как backup_path.
+
+    new_path должен быть уже проверен и обновлен до SCHEMA_VERSION (upgrade_database_file).
+    На время подмены запросы ждут; расписание напоминаний в новой базе сверяется
+    с текущим (reconcile_reminders). Возвращает {'rescheduled', 'pause'}.
+    """
+    with exclusive_access():
+        started = time.monotonic()
+        with connection() as conn:
+            previous = get_reminder_schedule(conn)
+
+        new_conn = sqlite3.connect(new_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        try:
+            new_conn.execute('BEGIN IMMEDIATE')
+            rescheduled = reconcile_reminders(new_conn, previous, int(time.time()))
+            new_conn.execute('COMMIT')
+        finally:
+            new_conn.close()
+
+        # Закрываем соединения и сливаем WAL, иначе старый -wal применится к новому файлу
+        checkpoint()
+        close_connections()
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(DATABASE_NAME + suffix):
+                os.remove(DATABASE_NAME + suffix)
+
+        os.replace(DATABASE_NAME, backup_path)
+        try:
+            os.replace(new_path, DATABASE_NAME)
+        except OSError:
+            os.replace(backup_path, DATABASE_NAME)
+            raise
+        pause = time.monotonic() - started
+
+    logger.info(f"Database swapped in {pause:.3f}s, {rescheduled} reminders rescheduled")
+    return {'rescheduled': rescheduled, 'pause': pause}
+
+
+# --- Схема и миграции ---
+#
+# Версия схемы хранится в PRAGMA user_version, примененные шаги — в
+# schema_migrations. Новые изменения схемы добавляются в конец MIGRATIONS
+# отдельной функцией; уже выпущенные шаги не меняются.
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    return any(row[1] == column for row in cursor.execute(f'PRAGMA table_info({table})'))
+
+
+def _add_column(cursor, table: str, column: str, definition: str):
+    # Базы, созданные до появления миграций, могут уже содержать колонку
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 
+def _migration_initial_schema(cursor):
     # Создаем таблицу для хранения времени напоминаний
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS reminders (
@@ -22,24 +291,11 @@ def init_database():
         )
     ''')
 
-    # Миграция: добавляем колонку timezone если её нет (для существующих баз данных)
-    try:
-        cursor.execute('SELECT timezone FROM reminders LIMIT 1')
-    except sqlite3.OperationalError:
-        try:
-            cursor.execute('ALTER TABLE reminders ADD COLUMN timezone TEXT DEFAULT \'Europe/Moscow\'')
-            cursor.execute('UPDATE reminders SET timezone = \'Europe/Moscow\' WHERE timezone IS NULL')
-        except sqlite3.OperationalError:
-            pass
-
-    # Миграция: добавляем колонку username если её нет
-    try:
-        cursor.execute('SELECT username FROM reminders LIMIT 1')
-    except sqlite3.OperationalError:
-        try:
-            cursor.execute('ALTER TABLE reminders ADD COLUMN username TEXT')
-        except sqlite3.OperationalError:
-            pass
+    # Самые старые базы создавались без timezone и username
+    if not _column_exists(cursor, 'reminders', 'timezone'):
+        cursor.execute('ALTER TABLE reminders ADD COLUMN timezone TEXT DEFAULT \'Europe/Moscow\'')
+        cursor.execute('UPDATE reminders SET timezone = \'Europe/Moscow\' WHERE timezone IS NULL')
+    _add_column(cursor, 'reminders', 'username', 'TEXT')
 
     # Создаем таблицу для отслеживания принятых таблеток (по датам)
     cursor.execute('''
@@ -93,303 +349,939 @@ def init_database():
         )
     ''')
 
-    conn.commit()
-    conn.close()
 
+def _migration_reminder_next_fire(cursor):
+    # Время следующего срабатывания напоминания (Unix-время UTC)
+    _add_column(cursor, 'reminders', 'next_fire_utc', 'INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminders_next_fire ON reminders (next_fire_utc)')
 
-def set_reminder_time(user_id: int, time: str, timezone: str = 'Europe/Moscow', username: str = None):
-    """Устанавливает время напоминания для пользователя"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    rows = cursor.execute(
+        'SELECT user_id, reminder_time, timezone FROM reminders WHERE next_fire_utc IS NULL'
+    ).fetchall()
+    if rows:
+        now_utc = datetime.now(pytz.UTC)
+        cursor.executemany(
+            'UPDATE reminders SET next_fire_utc = ? WHERE user_id = ?',
+            [(_next_fire_or_none(t, tz or 'Europe/Moscow', now_utc), user_id) for user_id, t, tz in rows]
+        )
+
+
+def _migration_secondary_indexes(cursor):
+    # Выборки по пользователю; username в индексе — сводка экспорта не читает саму таблицу
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_interactions_user ON bot_interactions (user_id, username)')
+    # delete_voice_memo удаляет выдачи по memo_id
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_voice_deliveries_memo ON voice_deliveries (memo_id)')
+    # Выгрузка отметок идет по дате без сортировки во временной таблице
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pills_taken_date ON pills_taken (date, taken_at)')
 
-    # Если username не передан, пытаемся получить существующий
-    if username is None:
-        cursor.execute('SELECT username FROM reminders WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        username = result[0] if result else None
 
+def _migration_voice_memo_cursor(cursor):
+    # Памятки выдаются строго по возрастанию id, поэтому выданное пользователю —
+    # всегда все памятки до last_memo_id. Курсор заменяет поиск по voice_deliveries.
     cursor.execute('''
-        INSERT OR REPLACE INTO reminders (user_id, username, reminder_time, timezone, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, time, timezone, datetime.now().isoformat()))
+        CREATE TABLE IF NOT EXISTS voice_memo_cursor (
+            user_id INTEGER PRIMARY KEY,
+            last_memo_id INTEGER NOT NULL,
+            delivered_count INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO voice_memo_cursor (user_id, last_memo_id, delivered_count, updated_at)
+        SELECT user_id, MAX(memo_id), COUNT(*), MAX(delivered_at)
+        FROM voice_deliveries
+        GROUP BY user_id
+    ''')
+
+
+def _migration_user_stats(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            days_count INTEGER NOT NULL,
+            first_date TEXT NOT NULL,
+            last_taken TEXT NOT NULL,
+            current_streak INTEGER NOT NULL,
+            longest_streak INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    # Пересчет читает и пишет одновременно — нужны разные курсоры
+    _rebuild_user_stats(cursor.connection)
+
+
+def _migration_change_journal(cursor):
+    # Журнал изменений для инкрементальных копий (db_backup.create_delta): какая
+    # строка какой таблицы менялась. Одна запись на строку — повторная правка
+    # получает новый seq. bot_interactions только дополняется, ее дельта
+    # берется по id, без триггеров на самой нагруженной таблице.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            UNIQUE (table_name, row_id)
+        )
+    ''')
+    for table in ('reminders', 'pills_taken', 'voice_memos', 'voice_deliveries',
+                  'voice_memo_daily', 'voice_memo_cursor', 'user_stats'):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS journal_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR REPLACE INTO change_journal (table_name, row_id) VALUES ('{table}', {row}.rowid);
+                END
+            ''')
+
+    # Состояние цепочки копий: от какого снимка и до какого seq выгружены изменения
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            chain_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            interaction_id INTEGER NOT NULL,
+            delta_number INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+
+# (версия, название, функция); версия шага совпадает с его номером в списке
+MIGRATIONS = [
+    (1, 'initial schema', _migration_initial_schema),
+    (2, 'reminders.next_fire_utc', _migration_reminder_next_fire),
+    (3, 'secondary indexes', _migration_secondary_indexes),
+    (4, 'voice memo cursor', _migration_voice_memo_cursor),
+    (5, 'user stats', _migration_user_stats),
+    (6, 'change journal', _migration_change_journal),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection = None) -> int:
+    """Текущая версия схемы базы (PRAGMA user_version)"""
+    if conn is None:
+        with connection() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _apply_migrations(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than supported {SCHEMA_VERSION}"
+        )
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+
+    for step, name, migrate in MIGRATIONS:
+        if step <= version:
+            continue
+        logger.info(f"Applying database migration {step}: {name}")
+        migrate(cursor)
+        cursor.execute(
+            'INSERT OR REPLACE INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+            (step, name, datetime.now().isoformat())
+        )
+        # PRAGMA не принимает параметры; step — целое из MIGRATIONS
+        cursor.execute(f'PRAGMA user_version = {int(step)}')
+
+
+def init_database():
+    """Инициализация базы данных: применяет недостающие миграции одной транзакцией"""
+    with transaction() as conn:
+        _apply_migrations(conn)
+
 
-    conn.commit()
-    conn.close()
+def upgrade_database_file(path: str):
+    """Применяет недостающие миграции к файлу базы, который еще не подключен (перед подменой)"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            _apply_migrations(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def compute_next_fire_utc(time_str: str, timezone: str, now_utc: datetime = None) -> int:
+    """Unix-время (UTC, секунды) ближайшего срабатывания напоминания ЧЧ:ММ в часовом поясе"""
+    hour, minute = map(int, time_str.split(':'))
+    user_tz = local_time.get_timezone(timezone)
+    if now_utc is None:
+        now_utc = datetime.now(pytz.UTC)
+
+    now_user_tz = now_utc.astimezone(user_tz)
+    target_date = now_user_tz.date()
+    target = user_tz.localize(datetime(target_date.year, target_date.month, target_date.day, hour, minute))
+
+    # Если время уже прошло сегодня, планируем на завтра
+    if target <= now_user_tz:
+        target_date += timedelta(days=1)
+        target = user_tz.localize(datetime(target_date.year, target_date.month, target_date.day, hour, minute))
+
+    return int(target.timestamp())
+
+
+def _next_fire_or_none(time_str: str, timezone: str, now_utc: datetime):
+    # Битая строка в базе не должна останавливать планировщик: такое напоминание просто не срабатывает
+    try:
+        return compute_next_fire_utc(time_str, timezone, now_utc)
+    except (ValueError, AttributeError, pytz.UnknownTimeZoneError):
+        logger.error(f"Invalid reminder {time_str!r} ({timezone!r}), disabling it")
+        return None
+
+
+def set_reminder_time(user_id: int, time: str, timezone: str = 'Europe/Moscow', username: str = None):
+    """Устанавливает время напоминания для пользователя"""
+    next_fire_utc = compute_next_fire_utc(time, timezone)
+
+    with transaction() as conn:
+        # Если username не передан, пытаемся получить существующий
+        if username is None:
+            result = conn.execute('SELECT username FROM reminders WHERE user_id = ?', (user_id,)).fetchone()
+            username = result[0] if result else None
+
+        conn.execute('''
+            INSERT OR REPLACE INTO reminders (user_id, username, reminder_time, timezone, created_at, next_fire_utc)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, username, time, timezone, datetime.now().isoformat(), next_fire_utc))
 
 
 def set_user_timezone(user_id: int, timezone: str, username: str = None):
     """Устанавливает часовой пояс для пользователя"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    with transaction() as conn:
+        # Обновляем часовой пояс, сохраняя существующее время напоминания
+        result = conn.execute(
+            'SELECT reminder_time, username FROM reminders WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        reminder_time = result[0] if result else '09:00'
+        if username is None and result:
+            username = result[1]
+
+        conn.execute('''
+            INSERT OR REPLACE INTO reminders (user_id, username, reminder_time, timezone, created_at, next_fire_utc)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, username, reminder_time, timezone, datetime.now().isoformat(),
+              compute_next_fire_utc(reminder_time, timezone)))
+
+
+def claim_due_reminders(now_utc: int, limit: int = 1000):
+    """Забирает напоминания с next_fire_utc <= now_utc и переносит их на следующее срабатывание.
+
+    Возвращает [(user_id, next_fire_utc)] — время, на которое напоминание было запланировано.
+    Выборка и перенос идут в одной транзакции, поэтому каждое срабатывание забирается один раз.
+    """
+    with transaction() as conn:
+        rows = conn.execute('''
+            SELECT user_id, reminder_time, timezone, next_fire_utc FROM reminders
+            WHERE next_fire_utc <= ?
+            ORDER BY next_fire_utc
+            LIMIT ?
+        ''', (now_utc, limit)).fetchall()
+        if not rows:
+            return []
+
+        updates = []
+        for user_id, reminder_time, timezone, fire_utc in rows:
+            # Следующее срабатывание — строго после текущего, даже если задача пришла чуть раньше
+            base = datetime.fromtimestamp(max(now_utc, fire_utc + 60), pytz.UTC)
+            updates.append((_next_fire_or_none(reminder_time, timezone, base), user_id))
+        conn.executemany('UPDATE reminders SET next_fire_utc = ? WHERE user_id = ?', updates)
+
+    return [(row[0], row[3]) for row in rows]
+
+
+def claim_missed_reminders(since_utc: int, now_utc: int):
+    """Забирает напоминания, пропущенные в окне [since_utc, now_utc), и переносит их на будущее.
+
+    Возвращает [(user_id, next_fire_utc)] тех, кто еще не отметил таблеточку за день
+    пропущенного напоминания (дата считается в часовом поясе пользователя).
+    """
+    base = datetime.fromtimestamp(now_utc, pytz.UTC)
+    with transaction() as conn:
+        rows = conn.execute('''
+            SELECT user_id, reminder_time, timezone, next_fire_utc FROM reminders
+            WHERE next_fire_utc >= ? AND next_fire_utc < ?
+            ORDER BY next_fire_utc
+        ''', (since_utc, now_utc)).fetchall()
+
+        missed = []
+        for user_id, _reminder_time, timezone, fire_utc in rows:
+            fire_date = local_time.local_date_of(fire_utc, timezone)
+            taken = conn.execute(
+                'SELECT 1 FROM pills_taken WHERE user_id = ? AND date = ?', (user_id, fire_date)
+            ).fetchone()
+            if taken is None:
+                missed.append((user_id, fire_utc))
+
+        conn.executemany(
+            'UPDATE reminders SET next_fire_utc = ? WHERE user_id = ?',
+            [(_next_fire_or_none(t, tz, base), user_id) for user_id, t, tz, _ in rows]
+        )
+    return missed
+
+
+def roll_forward_reminders(now_utc: int) -> int:
+    """Переносит просроченные напоминания (next_fire_utc < now_utc) на ближайшее будущее срабатывание.
+
+    Возвращает количество перенесенных строк.
+    """
+    base = datetime.fromtimestamp(now_utc, pytz.UTC)
+    with transaction() as conn:
+        rows = conn.execute(
+            'SELECT user_id, reminder_time, timezone FROM reminders WHERE next_fire_utc < ?',
+            (now_utc,)
+        ).fetchall()
+        conn.executemany(
+            'UPDATE reminders SET next_fire_utc = ? WHERE user_id = ?',
+            [(_next_fire_or_none(t, tz, base), user_id) for user_id, t, tz in rows]
+        )
+    return len(rows)
 
-    # Обновляем часовой пояс, сохраняя существующее время напоминания
-    cursor.execute('SELECT reminder_time, username FROM reminders WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    reminder_time = result[0] if result else '09:00'
-    if username is None and result:
-        username = result[1]
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO reminders (user_id, username, reminder_time, timezone, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, reminder_time, timezone, datetime.now().isoformat()))
+def get_reminder_schedule(conn: sqlite3.Connection, user_ids=None) -> dict:
+    """user_id -> (reminder_time, timezone, next_fire_utc) для всех или только для user_ids"""
+    rows = conn.execute('SELECT user_id, reminder_time, timezone, next_fire_utc FROM reminders')
+    if user_ids is None:
+        return {row[0]: row[1:] for row in rows}
+    return {row[0]: row[1:] for row in rows if row[0] in user_ids}
 
-    conn.commit()
-    conn.close()
 
+def reconcile_reminders(conn: sqlite3.Connection, previous: dict, now_utc: int, user_ids=None) -> int:
+    """Приводит next_fire_utc в conn к расписанию previous (после восстановления из копии).
 
-def get_user_timezone(user_id: int) -> str:
-    """Получает часовой пояс пользователя"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    Если время и пояс пользователя не менялись, срабатывание берется из previous:
+    сегодняшнее напоминание не повторится и не потеряется. Для новых и измененных
+    напоминаний просроченное время пересчитывается от now_utc. Пишутся только
+    отличающиеся строки; возвращает их количество.
+    """
+    base = datetime.fromtimestamp(now_utc, pytz.UTC)
+    updates = []
+    for user_id, (reminder_time, timezone, fire_utc) in get_reminder_schedule(conn, user_ids).items():
+        old = previous.get(user_id)
+        if old is not None and old[:2] == (reminder_time, timezone):
+            target = old[2]
+        elif fire_utc is None or fire_utc <= now_utc:
+            target = _next_fire_or_none(reminder_time, timezone, base)
+        else:
+            target = fire_utc
+        if target != fire_utc:
+            updates.append((target, user_id))
+    conn.executemany('UPDATE reminders SET next_fire_utc = ? WHERE user_id = ?', updates)
+    return len(updates)
+
+
+def _user_today(conn, user_id: int) -> str:
+    # «Сегодня» пользователя — по его часовому поясу, а не по часам сервера
+    row = conn.execute('SELECT timezone FROM reminders WHERE user_id = ?', (user_id,)).fetchone()
+    return local_time.local_today(row[0] if row else None)
 
-    cursor.execute('SELECT timezone FROM reminders WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
 
-    conn.close()
+def get_user_today(user_id: int) -> str:
+    """Текущая дата (YYYY-MM-DD) в часовом поясе пользователя"""
+    with connection() as conn:
+        return _user_today(conn, user_id)
+
+
+def get_user_timezone(user_id: int) -> str:
+    """Получает часовой пояс пользователя"""
+    with connection() as conn:
+        result = conn.execute('SELECT timezone FROM reminders WHERE user_id = ?', (user_id,)).fetchone()
 
     return result[0] if result else 'Europe/Moscow'
 
 
 def get_reminder_time(user_id: int) -> str:
     """Получает время напоминания для пользователя"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT reminder_time FROM reminders WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-
-    conn.close()
+    with connection() as conn:
+        result = conn.execute('SELECT reminder_time FROM reminders WHERE user_id = ?', (user_id,)).fetchone()
 
     return result[0] if result else None
 
 
 def get_all_users_with_reminders():
     """Получает всех пользователей с установленными напоминаниями"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT user_id, reminder_time, timezone FROM reminders')
-    results = cursor.fetchall()
-
-    conn.close()
-
-    return results
+    with connection() as conn:
+        return conn.execute('SELECT user_id, reminder_time, timezone FROM reminders').fetchall()
 
 
 def mark_pill_taken(user_id: int, date: str):
     """Отмечает, что пользователь выпил таблеточку в указанную дату"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT OR REPLACE INTO pills_taken (user_id, date, taken_at)
-        VALUES (?, ?, ?)
-    ''', (user_id, date, datetime.now().isoformat()))
-
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        now = datetime.now().isoformat()
+        inserted = conn.execute('''
+            INSERT OR IGNORE INTO pills_taken (user_id, date, taken_at)
+            VALUES (?, ?, ?)
+        ''', (user_id, date, now)).rowcount
+        if inserted:
+            _add_pill_date_to_stats(conn, user_id, date)
+        else:
+            # Повторная отметка за ту же дату: обновляем только время
+            conn.execute(
+                'UPDATE pills_taken SET taken_at = ? WHERE user_id = ? AND date = ?', (now, user_id, date)
+            )
 
 
 def is_pill_taken_today(user_id: int) -> bool:
     """Проверяет, выпил ли пользователь таблеточку сегодня"""
-    from datetime import date
-    today = date.today().isoformat()
-
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    with connection() as conn:
+        today = _user_today(conn, user_id)
+        result = conn.execute('''
+            SELECT 1 FROM pills_taken
+            WHERE user_id = ? AND date = ?
+        ''', (user_id, today)).fetchone()
 
-    cursor.execute('''
-        SELECT 1 FROM pills_taken
-        WHERE user_id = ? AND date = ?
-    ''', (user_id, today))
+    return result is not None
 
-    result = cursor.fetchone()
-    conn.close()
 
-    return result is not None
+# Пачка для IN (...): SQLite до 3.32 ограничивает запрос 999 параметрами
+_IN_BATCH_SIZE = 500
+
+
+def filter_pill_not_taken_today(user_ids: list) -> list:
+    """Оставляет из user_ids тех, кто еще не выпил таблеточку сегодня (по своему часовому поясу).
+
+    Для рассылки напоминаний: два запроса на пачку вместо is_pill_taken_today на каждого.
+    """
+    pending = []
+    with connection() as conn:
+        for i in range(0, len(user_ids), _IN_BATCH_SIZE):
+            batch = user_ids[i:i + _IN_BATCH_SIZE]
+            marks = ','.join('?' * len(batch))
+            timezones = dict(conn.execute(
+                f'SELECT user_id, timezone FROM reminders WHERE user_id IN ({marks})', batch
+            ))
+            today = {}
+            for tz in set(timezones.values()) | {None}:
+                today[tz] = local_time.local_today(tz)
+            dates = sorted(set(today.values()))
+            taken = set(conn.execute(
+                f'SELECT user_id, date FROM pills_taken '
+                f'WHERE user_id IN ({marks}) AND date IN ({",".join("?" * len(dates))})',
+                batch + dates
+            ))
+            pending.extend(
+                user_id for user_id in batch
+                if (user_id, today[timezones.get(user_id)]) not in taken
+            )
+    return pending
 
 
 def clear_pill_taken_today(user_id: int):
     """Очищает отметку о выпитой таблеточке на сегодня"""
-    from datetime import date
-    today = date.today().isoformat()
-
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        DELETE FROM pills_taken
-        WHERE user_id = ? AND date = ?
-    ''', (user_id, today))
-
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        today = _user_today(conn, user_id)
+        deleted = conn.execute('''
+            DELETE FROM pills_taken
+            WHERE user_id = ? AND date = ?
+        ''', (user_id, today)).rowcount
+        if deleted:
+            _recompute_user_stats(conn, user_id)
 
 
 def get_days_count(user_id: int) -> int:
     """Получает количество дней использования бота (количество записей о выпитых таблеточках)"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    return get_user_stats(user_id)[0]
 
-    cursor.execute('''
-        SELECT COUNT(DISTINCT date) FROM pills_taken
-        WHERE user_id = ?
-    ''', (user_id,))
 
-    result = cursor.fetchone()
-    conn.close()
+def get_first_use_date(user_id: int) -> str:
+    """Получает дату первого использования бота"""
+    return get_user_stats(user_id)[1]
+
+
+# --- Счетчики приема (user_stats) ---
+#
+# user_stats поддерживается при каждой отметке и снятии отметки, поэтому экран
+# «Информация» читает одну строку по ключу. current_streak — серия дней подряд,
+# заканчивающаяся на last_taken.
+
+def _is_next_day(previous: str, current: str) -> bool:
+    return (datetime.fromisoformat(current) - datetime.fromisoformat(previous)).days == 1
+
+
+def _stats_from_dates(dates):
+    """(days_count, first_date, last_taken, current_streak, longest_streak) по датам в порядке возрастания"""
+    days_count = current = longest = 0
+    first_date = last_taken = None
+    for pill_date in dates:
+        if last_taken is not None and _is_next_day(last_taken, pill_date):
+            current += 1
+        else:
+            current = 1
+        longest = max(longest, current)
+        days_count += 1
+        first_date = first_date or pill_date
+        last_taken = pill_date
+    return days_count, first_date, last_taken, current, longest
+
+
+_UPSERT_USER_STATS_SQL = '''
+    INSERT OR REPLACE INTO user_stats
+        (user_id, days_count, first_date, last_taken, current_streak, longest_streak, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _recompute_user_stats(conn, user_id: int):
+    """Пересчитывает строку пользователя по pills_taken (по первичному ключу, только его даты)"""
+    dates = [row[0] for row in conn.execute(
+        'SELECT date FROM pills_taken WHERE user_id = ? ORDER BY date', (user_id,)
+    )]
+    if not dates:
+        conn.execute('DELETE FROM user_stats WHERE user_id = ?', (user_id,))
+        return
+    conn.execute(_UPSERT_USER_STATS_SQL, (user_id, *_stats_from_dates(dates), datetime.now().isoformat()))
+
+
+def _add_pill_date_to_stats(conn, user_id: int, pill_date: str):
+    row = conn.execute(
+        'SELECT days_count, first_date, last_taken, current_streak, longest_streak FROM user_stats WHERE user_id = ?',
+        (user_id,)
+    ).fetchone()
+    if row is None or pill_date < row[2]:
+        # Первая отметка или дата в прошлом (может склеить серии): считаем заново
+        _recompute_user_stats(conn, user_id)
+        return
+
+    days_count, first_date, last_taken, current, longest = row
+    current = current + 1 if _is_next_day(last_taken, pill_date) else 1
+    conn.execute(_UPSERT_USER_STATS_SQL, (
+        user_id, days_count + 1, first_date, pill_date, current, max(longest, current),
+        datetime.now().isoformat()
+    ))
+
+
+def _iter_expected_user_stats(conn):
+    """Отдает (user_id, статистика) по всем пользователям, читая pills_taken в порядке ключа"""
+    cursor = conn.execute('SELECT user_id, date FROM pills_taken ORDER BY user_id, date')
+    user_id, dates = None, []
+    for row_user_id, pill_date in cursor:
+        if row_user_id != user_id:
+            if dates:
+                yield user_id, _stats_from_dates(dates)
+            user_id, dates = row_user_id, []
+        dates.append(pill_date)
+    if dates:
+        yield user_id, _stats_from_dates(dates)
+
+
+def _rebuild_user_stats(conn) -> int:
+    conn.execute('DELETE FROM user_stats')
+    now = datetime.now().isoformat()
+    count = 0
+    batch = []
+    for user_id, stats in _iter_expected_user_stats(conn):
+        batch.append((user_id, *stats, now))
+        count += 1
+        if len(batch) >= EXPORT_CHUNK_SIZE:
+            conn.executemany(_UPSERT_USER_STATS_SQL, batch)
+            batch = []
+    conn.executemany(_UPSERT_USER_STATS_SQL, batch)
+    return count
+
+
+def get_user_stats(user_id: int):
+    """Возвращает (days_count, first_date, last_taken, current_streak, longest_streak) одним чтением по ключу"""
+    with connection() as conn:
+        row = conn.execute('''
+            SELECT days_count, first_date, last_taken, current_streak, longest_streak
+            FROM user_stats WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+    return tuple(row) if row else (0, None, None, 0, 0)
+
+
+def rebuild_user_stats() -> int:
+    """Полностью пересчитывает user_stats по pills_taken. Возвращает число пользователей."""
+    with transaction() as conn:
+        return _rebuild_user_stats(conn)
+
+
+def check_user_stats() -> list:
+    """Сверяет user_stats с pills_taken. Возвращает user_id с расхождениями."""
+    with connection() as conn:
+        actual = {
+            row[0]: tuple(row[1:]) for row in conn.execute(
+                'SELECT user_id, days_count, first_date, last_taken, current_streak, longest_streak FROM user_stats'
+            )
+        }
+        mismatched = []
+        for user_id, expected in _iter_expected_user_stats(conn):
+            if actual.pop(user_id, None) != expected:
+                mismatched.append(user_id)
+    # Оставшиеся строки — пользователи без единой отметки
+    return mismatched + list(actual)
+
+
+# --- Буферизованный лог взаимодействий ---
+
+# Сбрасываем буфер, когда в нем накопилось столько событий...
+INTERACTION_FLUSH_SIZE = 200
+# ...или прошло столько секунд с предыдущего сброса
+INTERACTION_FLUSH_INTERVAL = 2.0
+# Больше событий в памяти не держим: новые отбрасываются и учитываются в dropped
+INTERACTION_BUFFER_LIMIT = 50000
+
+_INSERT_INTERACTION_SQL = '''
+    INSERT INTO bot_interactions (user_id, username, interaction_type, interaction_data, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+
+class _InteractionBuffer:
+    """Копит события bot_interactions в памяти и пишет их пачками в одной транзакции"""
+
+    def __init__(self):
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.dropped = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+
+    def add(self, row: tuple):
+        with self._lock:
+            if len(self._rows) >= INTERACTION_BUFFER_LIMIT:
+                self.dropped += 1
+                return
+            self._rows.append(row)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='interaction-log', daemon=True
+                )
+                self._thread.start()
+            if len(self._rows) >= INTERACTION_FLUSH_SIZE:
+                self._wakeup.set()
+
+    def flush(self) -> int:
+        """Записывает накопленные события. Возвращает количество записанных строк."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+
+            try:
+                with transaction() as conn:
+                    conn.executemany(_INSERT_INTERACTION_SQL, rows)
+            except sqlite3.Error:
+                # Возвращаем события в начало очереди, чтобы не потерять их
+                with self._lock:
+                    self.failed_flushes += 1
+                    keep = max(0, INTERACTION_BUFFER_LIMIT - len(self._rows))
+                    self.dropped += max(0, len(rows) - keep)
+                    self._rows[:0] = rows[:keep]
+                raise
+
+            with self._lock:
+                self.flushed += len(rows)
+            return len(rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue_depth': len(self._rows),
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'failed_flushes': self.failed_flushes,
+            }
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(INTERACTION_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing interaction log: {e}", exc_info=True)
+
+
+_interaction_buffer = _InteractionBuffer()
 
-    return result[0] if result else 0
 
+def log_interaction(user_id: int, interaction_type: str, interaction_data: str = None, username: str = None):
+    """Логирует взаимодействие пользователя с ботом (запись в базу — пачками в фоне)"""
+    _interaction_buffer.add(
+        (user_id, username, interaction_type, interaction_data, datetime.now().isoformat())
+    )
 
-def get_first_use_date(user_id: int) -> str:
-    """Получает дату первого использования бота"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT MIN(date) FROM pills_taken
-        WHERE user_id = ?
-    ''', (user_id,))
+def flush_interactions() -> int:
+    """Немедленно записывает в базу все накопленные взаимодействия"""
+    return _interaction_buffer.flush()
 
-    result = cursor.fetchone()
-    conn.close()
 
-    return result[0] if result and result[0] else None
+def get_interaction_log_stats() -> dict:
+    """Метрики буфера: queue_depth, dropped, flushed, failed_flushes"""
+    return _interaction_buffer.stats()
 
 
-def log_interaction(user_id: int, interaction_type: str, interaction_data: str = None, username: str = None):
-    """Логирует взаимодействие пользователя с ботом"""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+def _flush_interactions_at_exit():
+    try:
+        flush_interactions()
+    except Exception as e:
+        logger.error(f"Error flushing interaction log at exit: {e}", exc_info=True)
 
-    cursor.execute('''
-        INSERT INTO bot_interactions (user_id, username, interaction_type, interaction_data, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, interaction_type, interaction_data, datetime.now().isoformat()))
 
-    conn.commit()
-    conn.close()
+atexit.register(_flush_interactions_at_exit)
 
 
 # --- Голосовые памятки ---
 
 def add_voice_memo(file_id: str) -> int:
     """Сохраняет голосовую памятку (file_id Telegram). Возвращает id записи."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    with transaction() as conn:
+        cursor = conn.execute('''
+            INSERT INTO voice_memos (file_id, created_at)
+            VALUES (?, ?)
+        ''', (file_id, datetime.now().isoformat()))
 
-    cursor.execute('''
-        INSERT INTO voice_memos (file_id, created_at)
-        VALUES (?, ?)
-    ''', (file_id, datetime.now().isoformat()))
+        return cursor.lastrowid
 
-    memo_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
 
-    return memo_id
+_NEXT_VOICE_MEMO_SQL = '''
+    SELECT id, file_id, created_at FROM voice_memos
+    WHERE id > ?
+    ORDER BY id ASC
+    LIMIT 1
+'''
 
 
 def get_next_voice_memo_for_user(user_id: int):
     """Берет следующую (самую раннюю) памятку, которую пользователь еще не получал."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT vm.id, vm.file_id, vm.created_at
-        FROM voice_memos vm
-        LEFT JOIN voice_deliveries vd
-               ON vd.memo_id = vm.id AND vd.user_id = ?
-        WHERE vd.memo_id IS NULL
-        ORDER BY vm.id ASC
-        LIMIT 1
-    ''', (user_id,))
-
-    row = cursor.fetchone()
-    conn.close()
-    return row
+    # Удаленные памятки просто пропускаются: ищем первую с id больше курсора
+    with connection() as conn:
+        return conn.execute('''
+            SELECT id, file_id, created_at
+            FROM voice_memos
+            WHERE id > COALESCE((SELECT last_memo_id FROM voice_memo_cursor WHERE user_id = ?), 0)
+            ORDER BY id ASC
+            LIMIT 1
+        ''', (user_id,)).fetchone()
+
+
+def get_voice_memo_after(memo_id: int):
+    """Первая памятка с id больше memo_id (или None)"""
+    with connection() as conn:
+        return conn.execute(_NEXT_VOICE_MEMO_SQL, (memo_id,)).fetchone()
+
+
+def get_voice_memo_state(user_id: int):
+    """Возвращает (id последней выданной памятки или 0, получал ли памятку сегодня) одним запросом."""
+    with connection() as conn:
+        today = _user_today(conn, user_id)
+        return conn.execute('''
+            SELECT COALESCE((SELECT last_memo_id FROM voice_memo_cursor WHERE user_id = ?), 0),
+                   EXISTS (SELECT 1 FROM voice_memo_daily WHERE user_id = ? AND date = ?)
+        ''', (user_id, user_id, today)).fetchone()
+
+
+def get_popular_next_voice_memos(limit: int = 50):
+    """Следующие памятки для самых частых позиций курсора (включая новых пользователей).
+
+    Возвращает [(last_memo_id, строка памятки или None)] — для прогрева кэша.
+    """
+    with connection() as conn:
+        positions = [0] + [row[0] for row in conn.execute('''
+            SELECT last_memo_id FROM voice_memo_cursor
+            GROUP BY last_memo_id
+            ORDER BY COUNT(*) DESC
+            LIMIT ?
+        ''', (int(limit),))]
+        return [
+            (last_memo_id, conn.execute(_NEXT_VOICE_MEMO_SQL, (last_memo_id,)).fetchone())
+            for last_memo_id in dict.fromkeys(positions)
+        ]
 
 
 def mark_voice_memo_delivered(user_id: int, memo_id: int):
-    """Отмечает, что памятка выдана пользователю (один раз)."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT OR IGNORE INTO voice_deliveries (user_id, memo_id, delivered_at)
-        VALUES (?, ?, ?)
-    ''', (user_id, memo_id, datetime.now().isoformat()))
-
-    conn.commit()
-    conn.close()
+    """Отмечает, что памятка выдана пользователю (один раз), и сдвигает его курсор."""
+    now = datetime.now().isoformat()
+    with transaction() as conn:
+        inserted = conn.execute('''
+            INSERT OR IGNORE INTO voice_deliveries (user_id, memo_id, delivered_at)
+            VALUES (?, ?, ?)
+        ''', (user_id, memo_id, now)).rowcount
+        if not inserted:
+            return
+
+        conn.execute('''
+            INSERT INTO voice_memo_cursor (user_id, last_memo_id, delivered_count, updated_at)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_memo_id = MAX(last_memo_id, excluded.last_memo_id),
+                delivered_count = delivered_count + 1,
+                updated_at = excluded.updated_at
+        ''', (user_id, memo_id, now))
+
+
+def get_voice_memo_stats_for_user(user_id: int):
+    """Возвращает (всего памяток, выдано пользователю, осталось)."""
+    with connection() as conn:
+        row = conn.execute(
+            'SELECT last_memo_id, delivered_count FROM voice_memo_cursor WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        last_memo_id, delivered = row if row else (0, 0)
+        remaining = conn.execute(
+            'SELECT COUNT(*) FROM voice_memos WHERE id > ?', (last_memo_id,)
+        ).fetchone()[0]
+
+    return delivered + remaining, delivered, remaining
 
 
 def is_voice_memo_taken_today(user_id: int) -> bool:
     """Проверяет, получал ли пользователь памяточку сегодня (для лимита 1/день)."""
-    from datetime import date
-    today = date.today().isoformat()
-
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT 1 FROM voice_memo_daily
-        WHERE user_id = ? AND date = ?
-    ''', (user_id, today))
-
-    result = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        today = _user_today(conn, user_id)
+        result = conn.execute('''
+            SELECT 1 FROM voice_memo_daily
+            WHERE user_id = ? AND date = ?
+        ''', (user_id, today)).fetchone()
 
     return result is not None
 
 
 def mark_voice_memo_taken_today(user_id: int):
     """Отмечает, что пользователь получил памяточку сегодня (для лимита 1/день)."""
-    from datetime import date
-    today = date.today().isoformat()
+    with transaction() as conn:
+        today = _user_today(conn, user_id)
+        conn.execute('''
+            INSERT OR REPLACE INTO voice_memo_daily (user_id, date, taken_at)
+            VALUES (?, ?, ?)
+        ''', (user_id, today, datetime.now().isoformat()))
 
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO voice_memo_daily (user_id, date, taken_at)
-        VALUES (?, ?, ?)
-    ''', (user_id, today, datetime.now().isoformat()))
-
-    conn.commit()
-    conn.close()
+def record_voice_memo_delivery(user_id: int, memo_id: int, count_daily: bool = True):
+    """Выдача памятки одной транзакцией: сдвиг курсора и (если count_daily) отметка дневного лимита."""
+    with transaction():
+        mark_voice_memo_delivered(user_id, memo_id)
+        if count_daily:
+            mark_voice_memo_taken_today(user_id)
 
 
 def list_voice_memos(limit: int = 10):
     """Список последних добавленных памяток (новые сверху)."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        'SELECT id, file_id, created_at FROM voice_memos ORDER BY id DESC LIMIT ?',
-        (int(limit),)
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with connection() as conn:
+        return conn.execute(
+            'SELECT id, file_id, created_at FROM voice_memos ORDER BY id DESC LIMIT ?',
+            (int(limit),)
+        ).fetchall()
 
 
 def delete_voice_memo(memo_id: int) -> bool:
     """Удаляет памятку и все её выдачи пользователям. Возвращает True если была удалена."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    with transaction() as conn:
+        exists = conn.execute('SELECT 1 FROM voice_memos WHERE id = ?', (memo_id,)).fetchone() is not None
+        if not exists:
+            return False
+
+        # Курсоры не двигаем: следующая выдача просто перешагнет удаленный id
+        conn.execute('''
+            UPDATE voice_memo_cursor SET delivered_count = delivered_count - 1
+            WHERE user_id IN (SELECT user_id FROM voice_deliveries WHERE memo_id = ?)
+        ''', (memo_id,))
+        conn.execute('DELETE FROM voice_deliveries WHERE memo_id = ?', (memo_id,))
+        conn.execute('DELETE FROM voice_memos WHERE id = ?', (memo_id,))
 
-    cursor.execute('SELECT 1 FROM voice_memos WHERE id = ?', (memo_id,))
-    exists = cursor.fetchone() is not None
-    if not exists:
-        conn.close()
-        return False
+    return True
 
-    cursor.execute('DELETE FROM voice_deliveries WHERE memo_id = ?', (memo_id,))
-    cursor.execute('DELETE FROM voice_memos WHERE id = ?', (memo_id,))
 
-    conn.commit()
-    conn.close()
-    return True
+# --- Выгрузка для экспорта ---
+
+# Сколько строк читать из курсора за один раз при потоковой выгрузке
+EXPORT_CHUNK_SIZE = 5000
+
+
+def _iter_query(sql: str, params: tuple = ()):
+    """Потоково отдает строки запроса, читая курсор порциями"""
+    with connection() as conn:
+        cursor = conn.execute(sql, params)
+        try:
+            while True:
+                chunk = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield from chunk
+        finally:
+            cursor.close()
+
+
+def iter_pills_taken():
+    """Все отметки о принятых таблеточках (новые сверху) с настройками пользователя"""
+    return _iter_query('''
+        SELECT pt.user_id, r.username, pt.date, pt.taken_at, r.reminder_time, r.timezone
+        FROM pills_taken pt
+        LEFT JOIN reminders r ON pt.user_id = r.user_id
+        ORDER BY pt.date DESC, pt.taken_at DESC
+    ''')
+
+
+def get_all_users_data():
+    """Сводка по всем пользователям (одним запросом с группировкой, потоково).
+
+    Строки: (user_id, username, reminder_time, timezone, created_at,
+    pills_count, first_pill_date, interactions_count). Пользователь попадает в
+    выгрузку, если у него есть напоминание, отметка о таблеточке или хотя бы
+    одно взаимодействие.
+    """
+    return _iter_query('''
+        WITH pills AS (
+            SELECT user_id, COUNT(*) AS pills_count, MIN(date) AS first_date
+            FROM pills_taken
+            GROUP BY user_id
+        ),
+        interactions AS (
+            SELECT user_id, COUNT(*) AS interactions_count, MAX(username) AS username
+            FROM bot_interactions
+            GROUP BY user_id
+        ),
+        users AS (
+            SELECT user_id FROM reminders
+            UNION SELECT user_id FROM pills
+            UNION SELECT user_id FROM interactions
+        )
+        SELECT u.user_id,
+               COALESCE(r.username, i.username),
+               r.reminder_time,
+               r.timezone,
+               r.created_at,
+               COALESCE(p.pills_count, 0),
+               p.first_date,
+               COALESCE(i.interactions_count, 0)
+        FROM users u
+        LEFT JOIN reminders r ON r.user_id = u.user_id
+        LEFT JOIN pills p ON p.user_id = u.user_id
+        LEFT JOIN interactions i ON i.user_id = u.user_id
+        ORDER BY u.user_id
+    ''')
+
+
+def get_all_interactions():
+    """Вся история взаимодействий (новые сверху, потоково) с текущими настройками пользователя.
+
+    Строки: (id, user_id, username, interaction_type, interaction_data,
+    timestamp, reminder_time, timezone).
+    """
+    return _iter_query('''
+        SELECT bi.id, bi.user_id, bi.username, bi.interaction_type, bi.interaction_data,
+               bi.timestamp, r.reminder_time, r.timezone
+        FROM bot_interactions bi
+        LEFT JOIN reminders r ON r.user_id = bi.user_id
+        ORDER BY bi.id DESC
+    ''')
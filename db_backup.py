@@ -0,0 +1,607 @@
+"""
+Резервные копии базы для /db_backup и /db_restore.
+
+Копия снимается через online backup API SQLite, а не чтением файла: бот
+продолжает писать во время копирования, и сырой файл (плюс -wal) может
+оказаться несогласованным. Источник держит читающую транзакцию, поэтому
+копируется один снимок, а WAL не мешает писателю работать. Копирование идет
+порциями страниц, после чего снимок сжимается потоково в .db.gz.
+
+Полная копия начинает цепочку. Дельта (create_delta) — это сжатые JSON-строки
+со строками, измененными после предыдущей копии цепочки: триггеры пишут
+в change_journal, какие строки менялись, bot_interactions берется по id.
+Восстановление: полная копия откладывается в отдельный файл (stage_restore),
+на него по порядку ложатся дельты (apply_delta), и только потом рабочая база
+один раз подменяется итоговым файлом без перезапуска бота (hot_restore).
+Пока бот работает, дельты на рабочую базу не накладываются: они перезаписали
+бы по rowid строки, появившиеся после копии. Журнал чистят commit_backup и
+commit_delta; если копий долго не снимали, trim_journal сбрасывает цепочку,
+и следующей должна быть полная копия. Загруженный файл принимается
+потоково (receive_upload): распаковка, контрольная сумма и проверка
+заголовка идут по мере скачивания, плохой файл отбрасывается по первым байтам.
+
+Все функции синхронные и долгие — вызывать через asyncio.to_thread.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import httpx
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при сжатии, распаковке и скачивании
+CHUNK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+# Заголовок SQLite занимает первые 100 байт файла
+SQLITE_HEADER_SIZE = 100
+DELTA_FORMAT = 'pillow-delta'
+DELTA_VERSION = 1
+DELTA_PREFIX = b'{"format": "pillow-delta"'
+# Таймаут чтения при скачивании загруженного файла (секунды)
+DOWNLOAD_TIMEOUT = 300
+
+
+# Без этих таблиц файл — не база бота
+REQUIRED_TABLES = ('reminders', 'pills_taken')
+
+
+class ChainError(Exception):
+    """Дельта не продолжает состояние базы (другая цепочка, пропуск, другая схема)"""
+
+
+class RestoreError(Exception):
+    """Загруженная база не прошла проверку"""
+
+
+def _temp_path(suffix: str) -> str:
+    """Временный файл рядом с базой (на том же диске, чтобы os.replace был атомарным)"""
+    directory = os.path.dirname(os.path.abspath(database.DATABASE_NAME))
+    fd, path = tempfile.mkstemp(prefix='.pillow-backup-', suffix=suffix, dir=directory)
+    os.close(fd)
+    return path
+
+
+class _HashingWriter:
+    """Файл для записи, который по ходу считает sha256 и размер записанного"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def remove(path: str):
+    """Удаляет временный файл копии, если он есть"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _journal_position(conn: sqlite3.Connection) -> tuple:
+    """(последний seq журнала, последний id bot_interactions) в текущем снимке conn"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+    seq = row[0] if row else 0
+    interaction_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM bot_interactions').fetchone()[0]
+    return seq, interaction_id
+
+
+def _get_state(conn: sqlite3.Connection):
+    row = conn.execute(
+        'SELECT chain_id, seq, interaction_id, delta_number FROM backup_state WHERE id = 1'
+    ).fetchone()
+    if row is None:
+        return None
+    return {'chain_id': row[0], 'seq': row[1], 'interaction_id': row[2], 'delta_number': row[3]}
+
+
+def _save_state(conn: sqlite3.Connection, chain_id: str, seq: int, interaction_id: int, delta_number: int):
+    conn.execute('''
+        INSERT OR REPLACE INTO backup_state (id, chain_id, seq, interaction_id, delta_number, updated_at)
+        VALUES (1, ?, ?, ?, ?, ?)
+    ''', (chain_id, seq, interaction_id, delta_number, datetime.now().isoformat()))
+
+
+def snapshot(dest_path: str, pages: int = None) -> dict:
+    """Копирует согласованный снимок базы в dest_path и начинает в копии новую цепочку.
+
+    Возвращает состояние цепочки; в рабочей базе его фиксирует commit_backup.
+    """
+    pages = pages or config.BACKUP_PAGES_PER_STEP
+    dst = sqlite3.connect(dest_path, isolation_level=None)
+    try:
+        # Отдельное соединение: потоковые соединения database.py заняты запросами бота.
+        # shared_access — чтобы файл не подменили посреди копирования.
+        with database.shared_access():
+            src = sqlite3.connect(database.DATABASE_NAME, timeout=database.BUSY_TIMEOUT, isolation_level=None)
+            try:
+                # Читающая транзакция фиксирует снимок: записи бота идут в WAL и не перезапускают копирование
+                src.execute('BEGIN')
+                seq, interaction_id = _journal_position(src)
+                src.backup(dst, pages=pages)
+                src.execute('COMMIT')
+            finally:
+                src.close()
+
+        chain = {'chain_id': uuid.uuid4().hex[:12], 'seq': seq, 'interaction_id': interaction_id, 'delta_number': 0}
+        dst.execute('BEGIN')
+        # Журнал до снимка в копии не нужен: дельты считаются от seq
+        dst.execute('DELETE FROM change_journal')
+        _save_state(dst, **chain)
+        dst.execute('COMMIT')
+        # Копия отправляется одним файлом, без -wal
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        dst.close()
+    return chain
+
+
+def compress(src_path: str, dest_path: str, level: int = None) -> str:
+    """Потоково сжимает файл в gzip, возвращает sha256 сжатого файла"""
+    level = config.BACKUP_COMPRESS_LEVEL if level is None else level
+    with open(src_path, 'rb') as src, _HashingWriter(dest_path) as out:
+        with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    return out.sha256.hexdigest()
+
+
+def create_backup() -> dict:
+    """Снимает копию базы и сжимает ее.
+
+    Возвращает {'path': .db.gz во временном файле, 'raw_size', 'size', 'sha256',
+    'elapsed', 'chain': состояние цепочки для commit_backup}. Временный файл
+    удаляет вызывающий.
+    """
+    started = time.monotonic()
+    raw_path = _temp_path('.db')
+    gz_path = _temp_path('.db.gz')
+    try:
+        chain = snapshot(raw_path)
+        raw_size = os.path.getsize(raw_path)
+        sha256 = compress(raw_path, gz_path)
+    except BaseException:
+        remove(gz_path)
+        raise
+    finally:
+        remove(raw_path)
+
+    elapsed = time.monotonic() - started
+    size = os.path.getsize(gz_path)
+    logger.info(f"Backup created: {raw_size} bytes -> {size} bytes in {elapsed:.2f}s, sha256 {sha256}")
+    return {'path': gz_path, 'raw_size': raw_size, 'size': size, 'sha256': sha256, 'elapsed': elapsed, 'chain': chain}
+
+
+def commit_backup(chain: dict):
+    """Фиксирует в рабочей базе начало цепочки после успешной отправки полной копии"""
+    with database.transaction() as conn:
+        state = _get_state(conn)
+        # trim_journal после снимка удалил и изменения, которых в копии нет
+        if state is not None and not state['chain_id'] and state['seq'] > chain['seq']:
+            raise ChainError("Журнал изменений сброшен, пока отправлялась копия: сними ее заново (/db_backup)")
+        _save_state(conn, **chain)
+        conn.execute('DELETE FROM change_journal WHERE seq <= ?', (chain['seq'],))
+
+
+def trim_journal(max_rows: int) -> int:
+    """Сбрасывает цепочку копий, если в журнале изменений больше max_rows строк.
+
+    Без /db_backup журнал рос бы вместе со всеми таблицами. Сброс помечается
+    в backup_state пустым chain_id и seq, по которому commit_backup узнает
+    копию, снятую до сброса. Возвращает число удаленных строк журнала.
+    """
+    with database.transaction() as conn:
+        low, high = conn.execute('SELECT MIN(seq), MAX(seq) FROM change_journal').fetchone()
+        # Разброс seq не меньше числа строк: считаем строки, только когда он велик
+        if low is None or high - low < max_rows:
+            return 0
+        if conn.execute('SELECT COUNT(*) FROM change_journal').fetchone()[0] <= max_rows:
+            return 0
+        seq, interaction_id = _journal_position(conn)
+        removed = conn.execute('DELETE FROM change_journal').rowcount
+        _save_state(conn, '', seq, interaction_id, 0)
+    logger.warning(f"Change journal exceeded {max_rows} rows without backups: removed {removed} rows, chain reset")
+    return removed
+
+
+def get_chain_state():
+    """Состояние цепочки копий рабочей базы или None, если полной копии еще не было"""
+    with database.connection() as conn:
+        return _get_state(conn)
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> list:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def create_delta() -> tuple:
+    """Собирает изменения с последней копии цепочки в сжатый файл дельты.
+
+    Возвращает (путь к файлу во временном файле, заголовок дельты плюс 'rows'
+    и 'sha256'); после успешной отправки вызывающий фиксирует ее через commit_delta.
+    """
+    with database.shared_access():
+        return _create_delta()
+
+
+def _create_delta() -> tuple:
+    started = time.monotonic()
+    src = sqlite3.connect(database.DATABASE_NAME, timeout=database.BUSY_TIMEOUT, isolation_level=None)
+    path = _temp_path('.delta.gz')
+    rows = 0
+    try:
+        src.execute('BEGIN')
+        state = _get_state(src)
+        if state is None:
+            raise ChainError("Полной копии еще не было: сначала /db_backup")
+        if not state['chain_id']:
+            raise ChainError("Цепочка копий сброшена: журнал изменений перерос лимит, сначала /db_backup")
+        to_seq, to_interaction = _journal_position(src)
+        tables = [row[0] for row in src.execute(
+            'SELECT DISTINCT table_name FROM change_journal WHERE seq > ? AND seq <= ?', (state['seq'], to_seq)
+        )]
+        header = {
+            'format': DELTA_FORMAT,
+            'version': DELTA_VERSION,
+            'schema_version': database.get_schema_version(src),
+            'chain_id': state['chain_id'],
+            'delta_number': state['delta_number'] + 1,
+            'from_seq': state['seq'],
+            'to_seq': to_seq,
+            'from_interaction_id': state['interaction_id'],
+            'to_interaction_id': to_interaction,
+            'columns': {table: _columns(src, table) for table in tables + ['bot_interactions']},
+            'created_at': datetime.now().isoformat(),
+        }
+
+        with _HashingWriter(path) as raw, \
+                gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=config.BACKUP_COMPRESS_LEVEL) as gz, \
+                io.TextIOWrapper(gz, encoding='utf-8') as out:
+            out.write(json.dumps(header, ensure_ascii=False) + '\n')
+            # Строка есть — [таблица, rowid, значения]; строки нет (удалена) — [таблица, rowid]
+            for table in tables:
+                cursor = src.execute(f'''
+                    SELECT j.row_id, t.rowid IS NOT NULL, t.*
+                    FROM change_journal j LEFT JOIN {table} t ON t.rowid = j.row_id
+                    WHERE j.table_name = ? AND j.seq > ? AND j.seq <= ?
+                ''', (table, state['seq'], to_seq))
+                for row_id, present, *values in cursor:
+                    record = [table, row_id, values] if present else [table, row_id]
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    rows += 1
+            cursor = src.execute(
+                'SELECT rowid, * FROM bot_interactions WHERE id > ? AND id <= ?',
+                (state['interaction_id'], to_interaction)
+            )
+            for row_id, *values in cursor:
+                out.write(json.dumps(['bot_interactions', row_id, values], ensure_ascii=False) + '\n')
+                rows += 1
+        src.execute('COMMIT')
+    except BaseException:
+        remove(path)
+        raise
+    finally:
+        src.close()
+
+    header['rows'] = rows
+    header['sha256'] = raw.sha256.hexdigest()
+    logger.info(
+        f"Delta {header['delta_number']} of chain {header['chain_id']}: {rows} rows, "
+        f"{os.path.getsize(path)} bytes in {time.monotonic() - started:.2f}s"
+    )
+    return path, header
+
+
+def commit_delta(header: dict):
+    """Продвигает цепочку рабочей базы после успешной отправки дельты"""
+    with database.transaction() as conn:
+        state = _get_state(conn)
+        # Пока дельта отправлялась, могли снять новую полную копию или другую дельту
+        if state is None or state['chain_id'] != header['chain_id'] or state['seq'] != header['from_seq']:
+            raise ChainError("Цепочка копий изменилась во время отправки дельты")
+        _save_state(conn, header['chain_id'], header['to_seq'], header['to_interaction_id'], header['delta_number'])
+        conn.execute('DELETE FROM change_journal WHERE seq <= ?', (header['to_seq'],))
+
+
+def apply_delta(db_path: str, delta_path: str) -> dict:
+    """Применяет распакованную дельту к файлу базы db_path одной транзакцией, возвращает ее заголовок.
+
+    db_path — восстанавливаемая копия до подмены, а не рабочая база: дельта
+    ложится только на копию, в которую ничего не писали после ее снятия.
+    """
+    # Напоминания из дельты сняты в прошлом: их расписание сверяется с текущим, как при подмене файла
+    with open(delta_path, encoding='utf-8') as f:
+        f.readline()
+        touched = {json.loads(line)[1] for line in f if line.startswith('["reminders",')}
+
+    conn = sqlite3.connect(db_path, timeout=database.BUSY_TIMEOUT, isolation_level=None)
+    try:
+        with open(delta_path, encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _apply_delta(conn, header, f, touched)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
+    return header
+
+
+def _apply_delta(conn: sqlite3.Connection, header: dict, lines, touched: set):
+    state = _get_state(conn)
+    if header.get('version') != DELTA_VERSION:
+        raise ChainError(f"Неизвестная версия дельты: {header.get('version')}")
+    if header['schema_version'] != database.get_schema_version(conn):
+        raise ChainError("Дельта снята с другой версией схемы базы")
+    if state is None or state['chain_id'] != header['chain_id']:
+        raise ChainError("Дельта из другой цепочки: сначала восстанови ее полную копию")
+    if (state['seq'], state['interaction_id']) != (header['from_seq'], header['from_interaction_id']):
+        raise ChainError(
+            f"Дельта {header['delta_number']} не следует за текущим состоянием "
+            f"(применено дельт: {state['delta_number']})"
+        )
+    # Строки, записанные после копии, дельта перезаписала бы по rowid
+    seq_before, interaction_before = _journal_position(conn)
+    written = conn.execute('SELECT 1 FROM change_journal WHERE seq > ? LIMIT 1', (state['seq'],)).fetchone()
+    if written or interaction_before > state['interaction_id']:
+        raise ChainError("В базу писали после снятия копии: дельты применяются только до подмены базы")
+
+    # Имена таблиц и колонок из файла подставляются в SQL — сверяем их со схемой
+    statements = {}
+    for table, columns in header['columns'].items():
+        if _columns(conn, table) != columns:
+            raise ChainError(f"Колонки таблицы {table} не совпадают со схемой базы")
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        # Журнал взаимодействий только дописывается: занятый id — ошибка, а не замена
+        verb = 'INSERT' if table == 'bot_interactions' else 'INSERT OR REPLACE'
+        statements[table] = (
+            f"{verb} INTO {table} (rowid, {', '.join(columns)}) VALUES ({placeholders})",
+            f"DELETE FROM {table} WHERE rowid = ?",
+        )
+
+    previous = database.get_reminder_schedule(conn, touched)
+    try:
+        for line in lines:
+            table, row_id, *values = json.loads(line)
+            upsert, delete = statements[table]
+            if values:
+                conn.execute(upsert, [row_id, *values[0]])
+            else:
+                conn.execute(delete, (row_id,))
+    except sqlite3.IntegrityError as e:
+        raise ChainError(f"Дельта конфликтует с данными базы: {e}")
+    database.reconcile_reminders(conn, previous, int(time.time()), touched)
+
+    # Триггеры записали в журнал сам повтор — удаляем только эти строки;
+    # следующие изменения должны получить seq после to_seq
+    conn.execute('DELETE FROM change_journal WHERE seq > ?', (seq_before,))
+    conn.execute(
+        "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'change_journal'", (header['to_seq'],)
+    )
+    conn.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'change_journal', ? "
+        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'change_journal')",
+        (header['to_seq'],)
+    )
+    _save_state(conn, header['chain_id'], header['to_seq'], header['to_interaction_id'], header['delta_number'])
+
+
+def validate_database(path: str) -> int:
+    """Проверяет загруженную базу (целостность, версия схемы, таблицы бота), возвращает версию схемы"""
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+            if problems != ['ok']:
+                raise RestoreError("integrity_check: " + '; '.join(problems[:5]))
+
+            version = database.get_schema_version(conn)
+            if version > database.SCHEMA_VERSION:
+                raise RestoreError(
+                    f"Версия схемы {version} новее поддерживаемой ботом ({database.SCHEMA_VERSION})"
+                )
+
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = [table for table in REQUIRED_TABLES if table not in tables]
+            if missing:
+                raise RestoreError(f"В базе нет таблиц: {', '.join(missing)}")
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        raise RestoreError(f"Файл не читается как SQLite: {e}")
+    return version
+
+
+def stage_restore(upload_path: str, staged_path: str) -> int:
+    """Проверяет загруженную полную копию и переносит ее в staged_path, возвращает версию схемы.
+
+    Рабочая база не трогается: сначала на копию ложатся дельты (apply_delta),
+    потом hot_restore подменяет базу один раз, уже итоговым состоянием.
+    """
+    version = validate_database(upload_path)
+    database.upgrade_database_file(upload_path)
+    os.replace(upload_path, staged_path)
+    return version
+
+
+def hot_restore(staged_path: str) -> dict:
+    """Подменяет рабочую базу подготовленной копией, не останавливая бота.
+
+    Копия с примененными дельтами еще раз проверяется до подмены; запросы бота
+    ждут только саму подмену. Возвращает статистику swap_database плюс
+    'backup_path' и 'total'.
+    """
+    started = time.monotonic()
+    validate_database(staged_path)
+    database.upgrade_database_file(staged_path)
+
+    ts = datetime.now().strftime('%Y%m%d-%H%M%S')
+    backup_path = f"{database.DATABASE_NAME}.backup-{ts}.db"
+    result = database.swap_database(staged_path, backup_path)
+    result.update(backup_path=backup_path, total=time.monotonic() - started)
+    return result
+
+
+class RestoreUpload:
+    """Принимает загруженный файл кусками и пишет в dest_path распакованное содержимое.
+
+    По ходу считает sha256 полученных байт, распаковывает gzip и по первым
+    100 байтам распакованного определяет вид файла: 'database' (заголовок
+    SQLite с допустимым размером страницы) или 'delta'. Все проверки бросают
+    RestoreError сразу, не дожидаясь конца файла.
+    """
+
+    def __init__(self, dest_path: str, max_received: int, max_size: int):
+        self.dest_path = dest_path
+        self.max_received = max_received
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.received = 0
+        self.size = 0
+        self.compressed = None
+        self.kind = None
+        self.page_size = None
+        self._pending = b''
+        self._head = b''
+        self._decompressor = None
+        self._file = open(dest_path, 'wb')
+
+    def write(self, chunk: bytes):
+        self.received += len(chunk)
+        if self.received > self.max_received:
+            raise RestoreError("Файл больше допустимого размера")
+        self.sha256.update(chunk)
+
+        if self.compressed is None:
+            self._pending += chunk
+            if len(self._pending) < len(GZIP_MAGIC):
+                return
+            chunk, self._pending = self._pending, b''
+            self.compressed = chunk.startswith(GZIP_MAGIC)
+            if self.compressed:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if not self.compressed:
+            self._output(chunk)
+            return
+        try:
+            # Ограничиваем выход каждого шага, чтобы «gzip-бомба» не заняла память
+            self._output(self._decompressor.decompress(chunk, CHUNK_SIZE))
+            while self._decompressor.unconsumed_tail:
+                self._output(self._decompressor.decompress(self._decompressor.unconsumed_tail, CHUNK_SIZE))
+        except zlib.error as e:
+            raise RestoreError(f"Файл не распаковывается: {e}")
+
+    def _output(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RestoreError("Распакованный файл больше допустимого размера")
+
+        if self.kind is None:
+            self._head += data
+            if len(self._head) < SQLITE_HEADER_SIZE:
+                return
+            self._detect()
+            data, self._head = self._head, b''
+        self._file.write(data)
+
+    def _detect(self):
+        head = self._head
+        if head.startswith(SQLITE_MAGIC):
+            page_size = int.from_bytes(head[16:18], 'big')
+            page_size = 65536 if page_size == 1 else page_size
+            if page_size < 512 or page_size & (page_size - 1):
+                raise RestoreError(f"Недопустимый размер страницы SQLite: {page_size}")
+            self.kind, self.page_size = 'database', page_size
+        elif head.startswith(DELTA_PREFIX):
+            self.kind = 'delta'
+        else:
+            raise RestoreError("Файл не похож ни на базу SQLite, ни на дельту из /db_delta")
+
+    def finish(self):
+        """Дописывает хвост и проверяет, что файл пришел целиком"""
+        if self._pending:
+            self.compressed = False
+            self._output(self._pending)
+        if self.compressed:
+            try:
+                self._output(self._decompressor.flush())
+            except zlib.error as e:
+                raise RestoreError(f"Файл не распаковывается: {e}")
+            if not self._decompressor.eof:
+                raise RestoreError("Сжатый файл обрезан")
+        if self.kind is None:
+            raise RestoreError("Файл слишком короткий")
+        if self.kind == 'database' and self.size % self.page_size:
+            raise RestoreError("Размер базы не кратен размеру страницы — файл обрезан")
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        remove(self.dest_path)
+
+    @property
+    def checksum(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def receive_upload(source: str, dest_path: str, max_received: int, max_size: int) -> RestoreUpload:
+    """Скачивает загруженный в Telegram файл кусками в RestoreUpload.
+
+    source — ссылка на файл из getFile или локальный путь (локальный Bot API сервер).
+    """
+    upload = RestoreUpload(dest_path, max_received, max_size)
+    try:
+        if source.startswith(('http://', 'https://')):
+            timeout = httpx.Timeout(DOWNLOAD_TIMEOUT, connect=10)
+            with httpx.Client(timeout=timeout) as client, client.stream('GET', source) as response:
+                response.raise_for_status()
+                if int(response.headers.get('content-length') or 0) > max_received:
+                    raise RestoreError("Файл больше допустимого размера")
+                for chunk in response.iter_bytes(CHUNK_SIZE):
+                    upload.write(chunk)
+        else:
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    upload.write(chunk)
+        upload.finish()
+    except BaseException:
+        upload.abort()
+        raise
+    return upload
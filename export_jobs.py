@@ -0,0 +1,172 @@
+"""
+Фоновый экспорт в Excel.
+
+Экспорт выполняется в отдельном процессе (пул процессов), чтобы не
+останавливать event loop бота: напоминания и кнопки продолжают работать,
+пока собирается книга. Процесс сообщает о прогрессе через очередь, а
+отмена передается через событие, которое проверяется между порциями строк.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import async_database
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять прогресс дочернего процесса (секунды)
+PROGRESS_POLL_INTERVAL = 0.5
+
+
+class ExportCancelled(Exception):
+    """Экспорт отменен пользователем"""
+
+
+class ExportBusy(Exception):
+    """У пользователя уже идет максимально допустимое число экспортов"""
+
+
+class _Export:
+    __slots__ = ('user_id', 'cancel_event', 'progress_queue')
+
+    def __init__(self, user_id: int, cancel_event, progress_queue):
+        self.user_id = user_id
+        self.cancel_event = cancel_event
+        self.progress_queue = progress_queue
+
+
+_executor = None
+_manager = None
+# _get_executor вызывается через asyncio.to_thread: два первых /export не должны создать два пула
+_executor_lock = threading.Lock()
+_running = {}  # user_id -> [_Export]
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor, _manager
+    with _executor_lock:
+        if _executor is None:
+            # spawn: дочерний процесс не наследует соединения и потоки бота
+            context = multiprocessing.get_context('spawn')
+            _manager = context.Manager()
+            _executor = ProcessPoolExecutor(max_workers=config.EXPORT_WORKERS, mp_context=context)
+        return _executor
+
+
+def _export_in_process(filename: str, db_path: str, progress_queue, cancel_event) -> str:
+    """Выполняется в дочернем процессе"""
+    import excel_export
+    database.DATABASE_NAME = db_path
+
+    def progress(sheet_title, rows_written, done):
+        if cancel_event.is_set():
+            raise ExportCancelled()
+        progress_queue.put((sheet_title, rows_written, done))
+
+    try:
+        return excel_export.export_to_excel(filename, progress=progress)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        # Процесс пула живет дольше экспорта: открытое соединение держало бы файл
+        # базы, который может быть подменен восстановлением (db_backup.hot_restore)
+        database.close_connections()
+
+
+def _drain(progress_queue) -> list:
+    events = []
+    while True:
+        try:
+            events.append(progress_queue.get_nowait())
+        except queue.Empty:
+            return events
+
+
+def running_count() -> int:
+    """Сколько экспортов выполняется сейчас"""
+    return sum(len(exports) for exports in _running.values())
+
+
+def can_start(user_id: int) -> bool:
+    """Можно ли пользователю запустить еще один экспорт"""
+    return len(_running.get(user_id, ())) < config.EXPORT_MAX_PER_USER
+
+
+def cancel_export(user_id: int) -> bool:
+    """Отменяет все экспорты пользователя. Возвращает True если было что отменять."""
+    exports = _running.get(user_id)
+    if not exports:
+        return False
+    for export in exports:
+        if export.cancel_event is not None:
+            export.cancel_event.set()
+    return True
+
+
+async def run_export(user_id: int, filename: str, on_progress=None) -> str:
+    """Собирает книгу в отдельном процессе и возвращает имя файла.
+
+    on_progress(sheet_title, rows_written, done) — корутина, вызывается в event loop.
+    Бросает ExportBusy при превышении лимита и ExportCancelled при отмене.
+    """
+    if not can_start(user_id):
+        raise ExportBusy()
+    # Регистрируемся до первого await, чтобы лимит нельзя было обойти параллельными командами
+    export = _Export(user_id, None, None)
+    exports = _running.setdefault(user_id, [])
+    exports.append(export)
+    try:
+        # Запуск пула и менеджера — блокирующие операции, уводим их из event loop
+        executor = await asyncio.to_thread(_get_executor)
+        export.cancel_event, export.progress_queue = await asyncio.to_thread(
+            lambda: (_manager.Event(), _manager.Queue())
+        )
+
+        # События из буфера логов должны попасть в файл
+        await async_database.flush_interactions()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            executor, _export_in_process,
+            filename, database.DATABASE_NAME, export.progress_queue, export.cancel_event
+        )
+
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=PROGRESS_POLL_INTERVAL)
+            events = await asyncio.to_thread(_drain, export.progress_queue)
+            if on_progress is not None:
+                for event in events:
+                    try:
+                        await on_progress(*event)
+                    except Exception as e:
+                        logger.warning(f"Error reporting export progress: {e}")
+            if done:
+                return future.result()
+    finally:
+        exports.remove(export)
+        if not exports:
+            _running.pop(user_id, None)
+
+
+def shutdown():
+    """Останавливает пул процессов экспорта"""
+    global _executor, _manager
+    with _executor_lock:
+        if _executor is not None:
+            for exports in _running.values():
+                for export in exports:
+                    if export.cancel_event is not None:
+                        export.cancel_event.set()
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        if _manager is not None:
+            _manager.shutdown()
+            _manager = None
@@ -0,0 +1,47 @@
+"""
+Локальное время пользователей.
+
+Напоминания планируются в часовом поясе пользователя, поэтому и «сегодня»
+(отметка о таблеточке, лимит памяток) считается в нем же, а не по часам
+сервера. Объекты часовых поясов pytz создаются один раз на имя.
+"""
+import functools
+import logging
+from datetime import datetime
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str):
+    """pytz-объект часового пояса (кэшируется; неизвестное имя — UnknownTimeZoneError)"""
+    return pytz.timezone(name)
+
+
+def _timezone_or_default(name: str):
+    try:
+        return get_timezone(name or DEFAULT_TIMEZONE)
+    except pytz.UnknownTimeZoneError:
+        logger.warning(f"Unknown timezone {name!r}, using {DEFAULT_TIMEZONE}")
+        return get_timezone(DEFAULT_TIMEZONE)
+
+
+def local_now(timezone: str, now_utc: datetime = None) -> datetime:
+    """Текущее время в часовом поясе timezone"""
+    if now_utc is None:
+        now_utc = datetime.now(pytz.UTC)
+    return now_utc.astimezone(_timezone_or_default(timezone))
+
+
+def local_today(timezone: str, now_utc: datetime = None) -> str:
+    """Текущая дата (YYYY-MM-DD) в часовом поясе timezone"""
+    return local_now(timezone, now_utc).date().isoformat()
+
+
+def local_date_of(timestamp_utc: int, timezone: str) -> str:
+    """Дата (YYYY-MM-DD) момента Unix-времени в часовом поясе timezone"""
+    return datetime.fromtimestamp(timestamp_utc, _timezone_or_default(timezone)).date().isoformat()
@@ -0,0 +1,109 @@
+"""
+Выдача голосовых памяток.
+
+Памятка и подпись уходят одним send_voice через общую очередь отправки
+(SendQueue), так что одновременные нажатия кнопки разных пользователей
+отправляются параллельно в пределах лимитов Telegram.
+
+Все пользователи идут по одной последовательности id, поэтому следующая
+памятка после данной почти всегда уже известна: строки памяток хранятся
+в LRU по id предыдущей выданной памятки. При нажатии остается одно чтение
+состояния пользователя и одна запись выдачи.
+"""
+import functools
+import logging
+from collections import OrderedDict
+
+import async_database
+import config
+
+logger = logging.getLogger(__name__)
+
+MEMO_CAPTION = "Сладких котят, милая. Я очень сильно тебя люблю!"
+
+_MISSING = object()
+
+
+class MemoCache:
+    """LRU: id последней выданной памятки -> следующая памятка (id, file_id, created_at) или None"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, last_memo_id: int):
+        row = self._items.get(last_memo_id, _MISSING)
+        if row is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._items.move_to_end(last_memo_id)
+        return row
+
+    def put(self, last_memo_id: int, row, generation: int = None):
+        # Строка прочитана до сброса кэша (памятку добавили, пока шел запрос) — не кладем
+        if generation is not None and generation != self._generation:
+            return
+        self._items[last_memo_id] = row
+        self._items.move_to_end(last_memo_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._generation += 1
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+_cache = MemoCache(config.MEMO_CACHE_SIZE)
+
+
+def invalidate():
+    """Сбрасывает кэш (после добавления или удаления памятки, восстановления базы)"""
+    _cache.clear()
+
+
+def get_stats() -> dict:
+    return {'size': len(_cache), 'hits': _cache.hits, 'misses': _cache.misses}
+
+
+async def warm(limit: int = None):
+    """Заранее загружает следующие памятки для самых частых позиций пользователей"""
+    if limit is None:
+        limit = config.MEMO_WARM_COUNT
+    generation = _cache.generation
+    rows = await async_database.get_popular_next_voice_memos(limit)
+    for last_memo_id, row in rows:
+        _cache.put(last_memo_id, row, generation)
+    logger.info(f"Voice memo cache warmed with {len(rows)} entries")
+
+
+async def next_memo(last_memo_id: int):
+    """Следующая памятка после last_memo_id (из кэша или из базы)"""
+    row = _cache.get(last_memo_id)
+    if row is _MISSING:
+        generation = _cache.generation
+        row = await async_database.get_voice_memo_after(last_memo_id)
+        _cache.put(last_memo_id, row, generation)
+    return row
+
+
+async def deliver(bot, send_queue, user_id: int, memo, count_daily: bool = True):
+    """Отправляет памятку с подписью одним сообщением и записывает выдачу"""
+    memo_id, file_id, _created_at = memo
+    await send_queue.send(user_id, functools.partial(
+        bot.send_voice,
+        chat_id=user_id,
+        voice=file_id,
+        caption=MEMO_CAPTION
+    ))
+    await async_database.record_voice_memo_delivery(user_id, memo_id, count_daily)
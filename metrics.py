@@ -0,0 +1,172 @@
+"""
+Метрики задержек для горячих путей бота в формате Prometheus.
+
+Гистограммы задержек:
+- bot_handler_seconds{handler} — обработчики обновлений;
+- bot_db_seconds{function} — вызовы database.py через async_database;
+- bot_telegram_api_seconds{method, status} — запросы к Bot API;
+- bot_reminder_lag_seconds — насколько позже запланированного ушло напоминание.
+
+Плюс значения, которые читаются в момент выгрузки (очереди, кэши). Метрики
+общие на процесс: их пишут event loop бота и потоки базы, а читает
+Flask (/metrics в app.py) или webhook-сервер.
+"""
+import bisect
+import functools
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+# Границы корзин (секунды): от быстрых чтений из базы до медленных отправок файлов
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Задержка напоминаний измеряется секундами и минутами
+LAG_BUCKETS = (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+
+
+class Histogram:
+    """Гистограмма с метками (как prometheus_client.Histogram, но без зависимостей)"""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # метки -> [счетчики по корзинам..., +Inf], сумма
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def collect(self):
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in sorted(snapshot):
+            base = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = ','.join(base + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(base)}}}" if base else ''
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def time(self, *labels):
+        """Контекст, измеряющий длительность блока"""
+        return _Timer(self, labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_histograms = []
+_gauges = []  # (имя, описание, тип, функция без аргументов)
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    h = Histogram(name, documentation, labelnames, buckets)
+    _histograms.append(h)
+    return h
+
+
+def register_gauge(name: str, documentation: str, func, kind: str = 'gauge'):
+    """Значение, которое вычисляется при выгрузке (kind='counter' для монотонных счетчиков)"""
+    _gauges[:] = [g for g in _gauges if g[0] != name]
+    _gauges.append((name, documentation, kind, func))
+
+
+HANDLER_SECONDS = histogram('bot_handler_seconds', 'Update handler latency', ('handler',))
+DB_SECONDS = histogram('bot_db_seconds', 'Database call latency as seen by handlers', ('function',))
+TELEGRAM_API_SECONDS = histogram('bot_telegram_api_seconds', 'Telegram Bot API request latency', ('method', 'status'))
+REMINDER_LAG_SECONDS = histogram(
+    'bot_reminder_lag_seconds', 'Delay between scheduled and actual reminder delivery', buckets=LAG_BUCKETS
+)
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for h in _histograms:
+        lines.extend(h.collect())
+    for name, documentation, kind, func in _gauges:
+        try:
+            value = func()
+        except Exception:
+            continue
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# --- Инструментирование ---
+
+def _timed_callback(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with HANDLER_SECONDS.time(name):
+            return await callback(update, context)
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument_handlers(handlers):
+    """Оборачивает колбэки обработчиков замером времени.
+
+    Колбэки с атрибутом timed меряют себя сами: CallbackRouter.dispatch пишет
+    время под именем маршрута, а не одну метку на все inline-кнопки.
+    """
+    for handler in handlers:
+        callback = getattr(handler, 'callback', None)
+        if callback is None or getattr(callback, 'timed', False):
+            continue
+        handler.callback = _timed_callback(callback, getattr(callback, '__name__', 'unknown'))
+
+
+def instrument_application(application):
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, который пишет длительность каждого запроса к Bot API"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, endpoint, status)
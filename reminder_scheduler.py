@@ -0,0 +1,69 @@
+"""
+Планировщик ежедневных напоминаний.
+
+Время следующего срабатывания каждого пользователя хранится в
+reminders.next_fire_utc (с индексом). Одна повторяющаяся задача раз в
+минуту забирает из базы созревшие напоминания диапазонным запросом,
+переносит их на следующий день и отправляет пачкой. В памяти пользователи
+не хранятся, а после перезапуска планировщик продолжает с того же места.
+"""
+import logging
+import time
+
+import async_database
+
+logger = logging.getLogger(__name__)
+
+TICK_JOB_NAME = 'reminder_tick'
+TICK_INTERVAL = 60
+
+
+class ReminderScheduler:
+    """Ежеминутная задача поверх reminders.next_fire_utc.
+
+    dispatch — корутина dispatch(context, user_ids, fire_times), которая отправляет
+    напоминания пачке пользователей; fire_times — user_id -> запланированное
+    время (Unix, UTC), по нему dispatch пишет задержку каждого отправленного сообщения.
+    """
+
+    def __init__(self, dispatch, batch_size: int = 1000):
+        self._dispatch = dispatch
+        self._batch_size = batch_size
+        self._job = None
+
+    def start(self, job_queue):
+        """Запускает ежеминутную задачу (повторный вызов ничего не делает)"""
+        if self._job is not None:
+            return
+        # Выравниваем срабатывания по началу минуты
+        first = TICK_INTERVAL - time.time() % TICK_INTERVAL
+        self._job = job_queue.run_repeating(
+            self._tick,
+            interval=TICK_INTERVAL,
+            first=first,
+            name=TICK_JOB_NAME
+        )
+        logger.info(f"Reminder scheduler started, first tick in {first:.1f} seconds")
+
+    async def run_due(self, context, now_utc: int) -> int:
+        """Отправляет все напоминания с временем срабатывания <= now_utc. Возвращает их количество."""
+        total = 0
+        while True:
+            claimed = await async_database.claim_due_reminders(now_utc, self._batch_size)
+            if not claimed:
+                return total
+
+            total += len(claimed)
+            logger.info(f"Reminder tick: {len(claimed)} reminders due")
+            try:
+                await self._dispatch(context, [user_id for user_id, _ in claimed], dict(claimed))
+            except Exception as e:
+                logger.error(f"Error dispatching reminders: {e}", exc_info=True)
+
+            if len(claimed) < self._batch_size:
+                return total
+
+    async def _tick(self, context):
+        # Секунда запаса на случай, если задача сработала чуть раньше границы минуты
+        now_utc = int(time.time() + 1) // 60 * 60
+        await self.run_due(context, now_utc)
@@ -0,0 +1,227 @@
+"""
+Очередь отправки сообщений с ограничением скорости.
+
+Telegram допускает около 30 сообщений в секунду на бота и примерно одно
+сообщение в секунду в один чат; при превышении приходит 429 (RetryAfter).
+Все массовые и пользовательские отправки идут через SendQueue: общий
+token bucket, token bucket на чат, несколько воркеров и повтор после
+RetryAfter / сетевых ошибок.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до следующего токена (0 — можно отправлять сразу)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class DeliveryReport:
+    """Итог отправки одной пачки"""
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    duration: float = 0.0
+    errors: dict = field(default_factory=dict)  # chat_id -> текст ошибки
+
+    def __str__(self):
+        return (f"total={self.total} sent={self.sent} failed={self.failed} "
+                f"blocked={self.blocked} retries={self.retries} duration={self.duration:.1f}s")
+
+
+class _Item:
+    __slots__ = ('chat_id', 'send', 'future', 'attempt')
+
+    def __init__(self, chat_id: int, send, future):
+        self.chat_id = chat_id
+        self.send = send
+        self.future = future
+        self.attempt = 0
+
+
+def _seconds(value) -> float:
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class SendQueue:
+    """Очередь отправки: send — корутинная фабрика без аргументов, например
+    functools.partial(bot.send_message, chat_id=..., text=...)."""
+
+    def __init__(self, rate: float = 30, per_chat_rate: float = 1, per_chat_burst: int = 3,
+                 workers: int = 8, max_retries: int = 3):
+        self._bucket = TokenBucket(rate, rate)
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._chat_buckets = {}
+        self._workers_count = workers
+        self._max_retries = max_retries
+        self._queue = None
+        self._workers = []
+        self._paused_until = 0.0
+        self._retries = 0
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f'send-queue-{i}')
+            for i in range(self._workers_count)
+        ]
+
+    async def send(self, chat_id: int, send):
+        """Отправляет одно сообщение через очередь. Возвращает результат или бросает последнюю ошибку."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Item(chat_id, send, future))
+        return await future
+
+    async def send_batch(self, items) -> DeliveryReport:
+        """Отправляет пачку [(chat_id, send), ...] и возвращает отчет о доставке"""
+        self._ensure_started()
+        started = time.monotonic()
+        retries_before = self._retries
+        loop = asyncio.get_running_loop()
+
+        queued = []
+        for chat_id, send in items:
+            item = _Item(chat_id, send, loop.create_future())
+            queued.append(item)
+            self._queue.put_nowait(item)
+
+        report = DeliveryReport(total=len(queued))
+        results = await asyncio.gather(*(item.future for item in queued), return_exceptions=True)
+        for item, result in zip(queued, results):
+            # CancelledError — BaseException, а не Exception: отмененное при close() не отправлено
+            if not isinstance(result, BaseException):
+                report.sent += 1
+            elif isinstance(result, Forbidden):
+                report.blocked += 1
+                report.errors[item.chat_id] = str(result)
+            else:
+                report.failed += 1
+                report.errors[item.chat_id] = str(result) or type(result).__name__
+
+        # Повторы считаются по всей очереди: пачки, идущие параллельно, учитываются вместе
+        report.retries = self._retries - retries_before
+        report.duration = time.monotonic() - started
+        return report
+
+    async def _wait_turn(self, chat_id: int):
+        chat_bucket = self._chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle()}
+            chat_bucket = self._chat_buckets[chat_id] = TokenBucket(self._per_chat_rate, self._per_chat_burst)
+
+        while True:
+            pause = self._paused_until - time.monotonic()
+            delay = max(pause, self._bucket.delay(), chat_bucket.delay())
+            if delay <= 0:
+                self._bucket.take()
+                chat_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._process(item)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, item: _Item):
+        if item.future.done():
+            return
+        await self._wait_turn(item.chat_id)
+        try:
+            result = await item.send()
+        except asyncio.CancelledError:
+            # Воркер остановлен посреди отправки: отменяем и ожидание пачки, иначе оно зависнет
+            item.future.cancel()
+            raise
+        except RetryAfter as e:
+            # 429 относится ко всему боту: приостанавливаем все воркеры
+            retry_after = _seconds(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning(f"Flood limit hit sending to {item.chat_id}, pausing for {retry_after} seconds")
+            self._retry(item, e)
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или запрос некорректен — повторять бессмысленно
+            item.future.set_exception(e)
+        except (TimedOut, NetworkError) as e:
+            self._retry(item, e, backoff=2 ** item.attempt)
+        except Exception as e:
+            item.future.set_exception(e)
+        else:
+            item.future.set_result(result)
+
+    def _retry(self, item: _Item, error: Exception, backoff: float = 0.0):
+        item.attempt += 1
+        if item.attempt > self._max_retries:
+            item.future.set_exception(error)
+            return
+        self._retries += 1
+        if backoff:
+            asyncio.get_running_loop().call_later(backoff, self._requeue, item)
+        else:
+            self._requeue(item)
+
+    def _requeue(self, item: _Item):
+        if self._queue is None:
+            item.future.cancel()
+            return
+        self._queue.put_nowait(item)
+
+    async def close(self):
+        """Останавливает воркеры (неотправленные сообщения отменяются)"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if not item.future.done():
+                    item.future.cancel()
+            self._queue = None
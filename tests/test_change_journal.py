@@ -0,0 +1,51 @@
+"""trim_journal: журнал изменений не растет без /db_backup"""
+import pytest
+
+import db_backup
+
+
+def journal_rows(db) -> int:
+    with db.connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM change_journal').fetchone()[0]
+
+
+def test_trim_keeps_journal_under_limit(db):
+    for user_id in range(1, 4):
+        db.set_reminder_time(user_id, '09:00')
+    rows = journal_rows(db)
+    assert db_backup.trim_journal(rows) == 0
+    assert journal_rows(db) == rows
+
+
+def test_trim_resets_chain(db):
+    backup = db_backup.create_backup()
+    db_backup.commit_backup(backup['chain'])
+    db_backup.remove(backup['path'])
+    for user_id in range(1, 4):
+        db.set_reminder_time(user_id, '09:00')
+
+    assert db_backup.trim_journal(1) > 0
+    assert journal_rows(db) == 0
+    with pytest.raises(db_backup.ChainError):
+        db_backup.create_delta()
+
+    # Новая полная копия начинает цепочку заново
+    backup = db_backup.create_backup()
+    db_backup.commit_backup(backup['chain'])
+    db_backup.remove(backup['path'])
+    db.set_reminder_time(4, '09:00')
+    path, header = db_backup.create_delta()
+    db_backup.remove(path)
+    assert header['rows'] > 0
+
+
+def test_backup_taken_before_trim_is_not_committed(db):
+    backup = db_backup.create_backup()
+    db_backup.remove(backup['path'])
+    # Изменения после снимка, которые trim_journal удалит вместе с остальным журналом
+    for user_id in range(1, 4):
+        db.set_reminder_time(user_id, '09:00')
+    db_backup.trim_journal(1)
+
+    with pytest.raises(db_backup.ChainError):
+        db_backup.commit_backup(backup['chain'])
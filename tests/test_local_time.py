@@ -0,0 +1,75 @@
+"""«Сегодня» и время срабатывания напоминаний на границах суток и при переходах DST"""
+from datetime import datetime
+
+import pytz
+
+import database
+import local_time
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=pytz.UTC)
+
+
+def next_fire(time_str: str, timezone: str, now: datetime) -> datetime:
+    return datetime.fromtimestamp(database.compute_next_fire_utc(time_str, timezone, now), pytz.UTC)
+
+
+def test_today_moscow_vs_yekaterinburg():
+    # 19:30 UTC: в Москве еще 22:30, в Екатеринбурге (Уфа) уже 00:30 следующего дня
+    now = utc(2026, 10, 17, 19, 30)
+    assert local_time.local_today('Europe/Moscow', now) == '2026-10-17'
+    assert local_time.local_today('Asia/Yekaterinburg', now) == '2026-10-18'
+
+
+def test_today_extreme_offsets():
+    # UTC+14 и UTC-11 в один момент расходятся на две даты
+    now = utc(2026, 10, 17, 10, 30)
+    assert local_time.local_today('Pacific/Kiritimati', now) == '2026-10-18'
+    assert local_time.local_today('Pacific/Pago_Pago', now) == '2026-10-16'
+
+
+def test_date_of_timestamp_at_midnight():
+    ts = int(utc(2026, 10, 17, 19, 0).timestamp())  # ровно полночь в Екатеринбурге
+    assert local_time.local_date_of(ts, 'Asia/Yekaterinburg') == '2026-10-18'
+    assert local_time.local_date_of(ts - 1, 'Asia/Yekaterinburg') == '2026-10-17'
+    assert local_time.local_date_of(ts, 'Europe/Moscow') == '2026-10-17'
+
+
+def test_unknown_timezone_falls_back_to_default():
+    now = utc(2026, 10, 17, 21, 30)
+    assert local_time.local_today('Mars/Olympus', now) == local_time.local_today(local_time.DEFAULT_TIMEZONE, now)
+
+
+def test_next_fire_moscow_vs_yekaterinburg():
+    now = utc(2026, 10, 17, 19, 30)
+    # В Москве 09:00 еще впереди завтра утром, в Екатеринбурге «завтра» уже наступило
+    assert next_fire('09:00', 'Europe/Moscow', now) == utc(2026, 10, 18, 6, 0)
+    assert next_fire('09:00', 'Asia/Yekaterinburg', now) == utc(2026, 10, 18, 4, 0)
+
+
+def test_next_fire_extreme_offsets():
+    now = utc(2026, 10, 17, 10, 30)
+    assert next_fire('09:00', 'Pacific/Kiritimati', now) == utc(2026, 10, 17, 19, 0)
+    assert next_fire('09:00', 'Pacific/Pago_Pago', now) == utc(2026, 10, 17, 20, 0)
+
+
+def test_next_fire_exactly_at_local_midnight_is_tomorrow():
+    now = utc(2026, 10, 17, 19, 0)  # 00:00 18.10 в Екатеринбурге
+    assert next_fire('00:00', 'Asia/Yekaterinburg', now) == utc(2026, 10, 18, 19, 0)
+    assert next_fire('00:00', 'Asia/Yekaterinburg', utc(2026, 10, 17, 18, 59)) == utc(2026, 10, 17, 19, 0)
+
+
+def test_next_fire_spring_forward_gap():
+    # 29.03.2026 в Берлине 02:00 -> 03:00: 02:30 не существует, напоминание уходит в 03:30 CEST
+    assert next_fire('02:30', 'Europe/Berlin', utc(2026, 3, 28, 12, 0)) == utc(2026, 3, 29, 1, 30)
+    # На следующий день — снова 02:30 местного (уже CEST)
+    assert next_fire('02:30', 'Europe/Berlin', utc(2026, 3, 29, 1, 31)) == utc(2026, 3, 30, 0, 30)
+
+
+def test_next_fire_fall_back_ambiguous_fires_once():
+    # 25.10.2026 в Берлине 02:30 бывает дважды; напоминание — один раз, во второе (CET)
+    assert next_fire('02:30', 'Europe/Berlin', utc(2026, 10, 24, 12, 0)) == utc(2026, 10, 25, 1, 30)
+    # Первое 02:30 (CEST, 00:30 UTC) уже прошло — срабатывание все равно одно, в 01:30 UTC
+    assert next_fire('02:30', 'Europe/Berlin', utc(2026, 10, 25, 0, 45)) == utc(2026, 10, 25, 1, 30)
+    assert next_fire('02:30', 'Europe/Berlin', utc(2026, 10, 25, 1, 31)) == utc(2026, 10, 26, 1, 30)
@@ -0,0 +1,46 @@
+"""instrument_handlers и время обработки inline-кнопок по маршрутам"""
+import asyncio
+from types import SimpleNamespace
+
+from telegram.ext import CommandHandler
+
+import metrics
+from callback_router import CallbackRouter
+
+
+def handler_exposition() -> str:
+    return '\n'.join(metrics.HANDLER_SECONDS.collect())
+
+
+def test_router_is_timed_per_route():
+    async def show_settings(update, context):
+        pass
+
+    async def select_city(update, context, arg):
+        pass
+
+    async def start(update, context):
+        pass
+
+    router = CallbackRouter()
+    router.add('settings', show_settings)
+    router.add_prefix('city', select_city)
+    handlers = [router.handler(), CommandHandler('start', start)]
+    metrics.instrument_handlers(handlers)
+
+    # Роутер не обернут целиком, обычная команда — обернута
+    assert handlers[0].callback == router.dispatch
+    assert handlers[1].callback is not start and handlers[1].callback.timed
+
+    async def press(data):
+        async def answer(*args, **kwargs):
+            pass
+        query = SimpleNamespace(data=data, answer=answer, from_user=SimpleNamespace(id=1))
+        await handlers[0].callback(SimpleNamespace(callback_query=query), None)
+
+    asyncio.run(press('settings'))
+    asyncio.run(press('city_spb'))
+    exposition = handler_exposition()
+    assert 'bot_handler_seconds_count{handler="show_settings"}' in exposition
+    assert 'bot_handler_seconds_count{handler="select_city"}' in exposition
+    assert 'handler="dispatch"' not in exposition
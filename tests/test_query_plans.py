@@ -0,0 +1,136 @@
+"""Горячие запросы database.py идут по индексам (EXPLAIN QUERY PLAN).
+
+Запросы не копируются в тесты: функции database.py вызываются как есть,
+а выполненный SQL перехватывается через set_trace_callback.
+
+Не проверяются намеренно: чтения backup_state и sqlite_sequence (по одной
+строке на таблицу), запросы экспорта и пересчета user_stats, которые и так
+читают таблицу целиком, и записи по первичному ключу (UPDATE ... WHERE user_id = ?).
+"""
+import pytest
+
+
+@pytest.fixture
+def traced(db):
+    """Список SQL (с подставленными параметрами), выполненных соединением потока"""
+    statements = []
+    conn = db.get_connection()
+    conn.set_trace_callback(statements.append)
+    yield statements
+    conn.set_trace_callback(None)
+
+
+def query_plan(db, statements, marker: str) -> str:
+    """План первого выполненного запроса, содержащего marker"""
+    sql = next(s for s in statements if marker in s)
+    with db.connection() as conn:
+        return '\n'.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql))
+
+
+def test_claim_due_reminders_uses_next_fire_index(db, traced):
+    db.claim_due_reminders(1_700_000_000)
+    plan = query_plan(db, traced, 'WHERE next_fire_utc <=')
+    assert 'SEARCH reminders USING INDEX idx_reminders_next_fire (next_fire_utc<?)' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_delete_voice_memo_uses_memo_index(db, traced):
+    memo_id = db.add_voice_memo('file-1')
+    db.record_voice_memo_delivery(1, memo_id, count_daily=False)
+    assert db.delete_voice_memo(memo_id)
+
+    for marker in ('DELETE FROM voice_deliveries', 'UPDATE voice_memo_cursor'):
+        plan = query_plan(db, traced, marker)
+        assert 'idx_voice_deliveries_memo (memo_id=?)' in plan
+        assert 'SCAN voice_deliveries' not in plan
+
+
+def test_export_summary_uses_covering_index(db, traced):
+    list(db.get_all_users_data())
+    plan = query_plan(db, traced, 'interactions_count')
+    assert 'SCAN bot_interactions USING COVERING INDEX idx_bot_interactions_user' in plan
+
+
+def test_pills_export_reads_in_date_order(db, traced):
+    list(db.iter_pills_taken())
+    plan = query_plan(db, traced, 'FROM pills_taken pt')
+    assert 'SCAN pt USING INDEX idx_pills_taken_date' in plan
+    assert 'TEMP B-TREE FOR ORDER BY' not in plan
+
+
+def test_user_stats_read_by_primary_key(db, traced):
+    db.get_user_stats(1)
+    plan = query_plan(db, traced, 'FROM user_stats WHERE user_id')
+    assert 'SEARCH user_stats USING INTEGER PRIMARY KEY (rowid=?)' in plan
+
+
+def test_next_voice_memo_reads_from_cursor(db, traced):
+    db.get_next_voice_memo_for_user(1)
+    db.get_voice_memo_after(0)
+    for marker in ('FROM voice_memo_cursor WHERE user_id', 'WHERE id > 0'):
+        plan = query_plan(db, traced, marker)
+        assert 'SEARCH voice_memos USING INTEGER PRIMARY KEY (rowid>?)' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+@pytest.mark.parametrize('func, table', [
+    ('is_pill_taken_today', 'pills_taken'),
+    ('is_voice_memo_taken_today', 'voice_memo_daily'),
+])
+def test_daily_marks_use_primary_key(db, traced, func, table):
+    getattr(db, func)(1)
+    plan = query_plan(db, traced, f'FROM {table}')
+    assert f'SEARCH {table} USING COVERING INDEX sqlite_autoindex_{table}_1 (user_id=? AND date=?)' in plan
+
+
+def test_reminder_filter_uses_primary_keys(db, traced):
+    db.filter_pill_not_taken_today([1, 2, 3])
+    assert 'SEARCH reminders USING INTEGER PRIMARY KEY' in query_plan(db, traced, 'WHERE user_id IN')
+    plan = query_plan(db, traced, 'FROM pills_taken')
+    assert 'SEARCH pills_taken USING COVERING INDEX sqlite_autoindex_pills_taken_1 (user_id=? AND date=?)' in plan
+
+
+def test_missed_reminders_use_next_fire_index(db, traced):
+    db.set_reminder_time(1, '09:00')
+    db.claim_missed_reminders(0, 2_000_000_000)
+    db.roll_forward_reminders(2_000_000_000)
+
+    plan = query_plan(db, traced, 'WHERE next_fire_utc >=')
+    assert 'SEARCH reminders USING INDEX idx_reminders_next_fire (next_fire_utc>? AND next_fire_utc<?)' in plan
+    assert 'TEMP B-TREE' not in plan
+    plan = query_plan(db, traced, 'FROM pills_taken WHERE user_id')
+    assert 'sqlite_autoindex_pills_taken_1 (user_id=? AND date=?)' in plan
+    plan = query_plan(db, traced, 'FROM reminders WHERE next_fire_utc <')
+    assert 'SEARCH reminders USING INDEX idx_reminders_next_fire (next_fire_utc<?)' in plan
+
+
+def test_delta_reads_journal_by_range(db, monkeypatch):
+    import db_backup
+
+    db.set_reminder_time(1, '09:00')
+    backup = db_backup.create_backup()
+    db_backup.commit_backup(backup['chain'])
+    db_backup.remove(backup['path'])
+    db.set_reminder_time(2, '09:00')
+
+    # create_delta открывает собственное соединение — перехватываем и его SQL
+    statements = []
+    connect = db_backup.sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(db_backup.sqlite3, 'connect', traced_connect)
+    path, _header = db_backup.create_delta()
+    db_backup.remove(path)
+
+    plan = query_plan(db, statements, 'SELECT DISTINCT table_name FROM change_journal')
+    assert 'SEARCH change_journal USING INTEGER PRIMARY KEY (rowid>? AND rowid<?)' in plan
+    # После commit_backup / commit_delta в журнале остаются только строки из диапазона
+    # дельты, поэтому поиск по (table_name) не хуже диапазона по seq
+    plan = query_plan(db, statements, 'FROM change_journal j')
+    assert 'SEARCH j USING COVERING INDEX sqlite_autoindex_change_journal_1 (table_name=?)' in plan
+    assert 'SEARCH t USING INTEGER PRIMARY KEY (rowid=?)' in plan
+    assert 'SCAN' not in plan
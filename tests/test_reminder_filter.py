@@ -0,0 +1,29 @@
+"""filter_pill_not_taken_today: отбор получателей напоминаний одним запросом"""
+import local_time
+
+
+def test_filter_uses_each_users_today(db):
+    db.set_reminder_time(1, '09:00', 'Europe/Moscow')
+    db.set_reminder_time(2, '09:00', 'Pacific/Kiritimati')
+    db.set_reminder_time(3, '09:00', 'Pacific/Pago_Pago')
+    # Отметка за «сегодня» Москвы: для остальных поясов это может быть другой день
+    moscow_today = local_time.local_today('Europe/Moscow')
+    for user_id in (1, 2, 3):
+        db.mark_pill_taken(user_id, moscow_today)
+
+    pending = db.filter_pill_not_taken_today([1, 2, 3, 4])
+    expected = [4] + [
+        user_id for user_id, tz in ((2, 'Pacific/Kiritimati'), (3, 'Pacific/Pago_Pago'))
+        if local_time.local_today(tz) != moscow_today
+    ]
+    assert sorted(pending) == sorted(expected)
+    assert pending == [u for u in [1, 2, 3, 4] if not db.is_pill_taken_today(u)]
+
+
+def test_filter_splits_large_batches(db, monkeypatch):
+    monkeypatch.setattr(db, '_IN_BATCH_SIZE', 2)
+    for user_id in range(1, 6):
+        db.set_reminder_time(user_id, '09:00')
+    for user_id in (2, 5):
+        db.mark_pill_taken(user_id, db.get_user_today(user_id))
+    assert db.filter_pill_not_taken_today([1, 2, 3, 4, 5]) == [1, 3, 4]
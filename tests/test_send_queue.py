@@ -0,0 +1,24 @@
+"""SendQueue.send_batch: отчет о доставке при остановке очереди"""
+import asyncio
+
+from send_queue import SendQueue
+
+
+def test_cancelled_sends_are_counted_as_failed():
+    async def scenario():
+        queue = SendQueue(workers=1)
+
+        async def ok():
+            return True
+
+        async def slow():
+            await asyncio.sleep(60)
+
+        batch = asyncio.create_task(queue.send_batch([(1, ok), (2, slow), (3, ok)]))
+        await asyncio.sleep(0.05)
+        await queue.close()
+        return await asyncio.wait_for(batch, 1)
+
+    report = asyncio.run(scenario())
+    assert (report.sent, report.failed) == (1, 2)
+    assert set(report.errors) == {2, 3}
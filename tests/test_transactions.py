@@ -0,0 +1,47 @@
+"""transaction(): сбой COMMIT и откат, уже сделанный самим SQLite"""
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def deferred_fk(db):
+    """Таблицы с отложенным внешним ключом: нарушение обнаруживается только на COMMIT"""
+    conn = db.get_connection()
+    conn.execute('PRAGMA foreign_keys=ON')
+    conn.execute('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+    conn.execute('CREATE TABLE child (parent_id INTEGER REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)')
+    return db
+
+
+def committed_parents(db) -> list:
+    # Отдельное соединение видит только зафиксированные данные
+    other = sqlite3.connect(db.DATABASE_NAME)
+    try:
+        return [row[0] for row in other.execute('SELECT id FROM parent ORDER BY id')]
+    finally:
+        other.close()
+
+
+def test_failed_commit_does_not_poison_next_transaction(deferred_fk):
+    db = deferred_fk
+    with pytest.raises(sqlite3.IntegrityError):
+        with db.transaction() as conn:
+            conn.execute('INSERT INTO child VALUES (1)')
+
+    assert not db.get_connection().in_transaction
+    with db.transaction() as conn:
+        conn.execute('INSERT INTO parent VALUES (5)')
+    assert committed_parents(db) == [5]
+
+
+def test_original_error_survives_rollback_done_by_sqlite(db):
+    with pytest.raises(ValueError):
+        with db.transaction() as conn:
+            # Так выглядит транзакция, которую SQLite откатил сам
+            conn.execute('ROLLBACK')
+            raise ValueError('original')
+
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO reminders (user_id, reminder_time, created_at) VALUES (1, '09:00', 'now')")
+    assert db.get_reminder_time(1) == '09:00'
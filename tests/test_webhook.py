@@ -0,0 +1,40 @@
+"""WebhookServer: проверка Content-Length до чтения тела"""
+import asyncio
+
+import pytest
+
+import webhook
+
+
+async def exchange(request: bytes) -> bytes:
+    server = webhook.WebhookServer(application=None, path='/telegram')
+    await server.start('127.0.0.1', 0)
+    try:
+        port = server._server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 2)
+        writer.close()
+        return response
+    finally:
+        await server.stop()
+
+
+@pytest.mark.parametrize('value', ['-1', 'abc', '+5', '1e3', '٣'])
+def test_invalid_content_length_is_rejected(value):
+    request = f'POST /telegram HTTP/1.1\r\nContent-Length: {value}\r\n\r\n'.encode()
+    response = asyncio.run(exchange(request))
+    assert response.startswith(b'HTTP/1.1 400 ')
+
+
+def test_oversized_body_is_rejected_before_reading():
+    # Тело не отправляется: ответ должен прийти без его ожидания
+    request = f'POST /telegram HTTP/1.1\r\nContent-Length: {webhook.MAX_BODY_SIZE + 1}\r\n\r\n'.encode()
+    response = asyncio.run(exchange(request))
+    assert response.startswith(b'HTTP/1.1 413 ')
+
+
+def test_health_without_body():
+    response = asyncio.run(exchange(b'GET /health HTTP/1.1\r\nConnection: close\r\n\r\n'))
+    assert response.startswith(b'HTTP/1.1 200 ')
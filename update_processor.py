@@ -0,0 +1,118 @@
+"""
+Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+Обновления разных пользователей обрабатываются одновременно (не больше
+max_concurrent_updates), а обновления одного пользователя — строго по
+очереди в порядке поступления. Так медленная отправка или экспорт одного
+пользователя не задерживают остальных, а флаги в context.user_data
+(например, waiting_for_custom_time) не гоняются.
+"""
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Семафор базового класса захватывается до ожидания очереди пользователя: если бы
+# он ограничивал параллельность, пачка нажатий одного пользователя заняла бы все места.
+# Поэтому базовый лимит фактически отключен, а свой лимит берется после очереди пользователя.
+_BASE_LIMIT = 1_000_000
+
+
+class _UserQueue:
+    __slots__ = ('lock', 'pending')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но последовательно в пределах одного пользователя"""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(_BASE_LIMIT)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._queues = {}
+        # Метрики: сколько обновлений обрабатывается и сколько ждет свободного места
+        self.active = 0
+        self.waiting = 0
+        self.processed = 0
+        self.max_waiting = 0
+        self.wait_time_total = 0.0
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        started = time.monotonic()
+        key = self._key(update)
+        try:
+            if key is None:
+                await self._run(coroutine, started)
+                return
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = _UserQueue()
+            queue.pending += 1
+            self.max_waiting = max(self.max_waiting, self.waiting + self.queued_behind_user)
+            try:
+                # asyncio.Lock отдает блокировку в порядке ожидания, а задачи приходят в порядке обновлений
+                async with queue.lock:
+                    await self._run(coroutine, started)
+            finally:
+                queue.pending -= 1
+                if not queue.pending:
+                    del self._queues[key]
+        finally:
+            # Если ожидание прервали (остановка бота), корутина так и не запускалась
+            coroutine.close()
+
+    async def _run(self, coroutine, started: float):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting + self.queued_behind_user)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        self.wait_time_total += time.monotonic() - started
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+            self._slots.release()
+
+    @property
+    def queued_behind_user(self) -> int:
+        """Сколько обновлений ждут завершения предыдущих обновлений того же пользователя"""
+        # В каждой очереди ровно одно обновление держит блокировку, остальные ждут
+        return sum(queue.pending for queue in self._queues.values()) - len(self._queues)
+
+    def get_stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'queued_behind_user': self.queued_behind_user,
+            'users': len(self._queues),
+            'max_waiting': self.max_waiting,
+            'processed': self.processed,
+            'wait_time_total': round(self.wait_time_total, 3),
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
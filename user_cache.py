@@ -0,0 +1,105 @@
+"""
+Кэш профилей пользователей для горячих чтений.
+
+Экран «Информация», выбор города и кнопки меню подряд читают часовой пояс,
+время напоминания, счетчики дней и отметку о таблеточке. Эти значения
+меняются только при записях из обработчиков, поэтому их можно отдавать из
+памяти: профиль пользователя живет в LRU с ограниченным временем жизни и
+сбрасывается при каждой записи в его данные (см. async_database).
+
+Кэш используется только из event loop.
+"""
+import time
+from collections import OrderedDict
+
+import config
+
+MISSING = object()
+
+
+class UserCache:
+    """LRU профилей: user_id -> {поле: (истекает, значение)}"""
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._profiles = OrderedDict()
+        # Растет при каждом сбросе: чтение, начатое до сброса, не кладет в кэш старое значение
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int, field):
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            entry = profile.get(field)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self._profiles.move_to_end(user_id)
+                return entry[1]
+        self.misses += 1
+        return MISSING
+
+    def put(self, user_id: int, field, value, generation: int = None):
+        if generation is not None and generation != self._generation:
+            return
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            profile = self._profiles[user_id] = {}
+        profile[field] = (time.monotonic() + self.ttl, value)
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_users:
+            self._profiles.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._generation += 1
+        self.invalidations += 1
+        self._profiles.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._profiles.clear()
+
+    def __len__(self):
+        return len(self._profiles)
+
+
+_cache = UserCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
+
+def get(user_id: int, field):
+    """Значение поля профиля или MISSING"""
+    return _cache.get(user_id, field)
+
+
+def put(user_id: int, field, value, generation: int = None):
+    """Кладет значение; если передан generation и с тех пор был сброс — ничего не делает"""
+    _cache.put(user_id, field, value, generation)
+
+
+def generation() -> int:
+    return _cache.generation
+
+
+def invalidate(user_id: int):
+    """Сбрасывает профиль пользователя (после записи в его данные)"""
+    _cache.invalidate(user_id)
+
+
+def clear():
+    """Сбрасывает весь кэш (например, после восстановления базы)"""
+    _cache.clear()
+
+
+def get_stats() -> dict:
+    return {
+        'size': len(_cache),
+        'hits': _cache.hits,
+        'misses': _cache.misses,
+        'invalidations': _cache.invalidations,
+    }
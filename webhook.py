@@ -0,0 +1,208 @@
+"""
+Запуск бота в режиме webhook.
+
+Telegram сам присылает обновления POST-запросами, а не бот забирает их
+long polling'ом. HTTP-сервер (asyncio, без внешних зависимостей) работает
+в том же event loop, что и бот: принятое обновление сразу кладется в
+очередь Application, и задержка ответа определяется только нашим сервером.
+
+Запуск: python webhook.py
+
+Если WEBHOOK_URL не задан, webhook в Telegram не регистрируется — так
+удобно проверять бота локально, отправляя сохраненные обновления:
+
+    curl -X POST localhost:8080/telegram \
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' \
+         -d @update.json
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from telegram import Update
+
+import admin_tools
+import bot
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Больше Telegram не присылает; защита от мусорных запросов
+MAX_BODY_SIZE = 1024 * 1024
+# Сколько ждать следующий запрос в keep-alive соединении (секунды)
+KEEP_ALIVE_TIMEOUT = 75
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+}
+
+
+class WebhookServer:
+    """Минимальный HTTP/1.1 сервер: POST <path> с JSON-обновлением, GET /health и GET /metrics"""
+
+    def __init__(self, application, path: str, secret_token: str = None):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                if not request_line:
+                    return
+
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, close=True)
+                    return
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                # Только десятичные цифры: int() пропустил бы '-1', '+5' и ' 5'
+                content_length = headers.get('content-length') or '0'
+                if not (content_length.isascii() and content_length.isdigit()):
+                    await self._respond(writer, 400, close=True)
+                    return
+                # Размер проверяется до чтения тела
+                length = int(content_length)
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, close=True)
+                    return
+                body = await reader.readexactly(length) if length else b''
+
+                path = target.split('?', 1)[0]
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                if path == '/metrics':
+                    await self._respond(writer, 200, close=close, body=metrics.render().encode(),
+                                        content_type=metrics.CONTENT_TYPE)
+                else:
+                    status = await self._dispatch(method, path, headers, body)
+                    await self._respond(writer, status, close=close)
+                if close:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Webhook connection error: {e}", exc_info=True)
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        if path == '/health':
+            return 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+
+        if self.secret_token and not hmac.compare_digest(
+            headers.get('x-telegram-bot-api-secret-token', ''), self.secret_token
+        ):
+            self.rejected += 1
+            return 403
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Rejected malformed update: {e}")
+            self.rejected += 1
+            return 400
+
+        # Обработка идет в Application; Telegram получает ответ сразу
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return 200
+
+    async def _respond(self, writer, status: int, close: bool = False, body: bytes = b'', content_type: str = None):
+        head = f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Length: {len(body)}\r\n"
+        if content_type:
+            head += f"Content-Type: {content_type}\r\n"
+        head += f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def run_webhook():
+    """Запускает бота и webhook-сервер до SIGINT/SIGTERM"""
+    application = bot.build_application()
+    admin_tools.add_handlers(application)
+    metrics.instrument_application(application)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    server = WebhookServer(application, config.WEBHOOK_PATH, config.WEBHOOK_SECRET or None)
+
+    await application.initialize()
+    try:
+        # post_init/post_shutdown вызываются только из run_polling/run_webhook, поэтому вручную
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+
+        if config.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=config.DROP_PENDING_UPDATES,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info("Webhook registered in Telegram")
+        else:
+            logger.info("WEBHOOK_URL is not set, webhook is not registered (local mode)")
+
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def main():
+    asyncio.run(run_webhook())
+
+
+if __name__ == '__main__':
+    main()